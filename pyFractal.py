@@ -1,4 +1,34 @@
-from src.GUI import run
+import sys
 
 if __name__ == "__main__":
-    run()
\ No newline at end of file
+    #log the metrics if asked to by the PYFRACTAL_METRICS/PYFRACTAL_TRACE environment variables (see src/metrics.py)
+    from src import metrics
+    metrics.from_environment()
+
+    #python pyFractal.py render ... renders views without the GUI (see src/batch.py),
+    #python pyFractal.py zoom ... renders zoom movies (see src/zoom.py),
+    #python pyFractal.py benchmark ... benchmarks the calculation backends (see src/benchmark.py),
+    #python pyFractal.py autoconfig times the backends and writes the fastest to .pyfractalrc (see src/autoconfig.py),
+    #python pyFractal.py serve ... serves map tiles over HTTP (see src/tileserver.py),
+    #python pyFractal.py loadgen ... measures the tile server's throughput and latency (see src/loadgen.py)
+    if len(sys.argv) > 1 and sys.argv[1] == "render":
+        from src.batch import main
+        sys.exit(main(sys.argv[2:]))
+    elif len(sys.argv) > 1 and sys.argv[1] == "zoom":
+        from src.zoom import main
+        sys.exit(main(sys.argv[2:]))
+    elif len(sys.argv) > 1 and sys.argv[1] == "benchmark":
+        from src.benchmark import main
+        sys.exit(main(sys.argv[2:]))
+    elif len(sys.argv) > 1 and sys.argv[1] == "autoconfig":
+        from src.autoconfig import main
+        sys.exit(main(sys.argv[2:]))
+    elif len(sys.argv) > 1 and sys.argv[1] == "serve":
+        from src.tileserver import main
+        sys.exit(main(sys.argv[2:]))
+    elif len(sys.argv) > 1 and sys.argv[1] == "loadgen":
+        from src.loadgen import main
+        sys.exit(main(sys.argv[2:]))
+    else:
+        from src.GUI import run
+        run()
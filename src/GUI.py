@@ -2,20 +2,30 @@ import sys
 import os
 import time
 import json
+from decimal import Decimal
 
 from PyQt5 import QtCore, QtWidgets
 
-import numpy as np
 
 import matplotlib
 matplotlib.use('Qt5Agg')
 from matplotlib.backends.backend_qt5agg import FigureCanvasQTAgg
 from matplotlib.figure import Figure
-import matplotlib.image as MPLimage
 
-from .mandelbrot import Mandelbrot
+from .mandelbrot import choose_maxiter, progressive_steps, numpy_platform
+from .multidevice import create_mandelbrot
+from .tilecache import TileCache
 from . import checkcl
 from . import pngs
+from . import perturbation
+from . import export
+from . import antialias
+from .renderer import RenderThread
+from .colour import ColourPipeline
+from .reuse import Frame, reuse, tolerance
+from .settings import load_settings, save_settings, load_preferences
+from . import view
+from . import metrics
 
 
 
@@ -37,62 +47,9 @@ scaling = [
     "Cbrt"
 ]
 
+#directory the rendered tiles are cached in between runs
+cachedir = ".pyfractalcache"
 
-#loads the OpenCl and precision settings from .pyfractalrc
-def load_settings():
-    if os.path.exists(".pyfractalrc"):
-        print("Loading settings from .pyfractalrc...")
-        try:
-            f=open(".pyfractalrc","r")
-            contents=f.readlines()
-            f.close()
-
-            platformline = contents[0]
-            deviceline = contents[1]
-            precisionline = contents[2]
-            
-            #read in platform
-            platforms = platformline.split()
-            if platforms[0] != "platform":
-                print("Platform line incorrect")
-                return None
-            platform = int(platforms[1])
-            print("Platform = %d"%platform)
-            
-            #read in device
-            devices = deviceline.split()
-            if devices[0] != "device":
-                print("Devices line wrong")
-                return None
-            device = int(devices[1])
-            print("Device = %d"%device)
-            
-            #read in precision
-            precisions = precisionline.split()
-            if precisions[0] != "precision":
-                print("Problem with the precision line")
-                return None
-            precision = int(precisions[1])
-            print("Precision = %d"%precision)
-
-            return platform, device, precision
-        except Exception as e:
-            print(e)
-            return None
-    else:
-        print("No config file")
-        return None
-        
-
-#saves the OpenCL and precision settings to .pyfractalrc
-def save_settings(platform,device,precision):
-    f = open('.pyfractalrc',"w")
-    f.write("platform %d\n"%platform)
-    f.write("device %d\n"%device)
-    f.write("precision %d\n"%precision)
-    f.close()
-
-    
 
 #allows the user to select the OpenCL platform and device graphically
 class configurePopup(QtWidgets.QDialog):
@@ -109,13 +66,20 @@ class configurePopup(QtWidgets.QDialog):
         pnames = []
         for platform in self.platforms:
                 pnames.append("Platform: "+platform["name"])
-        #add a OpenCL not available platform
+        #add an option to render on every device of every platform at once (platform -2), and OpenCL not available
+        #platforms: the Numba fallback (platform -1) and the NumPy fallback (platform -3), which needs neither
+        pnames.append("All platforms (every device)")
         pnames.append("None (do not use OpenCL)")
+        pnames.append("None (do not use OpenCL or Numba: NumPy only, slow)")
         
         #set the platform, device and precision to the parent window's current settings
         self.platform = parent.platform
         self.device = parent.device
         self.precision = parent.precision
+
+        #the preference table of auto-configuration (see autoconfig.py), kept as long as the settings it chose are
+        self.preferences = parent.preferences
+        self.autoChoice = (self.platform, self.device, self.precision)
         
         layout = QtWidgets.QVBoxLayout()
 
@@ -140,12 +104,19 @@ class configurePopup(QtWidgets.QDialog):
         self.deviceChooser.setEnabled(False)
         layout.addWidget(self.deviceChooser)
 
+        #the precision setting of each item of precisionChooser (see setPrecisions)
+        self.precisions = []
         self.precisionChooser = QtWidgets.QComboBox()
         self.precisionChooser.currentIndexChanged.connect(self.selectPrecision)
         self.precisionChooser.setEnabled(False)
         layout.addWidget(self.precisionChooser)
 
 
+        #time every backend and choose the fastest
+        self.autoButton = QtWidgets.QPushButton("Auto-configure (time every device)")
+        self.autoButton.clicked.connect(self.autoconfigure)
+        layout.addWidget(self.autoButton)
+
         self.okButton = QtWidgets.QPushButton("Ok")
         self.okButton.clicked.connect(self.confirm)
         self.okButton.setEnabled(False)
@@ -155,16 +126,37 @@ class configurePopup(QtWidgets.QDialog):
         
         #if configurePopup is called from the menu we preset the existing settings.
         if self.platform is not None:
-            self.platformChooser.setCurrentIndex(self.platform)
-            self.deviceChooser.setCurrentIndex(self.device)
-            self.precisionChooser.setCurrentIndex(self.precision)
+            if self.platform == -2:
+                self.platformChooser.setCurrentIndex(len(self.platforms))
+            elif self.platform == numpy_platform:
+                self.platformChooser.setCurrentIndex(len(self.platforms)+2)
+            elif self.platform < 0:
+                self.platformChooser.setCurrentIndex(len(self.platforms)+1)
+            else:
+                self.platformChooser.setCurrentIndex(self.platform)
+                if self.device == -1:
+                    self.deviceChooser.setCurrentIndex(len(self.platforms[self.platform]["devices"]))
+                else:
+                    self.deviceChooser.setCurrentIndex(self.device)
+            if self.precision in self.precisions:
+                self.precisionChooser.setCurrentIndex(self.precisions.index(self.precision))
             
     #called when the user selects a platform from platformChooser
     def selectPlatform(self,n):
         
-        #If the fallback is selected
+        #If every device is selected
         if n == len(self.platforms):
-            self.platform = -1
+            self.platform = -2
+            self.device = -1
+
+            self.deviceChooser.clear()
+            self.deviceChooser.setPlaceholderText("--all devices--")
+            self.deviceChooser.setEnabled(False)
+
+            self.setPrecisions(all(d["double_precision"] for p in self.platforms for d in p["devices"]))
+        #If one of the fallbacks is selected
+        elif n == len(self.platforms)+1 or n == len(self.platforms)+2:
+            self.platform = -1 if n == len(self.platforms)+1 else numpy_platform
             self.device = -1
             self.precision = 1
 
@@ -185,6 +177,9 @@ class configurePopup(QtWidgets.QDialog):
             devicelist = []
             for d in devices:
                 devicelist.append("Device: "+d["name"])
+            #render on all the platform's devices at once (device -1)
+            if len(devices) > 1:
+                devicelist.append("All devices")
             
             if len(devices) > 0:
                 self.deviceChooser.clear()
@@ -212,33 +207,67 @@ class configurePopup(QtWidgets.QDialog):
         if n < 0: 
             return
 
+        devices = self.platforms[self.platform]["devices"]
+        if n == len(devices):
+            self.device = -1
+            self.setPrecisions(all(d["double_precision"] for d in devices))
+        else:
+            self.setPrecisions(devices[n]["double_precision"])
+
+    #Fills precisionChooser with the precisions available (dp is whether the chosen device(s) support double precision),
+    #keeping the precision setting of each item in self.precisions. Without double precision, Auto switches from single
+    #precision to float-float instead
+    def setPrecisions(self,dp):
         self.precisionChooser.clear()
         self.okButton.setEnabled(False)
-        dp = self.platforms[self.platform]["devices"][n]["double_precision"]
         self.precisionChooser.setPlaceholderText("--select precision--")
         if dp:
-            self.precisionChooser.addItems(["Precision: Single","Precision: Double", "Precision: Auto"])
+            self.precisions = [0, 1, 2, 3]
+            self.precisionChooser.addItems(["Precision: Single","Precision: Double", "Precision: Auto", "Precision: Float-float (emulated double)"])
         else:
-            self.precisionChooser.addItems(["Precision: Single (device does not support double precision)"])
+            self.precisions = [0, 2, 3]
+            self.precisionChooser.addItems(["Precision: Single","Precision: Auto (single, then float-float)","Precision: Float-float (device does not support double precision)"])
         self.precisionChooser.setEnabled(True)
 
     #called when the user selects a precision from precisionChooser   
     def selectPrecision(self,n):
         
-        if self.platform == -1:
+        if self.platform in (-1, numpy_platform):
             self.precision = 1
-        else:
-            self.precision = n
+        elif n >= 0:
+            self.precision = self.precisions[n]
         self.okButton.setEnabled(True)
 
+    #Called when the "Auto-configure" button is pressed. Times a short render on every backend (see autoconfig.py),
+    #which takes a few seconds per device, then chooses the fastest with automatic precision and closes the dialogue
+    def autoconfigure(self):
+        from .autoconfig import autoconfigure
+        QtWidgets.QApplication.setOverrideCursor(QtCore.Qt.WaitCursor)
+        try:
+            config = autoconfigure()
+        finally:
+            QtWidgets.QApplication.restoreOverrideCursor()
+        if config is None:
+            QtWidgets.QMessageBox.warning(self,"pyFractal setup","No device could be timed")
+            return
+
+        self.platform, self.device, self.precision, self.preferences = config
+        self.autoChoice = (self.platform, self.device, self.precision)
+        self.confirm()
+
     #called when the "ok" button is pressed. Updates the settings for the parent window, writes settings to file and closes the dialogue
     def confirm(self):
         print(self.platform, self.device, self.precision)
+        #choosing the settings by hand replaces those auto-configuration chose
+        if (self.platform, self.device, self.precision) != self.autoChoice:
+            self.preferences = None
+
         self.parent.platform = self.platform
         self.parent.device = self.device
         self.parent.precision = self.precision
+        self.parent.preferences = self.preferences
 
-        save_settings(self.platform,self.device,self.precision)
+        save_settings(self.platform,self.device,self.precision,self.preferences)
         self.close()
 
 
@@ -253,6 +282,7 @@ class MplCanvas(FigureCanvasQTAgg):
         #request no margins for the subplot
         fig.subplots_adjust(left=0.0,right=1.0,bottom=0.0,top=1.0)
         self.axes = fig.add_subplot(111)
+        self.axes.set_axis_off()
 
 
         
@@ -281,10 +311,13 @@ class MainWindow(QtWidgets.QMainWindow):
         self.cmap_inverted = False #set initial cmap inversion to False
         self.scaling = scaling[0] #select the first scaling option (linear)
         self.real = False #set real-valued mandelbrot calculation to false (e.g. use discrete)
+        self.progressive = True #show coarse previews while each frame is calculated
+        self.antialias = False #supersample the edges of saved images
         
 
         #try to load the settings from the config file .pyfractalrc
         config = load_settings()
+        self.preferences = load_preferences()
         if config is not None:
             self.platform, self.device, self.precision = config
         #if this was unsuccessful, open a dialogue for the user to choose the configuration
@@ -303,8 +336,17 @@ class MainWindow(QtWidgets.QMainWindow):
             self.close()
             sys.exit()
         
-        #object that calculates the mandelbrot set
-        self.Mandelbrot = Mandelbrot(platform = self.platform, device=self.device)
+        #object that calculates the mandelbrot set, and those of the other backends automatic precision uses (see backend)
+        self.Mandelbrot = create_mandelbrot(self.platform, self.device)
+        self.backends = {(self.platform, self.device): self.Mandelbrot}
+
+        #cache of already rendered tiles, so views we have seen before do not need recalculating
+        self.tilecache = TileCache(directory=cachedir)
+
+        #calculates the frames in the background, handing them to showFrame when they are done
+        self.renderer = RenderThread(self)
+        self.renderer.frameReady.connect(self.showFrame)
+        self.renderer.start()
         
         mainwidget = QtWidgets.QWidget()
         mainlayout = QtWidgets.QHBoxLayout()
@@ -367,6 +409,23 @@ class MainWindow(QtWidgets.QMainWindow):
         self.continuousToggle.toggled.connect(lambda:self.toggle_real(self.continuousToggle))
         self.discreteToggle.setChecked(True)
 
+        #only calculate the borders of regions, filling in the ones with uniform borders
+        self.subdivideToggle = QtWidgets.QCheckBox("Boundary subdivision")
+        self.subdivideToggle.stateChanged.connect(lambda: self.toggle_subdivide(self.subdivideToggle))
+        realLayout.addWidget(self.subdivideToggle)
+
+        #show coarse previews while calculating
+        self.progressiveToggle = QtWidgets.QCheckBox("Progressive rendering")
+        self.progressiveToggle.setChecked(self.progressive)
+        self.progressiveToggle.stateChanged.connect(lambda: self.toggle_progressive(self.progressiveToggle))
+        realLayout.addWidget(self.progressiveToggle)
+
+        #supersample the pixels along edges when saving images
+        self.antialiasToggle = QtWidgets.QCheckBox("Anti-aliased export")
+        self.antialiasToggle.setChecked(self.antialias)
+        self.antialiasToggle.stateChanged.connect(lambda: self.toggle_antialias(self.antialiasToggle))
+        realLayout.addWidget(self.antialiasToggle)
+
         realWidget.setLayout(realLayout)
         panelLayout.addWidget(realWidget)
 
@@ -386,6 +445,18 @@ class MainWindow(QtWidgets.QMainWindow):
 
         #The canvas for matplotlib
         self.canvas = MplCanvas(self ,width=10, height=10, dpi=100)
+
+        #the image displayed on the canvas (created by the first plot, then updated in place) and the pipeline
+        #that colours it, which caches the scaled images and colourmap lookup tables
+        self.image = None
+        self.colours = ColourPipeline()
+
+        #the last frame the render thread calculated, which the next can reuse pixels from (see reuse.py)
+        self.lastFrame = None
+
+        #rolling timings of the last few frames' stages, shown in the status bar
+        self.stats = metrics.RollingStats()
+        metrics.subscribe(self.stats)
         
         #bind mouse clicks and mouse movement events to some hander functions
         self.canvas.mpl_connect("button_press_event",self.onclick)
@@ -423,16 +494,27 @@ class MainWindow(QtWidgets.QMainWindow):
             if button.isChecked():
                 if not self.real:
                     self.real=True
-                    print("Continuous")
                     self.plot()
                 
         elif button.text() == "Discrete":
             if button.isChecked():
                 if self.real:
                     self.real=False
-                    print("Discrete")
                     self.plot()
         
+    #Switches boundary subdivision (Mariani-Silver) rendering on/off. This does not change the image so there is no need to replot
+    def toggle_subdivide(self,button):
+        for mandelbrot in self.backends.values():
+            mandelbrot.subdivide = button.isChecked()
+        
+    #Switches the coarse-to-fine previews on/off. This does not change the final image so there is no need to replot
+    def toggle_progressive(self,button):
+        self.progressive = button.isChecked()
+
+    #Switches anti-aliasing of saved images on/off. This only affects exports so there is no need to replot
+    def toggle_antialias(self,button):
+        self.antialias = button.isChecked()
+        
     #Changes the colourmap being used
     # This is called when the approproate radioboxes are toggled
     def toggle_cmap(self):
@@ -471,126 +553,211 @@ class MainWindow(QtWidgets.QMainWindow):
         if fname != "":
             self.writeImage(fname)
 
-    #Displays the mandelbrot image. If recalculate is True, re-calculates the Mandelbrot set, else it uses the cached one
+    #Displays the mandelbrot image. If recalculate is True, requests the Mandelbrot set be re-calculated (in the
+    #background, it is displayed by showFrame when it is ready), else it redisplays the cached one
     #This is called by various functions
     def plot(self, recalculate=True):
         #calculate the image if requested
         if recalculate:
-            #determine if we want to use double precision or  single precision
-            if self.precision == 0:
-                double = False
-            elif self.precision == 1:
-                double = True
-            elif self.precision == 2:
-                #switch to DP when pixel size is 1E-7 
-                if (self.xmax-self.xmin)/1000 < 1E-7:
-                    double = True
-                else:
-                    double = False
-            else:
-                raise ValueError("self.precision is not a valid value: %d"%self.precision)
-            if self.real == False:
-                self.img = self.Mandelbrot.calculate(self.xmin,self.xmax,self.ymin,self.ymax, double=double)
+            #determine which backend and precision to use (single, double or float-float)
+            mandelbrot, double = self.backend()
+
+            #choose the iteration budget from the zoom depth and how the last frame used its budget (unless it was
+            #just restored from an image, see loadPNG)
+            if self.keepMaxiter:
+                self.keepMaxiter = False
             else:
-                self.img = self.Mandelbrot.calculate_real(self.xmin,self.xmax,self.ymin,self.ymax, double=double)
-        
-        #scale the image
-        if self.scaling == "Linear":
-            img=self.img
-        elif self.scaling == "Logarithmic":
-            # img = self.img +1
-            img = np.log(self.img)
-        elif self.scaling == "Sqrt":
-            img = np.sqrt(self.img)
-        elif self.scaling == "Cbrt":
-            img = np.cbrt(self.img)
-        
-        #clear the canvas
-        self.canvas.axes.cla()
-        self.canvas.axes.set_axis_off()
-
-        #display the image
+                self.maxiter = choose_maxiter(self.xmax-self.xmin,self.img,self.maxiter)
+
+            self.rebase()
+
+            #the frame is calculated on the render thread, so it gets its own copy of the settings
+            tilecache = self.tilecache
+            xorigin, yorigin = self.xorigin, self.yorigin
+            xmin, xmax, ymin, ymax = self.xmin, self.xmax, self.ymin, self.ymax
+            real = self.real
+            maxiter = self.maxiter
+            deep = self.isDeep()
+            progressive = self.progressive and not mandelbrot.subdivide
+
+            def calculate(show):
+                extent = (xmin,xmax,ymin,ymax)
+
+                #after a pan or zoom out, only calculate the pixels the last frame does not have
+                #(unless the tile cache has the whole view)
+                cached = not deep and tilecache.cached(mandelbrot,xmin,xmax,ymin,ymax,real=real,double=double,maxiter=maxiter)
+                if not cached:
+                    result = reuse(mandelbrot,self.lastFrame,xorigin,yorigin,xmin,xmax,ymin,ymax,real=real,double=double,deep=deep,maxiter=maxiter)
+                    if result is not None:
+                        return result
+
+                if deep:
+                    #beyond double precision: use perturbation theory
+                    img = mandelbrot.calculate_deep(xorigin,yorigin,xmin,xmax,ymin,ymax,real=real,maxiter=maxiter)
+                    return img, extent
+
+                ongrid = tilecache.grid(mandelbrot,xmin,xmax,ymin,ymax,double,1000,1000) is not None
+                if progressive and not cached:
+                    #show coarse previews while the image is calculated. On the tile grid the full resolution image
+                    #comes from the tile cache (so its tiles are kept), otherwise the last pass reuses the previews' samples
+                    steps = progressive_steps[:-1] if ongrid else progressive_steps
+                    for step, img in mandelbrot.calculate_progressive(xmin,xmax,ymin,ymax,real=real,double=double,maxiter=maxiter,steps=steps):
+                        if step == 1:
+                            return img, extent
+                        show((img, extent))
+
+                #assemble the image from cached tiles if the view is on the tile grid (snapping the view to the grid's pixels)
+                result = tilecache.render(mandelbrot,xmin,xmax,ymin,ymax,real=real,double=double,maxiter=maxiter)
+                if result is not None:
+                    return result
+                elif real == False:
+                    img = mandelbrot.calculate(xmin,xmax,ymin,ymax, double=double, maxiter=maxiter)
+                else:
+                    img = mandelbrot.calculate_real(xmin,xmax,ymin,ymax, double=double, maxiter=maxiter)
+                return img, extent
+
+            #remember each finished frame (on the render thread, which calculates one frame at a time) for the next to reuse
+            def work(show):
+                img, extent = calculate(show)
+                self.lastFrame = Frame(img,xorigin,yorigin,*extent,real,double,deep,maxiter,mandelbrot.backend,tolerance(mandelbrot,real))
+                return img, extent
+
+            self.renderer.request(mandelbrot,work)
+            return
+
+        #nothing has been calculated yet
+        if self.img is None:
+            return
+        
+        #scale and colour the image (reusing the scaled image and the colourmap's lookup table if we have them)
         cmap = self.cmap
         if self.cmap_inverted:
             cmap += "_r"
-        self.canvas.axes.imshow(img,
-                                origin="lower",
-                                extent = [self.xmin,self.xmax,self.ymin,self.ymax],
-                                cmap = cmap,
-                                interpolation=None)
+        width, height = self.canvas.get_width_height()
+        ratio = self.canvas.devicePixelRatioF()
+        rgba = self.colours.colour(self.img,self.scaling,cmap,size=(width*ratio,height*ratio))
+
+        #display the image, updating the existing image rather than building a new one
+        extent = [self.xmin,self.xmax,self.ymin,self.ymax]
+        if self.image is None:
+            self.image = self.canvas.axes.imshow(rgba,
+                                                 origin="lower",
+                                                 extent = extent,
+                                                 interpolation=None)
+        else:
+            self.image.set_data(rgba)
+            self.image.set_extent(extent)
         self.canvas.axes.set_xlim(self.xmin,self.xmax)
         self.canvas.axes.set_ylim(self.ymin,self.ymax)
         
-        self.canvas.draw()
+        with metrics.timer("draw"):
+            self.canvas.draw()
+        self.statusBar().showMessage(self.stats.summary())
         self.repaint()
 
     
-    #Generates a high resolution mandelbrot set from the current display and writes it to image file
+    #Receives a finished frame (the image and its view) from the render thread and displays it. Frames which have
+    #been superseded by a newer request, or which arrive while the view is being dragged, are dropped
+    def showFrame(self,generation,result):
+        if not self.renderer.isLatest(generation) or self.clicked:
+            return
+        self.img, (self.xmin,self.xmax,self.ymin,self.ymax) = result
+        self.plot(recalculate=False)
+
+    #stops the render thread when the window is closed
+    def closeEvent(self,event):
+        self.renderer.stop()
+        metrics.unsubscribe(self.stats)
+        super(MainWindow, self).closeEvent(event)
+    
+    #Returns the Mandelbrot object to calculate the current view with, nx pixels across (the frame, by default), and the
+    #precision to calculate it in (see view.use_double). With automatic precision and a preference table from auto-configuration (see autoconfig.py),
+    #this is the fastest backend in the precision the view needs (see view.preferred_backend), otherwise the
+    #chosen device. The other backends' Mandelbrot objects are created the first time they are needed
+    def backend(self,nx=1000):
+        if self.precision != 2 or self.preferences is None:
+            return self.Mandelbrot, view.use_double(self.precision,self.xmin,self.xmax,self.Mandelbrot.double_precision,nx=nx)
+
+        platform, device, double = view.preferred_backend(self.preferences,self.xmin,self.xmax,nx)
+        if (platform, device) not in self.backends:
+            mandelbrot = create_mandelbrot(platform, device)
+            mandelbrot.subdivide = self.subdivideToggle.isChecked()
+            self.backends[(platform, device)] = mandelbrot
+        return self.backends[(platform, device)], double
+
+    #Generates a high resolution mandelbrot set from the current display and writes it to image file (see export.py)
     def writeImage(self, filename,nx=4000,ny=4000):
-        #determine if we want to use double precision or  single precision
-        if self.precision == 0:
-            double = False
-        elif self.precision == 1:
-            double = True
-        elif self.precision == 2:
-            #switch to DP when pixel size is 1E-7 
-            if (self.xmax-self.xmin)/1000 < 1E-7:
-                double = True
-            else:
-                double = False
-        else:
-            raise ValueError("self.precision is not a valid value: %d"%self.precision)
+        #determine which backend and precision to use (single, double or float-float) for the image's pixel size, which
+        #is finer than the frame's, so the image may need perturbation theory where the frame does not
+        mandelbrot, double = self.backend(nx)
+        xorigin, yorigin, xmin, xmax, ymin, ymax = view.split_view(perturbation.add(self.xorigin,self.xmin),perturbation.add(self.xorigin,self.xmax),
+                                                                   perturbation.add(self.yorigin,self.ymin),perturbation.add(self.yorigin,self.ymax),nx=nx)
 
-        #generate the image
-        if self.real == False:
-            img = self.Mandelbrot.calculate(self.xmin,self.xmax,self.ymin,self.ymax, double=double,nx=nx,ny=ny)
-        else:
-            img = self.Mandelbrot.calculate_real(self.xmin,self.xmax,self.ymin,self.ymax, double=double,nx=nx,ny=ny)
-
-        #scale the image
-        if self.scaling == "Linear":
-            pass
-        elif self.scaling == "Logarithmic":
-            img = np.log(img)
-        elif self.scaling == "Sqrt":
-            img = np.sqrt(img)
-        elif self.scaling == "Cbrt":
-            img = np.cbrt(img)
-        
         cmap = self.cmap
         if self.cmap_inverted:
             cmap += "_r"
-        
+
         #Add the display settings to the file so the image can be re-opened by pyFractal
-        metadata={
-            "xmin": self.xmin,
-            "xmax": self.xmax,
-            "ymin": self.ymin,
-            "ymax": self.ymax,
-            "scaling": self.scaling,
-            "cmap": self.cmap,
-            "cmap_inverted": self.cmap_inverted,
-            "continuous": self.real
-        }
-
-        print("Writing '%s'..."%filename,end="",flush=True)
-        MPLimage.imsave(filename,
-                        img,
-                        origin="lower",
-                        cmap = cmap,
-                        metadata = {"Software": "pyFractal",
+        metadata = view.image_metadata(self.xorigin,self.yorigin,self.xmin,self.xmax,self.ymin,self.ymax,
+                                       self.scaling,self.cmap,self.cmap_inverted,self.real,self.maxiter)
+
+        #calculate the image in bands and stream it to the file (resuming an interrupted export of the same view)
+        #once the render thread has finished with the Mandelbrot object
+        with self.renderer.lock:
+            export.export(mandelbrot,filename,xmin,xmax,ymin,ymax,
+                          xorigin=xorigin,yorigin=yorigin,deep=view.is_deep(xmin,xmax,nx),
+                          real=self.real,double=double,maxiter=self.maxiter,nx=nx,ny=ny,
+                          scaling=self.scaling,cmap=cmap,antialias=antialias.samples if self.antialias else 1,
+                          metadata={"Software": "pyFractal",
                                     "pyFractal": json.dumps(metadata)})
-        print(" Done!")
                        
     #resets the view
     def reset(self):
 
+        #exact origin the view's coordinates are relative to (non-zero only for deep zooms, see rebase)
+        self.xorigin = Decimal(0)
+        self.yorigin = Decimal(0)
+
         self.xmin = -2.5
         self.xmax = 1.5
         self.ymin=-2
         self.ymax=2
 
+        #the iteration budget is chosen afresh for the new view
+        self.img = None
+        self.maxiter = None
+        self.keepMaxiter = False
+
         self.plot()
+
+    #returns True if the view is deep enough to need perturbation theory
+    def isDeep(self):
+        return view.is_deep(self.xmin,self.xmax)
+
+    #For deep zooms, moves the exact origin (xorigin, yorigin) to the centre of the view, so that xmin ... ymax
+    #are small floats relative to it which keep full precision. Otherwise moves the origin back to 0, so that
+    #xmin ... ymax are the actual coordinates again
+    def rebase(self):
+        if self.isDeep():
+            xc = (self.xmin+self.xmax)/2
+            yc = (self.ymin+self.ymax)/2
+            self.xorigin = perturbation.add(self.xorigin,xc)
+            self.yorigin = perturbation.add(self.yorigin,yc)
+            self.xmin -= xc
+            self.xmax -= xc
+            self.ymin -= yc
+            self.ymax -= yc
+        elif self.xorigin != 0 or self.yorigin != 0:
+            self.xmin = float(perturbation.add(self.xorigin,self.xmin))
+            self.xmax = float(perturbation.add(self.xorigin,self.xmax))
+            self.ymin = float(perturbation.add(self.yorigin,self.ymin))
+            self.ymax = float(perturbation.add(self.yorigin,self.ymax))
+            self.xorigin = Decimal(0)
+            self.yorigin = Decimal(0)
+
+    #sets the view to the exact coordinates xmin ... ymax (Decimals)
+    def setView(self,xmin,xmax,ymin,ymax):
+        self.xorigin, self.yorigin, self.xmin, self.xmax, self.ymin, self.ymax = view.split_view(xmin,xmax,ymin,ymax)
     
     #When a mouse button is clicked, registers this event in self.clicked and its time in self.clickstart 
     def onclick(self,event):
@@ -637,7 +804,6 @@ class MainWindow(QtWidgets.QMainWindow):
     def zoom(self,event):
         
         x, y = event.xdata, event.ydata
-        print(x,y)
 
         xrange = self.xmax-self.xmin
         yrange = self.ymax-self.ymin
@@ -648,11 +814,9 @@ class MainWindow(QtWidgets.QMainWindow):
         if event.button == 1:
             xrange /=2
             yrange /=2
-            print("Zoom in")
         elif event.button ==3:
             xrange *=2
             yrange *=2
-            print("Zoom out")
         
         self.xmin = x-lambdax*xrange
         self.xmax = self.xmin+xrange
@@ -667,8 +831,6 @@ class MainWindow(QtWidgets.QMainWindow):
         # self.ymin = y-yrange/2
         # self.ymax = y+yrange/2
 
-        print(xrange,yrange)
-
         self.plot()
 
 
@@ -676,12 +838,15 @@ class MainWindow(QtWidgets.QMainWindow):
         #Have a popup window to allow the user to select the platform, device and which precision to use
         oldPlatform = self.platform
         oldDevice = self.device
+        oldPreferences = self.preferences
 
         popup=configurePopup(self)
         popup.exec_()
 
-        if self.platform != oldPlatform or self.device != oldDevice:
-            self.Mandelbrot = Mandelbrot(platform=self.platform,device=self.device)
+        if self.platform != oldPlatform or self.device != oldDevice or self.preferences != oldPreferences:
+            self.Mandelbrot = create_mandelbrot(self.platform, self.device)
+            self.Mandelbrot.subdivide = self.subdivideToggle.isChecked()
+            self.backends = {(self.platform, self.device): self.Mandelbrot}
             self.plot()
 
     #opens a PNG file written by pyFractal and changes the view to match this image
@@ -699,10 +864,11 @@ class MainWindow(QtWidgets.QMainWindow):
         if "pyFractal" in metadata.keys():
             settings = json.loads(metadata["pyFractal"])
 
-            self.xmin = settings["xmin"]
-            self.xmax = settings["xmax"]
-            self.ymin = settings["ymin"]
-            self.ymax = settings["ymax"]
+            #the coordinates are decimal strings (or floats in images from older versions)
+            self.setView(perturbation.exact(settings["xmin"]),
+                         perturbation.exact(settings["xmax"]),
+                         perturbation.exact(settings["ymin"]),
+                         perturbation.exact(settings["ymax"]))
 
             self.cmap = settings["cmap"]
             for cmap in self.cmaps:
@@ -723,6 +889,12 @@ class MainWindow(QtWidgets.QMainWindow):
             else:
                 self.discreteToggle.setChecked(True)
 
+            #render with the image's iteration budget (images from older versions lack it, so it is chosen afresh),
+            #so the view looks as it did when saved. Later frames adapt it as usual
+            self.img = None
+            self.maxiter = settings.get("maxiter")
+            self.keepMaxiter = self.maxiter is not None
+
             self.plot()
 
         else:
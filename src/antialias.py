@@ -0,0 +1,134 @@
+from decimal import Decimal
+
+import numpy as np
+
+from . import metrics
+
+
+#Edge-adaptive anti-aliasing for exported images. Supersampling the whole image (rendering it at several times the
+#size and shrinking it) costs as many times as there are samples, but most of a typical view is made of broad flat
+#areas (the interior of the set, and the wide bands far from it) which supersampling does not change. So the image is
+#calculated once at its own resolution, the pixels whose colour differs from one of their neighbours' by more than
+#threshold (the edges: the set's boundary, its filaments and the steps between bands) are found, and only those are
+#replaced by the mean of a samples x samples grid of points spread evenly over the pixel. The samples are calculated with
+#Mandelbrot.calculate_points_async (or calculate_deep_points for deep zooms), so on the OpenCL device or the Numba
+#fallback's threads, and averaged as values (iteration counts, or the continuous values) before colouring. The
+#anti-aliased image is a float image even for discrete images.
+#The colours are compared after the display scaling, as a fraction of the scaled range of values 1 ... maxiter (the
+#colour scale of any view which includes some of the set), so differences too small to change the colour are left
+#alone whatever the iteration budget and scaling, and every band of an export finds the same edges.
+#The whole set (1000 x 1000 pixels, maxiter 256) supersamples 4-5% of its pixels (8% of the continuous image with
+#logarithmic scaling), so 16 samples per edge pixel are 1.7 times the samples of the image itself, while views full
+#of filaments such as seahorse valley supersample a fifth to a third of them. The edges are mostly the pixels next to
+#the set, which take longest to calculate, so the time grows faster than the samples: on a CPU OpenCL device the whole
+#set takes 3-5 times as long as without anti-aliasing, and seahorse valley 13-15 times (still less than the 16 times
+#of supersampling every pixel).
+
+#default samples per pixel side (16 samples per edge pixel)
+samples = 4
+
+#default difference between neighbouring pixels' scaled values, as a fraction of the scaled range 1 ... maxiter, above
+#which they are anti-aliased (one colour of matplotlib's 256 colour colourmaps)
+threshold = 1/256
+
+#the most samples calculated at once (the edge pixels are supersampled a group of rows at a time)
+chunk_samples = 16*1024*1024
+
+
+#Returns a boolean array flagging the pixels of img which, after applying scaling (see export.scale), differ from one
+#of their four neighbours by more than threshold times the scaled range of values 1 ... maxiter. In discrete images
+#(integer iteration counts) the steps of a single iteration between neighbouring bands are not edges: at the usual
+#budgets every one of them is more than a colour apart, and supersampling them would double the cost of most views
+#while only blurring the steps between bands into intermediate colours
+def edges(img,scaling,maxiter,threshold):
+    from .export import scale
+    discrete = np.issubdtype(np.asarray(img).dtype,np.integer)
+    values = img
+    with np.errstate(invalid="ignore"):
+        img = scale(np.array(img,dtype=np.float32),scaling)
+    low, high = scale(np.array([1,max(2,maxiter)],dtype=np.float32),scaling)
+    threshold *= float(high-low)
+
+    mask = np.zeros(img.shape,dtype=np.bool_)
+    with np.errstate(invalid="ignore"):
+        dx = np.abs(np.diff(img,axis=1)) > threshold
+        dy = np.abs(np.diff(img,axis=0)) > threshold
+    if discrete:
+        dx &= np.abs(np.diff(values,axis=1)) > 1
+        dy &= np.abs(np.diff(values,axis=0)) > 1
+    mask[:,:-1] |= dx
+    mask[:,1:] |= dx
+    mask[:-1,:] |= dy
+    mask[1:,:] |= dy
+    return mask
+
+
+#Starts calculating the samples x samples grid of sample points of each of the pixels (flat indices i + nx*j) in
+#index of the nx by ny image of the view (deep as in Mandelbrot.calculate_deep). The samples are the pixels of the
+#image samples times the size, so sample (a, b) of pixel (i, j) is at xmin + (i + (a+1/2)/samples)*dx. Returns a
+#Readback whose result() is the samples, pixel by pixel (see average). Deep samples are calculated before returning
+def supersample_async(mandelbrot,index,xmin,xmax,ymin,ymax,xorigin=Decimal(0),yorigin=Decimal(0),deep=False,real=False,double=False,
+                      nx=1000,ny=1000,maxiter=256,samples=samples):
+    from .buffers import Readback
+    i = index % nx
+    j = index // nx
+    a, b = np.meshgrid(np.arange(samples),np.arange(samples))
+    fine = (i[:,None]*samples + a.ravel()) + nx*samples*(j[:,None]*samples + b.ravel())
+
+    if deep:
+        return Readback(mandelbrot,img=mandelbrot.calculate_deep_points(fine.ravel(),xorigin,yorigin,xmin,xmax,ymin,ymax,real=real,
+                                                                        nx=nx*samples,ny=ny*samples,maxiter=maxiter))
+    return mandelbrot.calculate_points_async(fine.ravel(),xmin,xmax,ymin,ymax,real=real,double=double,
+                                             nx=nx*samples,ny=ny*samples,maxiter=maxiter)
+
+#returns the mean of each pixel's samples (from supersample_async) as floats
+def average(values,samples):
+    return values.reshape((-1,samples*samples)).mean(axis=1,dtype=np.float64).astype(np.float32)
+
+#Calculates the rows j0 <= j < j1 (rows=(j0, j1), by default all of them) of the nx by ny image of the view with
+#mandelbrot (a Mandelbrot object), anti-aliasing the pixels which differ from their neighbours by more than threshold
+#after scaling (see edges) with samples x samples supersampling. The arguments are as for Mandelbrot.calculate_async,
+#with deep, xorigin and yorigin as in Mandelbrot.calculate_deep. Returns the (j1-j0, nx) image as floats
+def antialias(mandelbrot,xmin,xmax,ymin,ymax,xorigin=Decimal(0),yorigin=Decimal(0),deep=False,real=False,double=False,
+              nx=1000,ny=1000,maxiter=256,rows=None,scaling="Linear",samples=samples,threshold=threshold):
+    if rows is None:
+        rows = (0, ny)
+    j0, j1 = rows
+    dy = (ymax-ymin)/ny
+
+    #calculate the rows with the rows either side of them, so the pixels along their edges are compared with all
+    #their neighbours
+    h0 = max(0,j0-1)
+    h1 = min(ny,j1+1)
+    if deep:
+        img = mandelbrot.calculate_deep(xorigin,yorigin,xmin,xmax,ymin+h0*dy,ymin+h1*dy,real=real,nx=nx,ny=h1-h0,maxiter=maxiter)
+    else:
+        img = mandelbrot.calculate_async(xmin,xmax,ymin,ymax,real=real,double=double,nx=nx,ny=ny,maxiter=maxiter,rows=(h0,h1)).result()
+    mask = edges(img,scaling,maxiter,threshold)[j0-h0:j1-h0]
+    img = np.array(img[j0-h0:j1-h0],dtype=np.float32)
+    if samples <= 1:
+        return img
+
+    metrics.counter("antialiased_pixels",int(np.count_nonzero(mask)),total=mask.size,samples=samples*samples)
+    #the chunks of rows with edges to supersample. On OpenCL devices each chunk's samples are queued before the last
+    #chunk's are collected, so calculating one overlaps copying back and averaging the other
+    step = max(1,chunk_samples//(nx*samples*samples))
+    chunks = []
+    for c0 in range(0,j1-j0,step):
+        c1 = min(j1-j0,c0+step)
+        index = np.flatnonzero(mask[c0:c1])
+        if len(index) > 0:
+            chunks.append((c0, c1, index))
+
+    def start(chunk):
+        c0, c1, index = chunk
+        mandelbrot.checkCancel()
+        return supersample_async(mandelbrot,index,xmin,xmax,ymin+(j0+c0)*dy,ymin+(j0+c1)*dy,xorigin=xorigin,yorigin=yorigin,
+                                 deep=deep,real=real,double=double,nx=nx,ny=c1-c0,maxiter=maxiter,samples=samples)
+
+    pending = None
+    for k, (c0, c1, index) in enumerate(chunks):
+        readback = pending if pending is not None else start((c0, c1, index))
+        pending = start(chunks[k+1]) if k+1 < len(chunks) and not (deep or mandelbrot.fallback) else None
+        img[c0:c1].flat[index] = average(readback.result(),samples)
+    return img
@@ -0,0 +1,138 @@
+import io
+import time
+import argparse
+import contextlib
+
+from .mandelbrot import Mandelbrot, floatfloat, precision_name, numpy_platform
+from . import checkcl
+
+
+#Auto-configuration: rather than asking which platform, device and precision to use by name (where the slow integrated
+#GPU or the Numba fallback are easily picked by mistake), times a short standard render on every OpenCL device and
+#the CPU fallbacks, and ranks them by their measured throughput in each precision:
+#  single - single precision on the devices (the CPU fallbacks always calculate in double precision)
+#  double - double precision, or float-float, on the devices (and the CPU fallbacks)
+#The ranking is the preference table saved in .pyfractalrc (see settings.save_settings). With automatic precision,
+#the GUI renders each view on the fastest backend for the precision the view needs (see view.preferred_backend), so
+#shallow views can be rendered in single precision on one device and deeper views in double precision on another.
+#  python pyFractal.py autoconfig
+#does this without the GUI, writing .pyfractalrc.
+
+#the standard render: a view with escape times from 1 to the whole budget and parts of the cardioid and of the bulbs
+#(as tuning.py's test view), its size in pixels and iteration budget
+view = (-1.6, 0.4, -1.0, 1.0)
+size = 512
+maxiter = 256
+
+#number of timed renders of each backend (the fastest is used), after one untimed render which builds the kernels
+repeats = 3
+
+#the precisions of the preference table
+precisions = ["single", "double"]
+
+
+#Returns the backends to time, as (name, platform, device, precisions), where precisions lists the precisions (the
+#double argument of the calculate functions) to time it in: every OpenCL device in single, double (if it supports
+#it) and float-float precision, the Numba fallback (if numba is installed) and the NumPy fallback
+def candidates():
+    found = []
+    for p, platform in enumerate(checkcl.GetPlatformsAndDevices()):
+        for d, device in enumerate(platform["devices"]):
+            doubles = [False, True, floatfloat] if device["double_precision"] else [False, floatfloat]
+            found.append(("%s: %s"%(platform["name"].strip(),device["name"].strip()),p,d,doubles))
+
+    try:
+        import numba
+        found.append(("Numba fallback",-1,-1,[True]))
+    except ImportError:
+        pass
+    found.append(("NumPy fallback",numpy_platform,-1,[True]))
+    return found
+
+
+#Returns the throughput (Mpixels/s) of mandelbrot rendering the standard view in the precision double
+def measure(mandelbrot,double):
+    xmin, xmax, ymin, ymax = view
+    with contextlib.redirect_stdout(io.StringIO()):
+        mandelbrot.calculate(xmin,xmax,ymin,ymax,double=double,nx=size,ny=size,maxiter=maxiter)
+        best = None
+        for r in range(repeats):
+            tstart = time.perf_counter()
+            mandelbrot.calculate(xmin,xmax,ymin,ymax,double=double,nx=size,ny=size,maxiter=maxiter)
+            t = time.perf_counter()-tstart
+            if best is None or t < best:
+                best = t
+    return size*size/best/1E6
+
+
+#Times every backend (see candidates) and returns the preference table: a dictionary with a list for each of
+#precisions of (platform, device, double, Mpixels/s) for each backend, fastest first. The CPU fallbacks calculate in
+#double precision, so they appear in both lists with the same throughput. Backends which fail are left out
+def rank():
+    preferences = {precision: [] for precision in precisions}
+    for name, platform, device, doubles in candidates():
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                mandelbrot = Mandelbrot(platform=platform,device=device)
+        except Exception as e:
+            print("Skipping %s: %s"%(name,e))
+            continue
+
+        for double in doubles:
+            print("Timing %s (%s precision)..."%(name,precision_name(double)),end="",flush=True)
+            try:
+                rate = measure(mandelbrot,double)
+            except Exception as e:
+                print(" failed: %s"%e)
+                continue
+            print(" %.1f Mpixels/s"%rate)
+
+            entry = (platform, device, double, rate)
+            if double is False or platform < 0:
+                preferences["single"].append(entry)
+            if double is not False:
+                preferences["double"].append(entry)
+
+    for precision in precisions:
+        preferences[precision].sort(key=lambda e: -e[3])
+    return preferences
+
+
+#returns a description of the preference table, one line per backend, for printing
+def describe(preferences):
+    names = {(platform, device): name for name, platform, device, doubles in candidates()}
+    lines = []
+    for precision in precisions:
+        lines.append("%s precision:"%precision.capitalize())
+        for k, (platform, device, double, rate) in enumerate(preferences[precision]):
+            lines.append("  %d. %-50s %-10s %8.1f Mpixels/s"%(k+1,names.get((platform, device),"platform %d, device %d"%(platform,device)),
+                                                             precision_name(double),rate))
+    return "\n".join(lines)
+
+
+#Times every backend and returns the settings to use: the fastest backend in single precision (for the platform and
+#device), automatic precision, and the preference table. Returns None if nothing could be timed
+def autoconfigure():
+    preferences = rank()
+    if len(preferences["single"]) == 0:
+        return None
+    print(describe(preferences))
+
+    platform, device, double, rate = preferences["single"][0]
+    return platform, device, 2, preferences
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pyFractal.py autoconfig",description="Times every backend and writes the fastest to .pyfractalrc")
+    parser.add_argument("--dry-run",action="store_true",help="only print the ranking, without writing .pyfractalrc")
+    args = parser.parse_args(argv)
+
+    from .settings import save_settings
+    config = autoconfigure()
+    if config is None:
+        print("No backend could be timed")
+        return 1
+    if not args.dry_run:
+        save_settings(*config)
+        print("Written to .pyfractalrc")
+    return 0
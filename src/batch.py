@@ -0,0 +1,216 @@
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import multiprocessing
+
+from . import pngs
+from . import view
+from .settings import add_device_arguments, device_settings
+
+
+#Headless batch rendering: python pyFractal.py render <views>
+#Renders a list of views to PNG images (with the same metadata as the GUI's Save Image, so they can be re-opened in
+#pyFractal) on a pool of worker processes, each with its own Mandelbrot object (and so its own OpenCL context).
+#Nothing here imports Qt or the matplotlib GUI, so it runs without a display.
+#
+#The views can be given as
+#  - a JSON file holding a list of views (or {"views": [...]}), each a dictionary with the keys below
+#  - a CSV file with a header row naming the keys below
+#  - PNG images written by pyFractal, or directories of them, whose views are re-rendered
+#Each view needs xmin, xmax, ymin and ymax (numbers or, for deep zooms, decimal strings). The optional keys
+#cmap, cmap_inverted, scaling, continuous, maxiter, nx, ny, antialias and output (the file name) override the command
+#line defaults
+
+#reads a boolean from a JSON value or a CSV string
+def parse_bool(s):
+    if isinstance(s,str):
+        return s.strip().lower() in ("1", "true", "yes")
+    return bool(s)
+
+#keys which may be given for each view, and the types to convert them to (from CSV strings)
+view_keys = {
+    "xmin": str,
+    "xmax": str,
+    "ymin": str,
+    "ymax": str,
+    "cmap": str,
+    "cmap_inverted": parse_bool,
+    "scaling": str,
+    "continuous": parse_bool,
+    "maxiter": int,
+    "nx": int,
+    "ny": int,
+    "antialias": int,
+    "output": str,
+}
+
+
+#returns the view dictionary described by entry (a dictionary from a JSON, CSV or PNG), keeping only the known keys
+def parse_view(entry,source):
+    for key in ("xmin", "xmax", "ymin", "ymax"):
+        if key not in entry:
+            raise ValueError("%s: view has no '%s'"%(source,key))
+
+    job = {}
+    for key, convert in view_keys.items():
+        value = entry.get(key)
+        if value is not None and value != "":
+            job[key] = convert(value)
+    job["source"] = source
+    return job
+
+
+#Reads the views from the files and directories in paths. Returns a list of view dictionaries (see parse_view)
+def read_views(paths):
+    views = []
+    for path in paths:
+        if os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                if name.lower().endswith(".png"):
+                    views += read_views([os.path.join(path,name)])
+        elif path.lower().endswith(".png"):
+            metadata = pngs.GetImageMetadata(path)
+            if metadata is None or "pyFractal" not in metadata:
+                print("Skipping %s: not a pyFractal image"%path)
+                continue
+            entry = json.loads(metadata["pyFractal"])
+            entry["output"] = os.path.basename(path)
+            views.append(parse_view(entry,path))
+        elif path.lower().endswith(".csv"):
+            with open(path,"r",newline="") as f:
+                for n, row in enumerate(csv.DictReader(f)):
+                    views.append(parse_view(row,"%s:%d"%(path,n+2)))
+        else:
+            with open(path,"r") as f:
+                entries = json.load(f)
+            if isinstance(entries,dict):
+                entries = entries["views"]
+            for n, entry in enumerate(entries):
+                views.append(parse_view(entry,"%s[%d]"%(path,n)))
+    return views
+
+
+#the Mandelbrot object of this worker process, created by init_worker
+worker_mandelbrot = None
+
+def init_worker(platform,device,nthreads):
+    global worker_mandelbrot
+    from .multidevice import create_mandelbrot
+    worker_mandelbrot = create_mandelbrot(platform,device,nthreads=nthreads)
+
+
+#Renders one view (a dictionary from read_views, completed with the defaults) in a worker process.
+#Returns the view with the time taken (or the error) added
+def render_view(job):
+    from .mandelbrot import choose_maxiter
+    from . import export
+
+    tstart = time.time()
+    try:
+        xorigin, yorigin, xmin, xmax, ymin, ymax = view.split_view(job["xmin"],job["xmax"],job["ymin"],job["ymax"],nx=job["nx"])
+        deep = view.is_deep(xmin,xmax,job["nx"])
+        double = view.use_double(job["precision"],xmin,xmax,worker_mandelbrot.double_precision,nx=job["nx"])
+        maxiter = job.get("maxiter")
+        if maxiter is None:
+            maxiter = choose_maxiter(xmax-xmin)
+
+        cmap = job["cmap"]
+        if job["cmap_inverted"]:
+            cmap += "_r"
+
+        metadata = view.image_metadata(xorigin,yorigin,xmin,xmax,ymin,ymax,
+                                       job["scaling"],job["cmap"],job["cmap_inverted"],job["continuous"],maxiter)
+
+        export.export(worker_mandelbrot,job["output"],xmin,xmax,ymin,ymax,
+                      xorigin=xorigin,yorigin=yorigin,deep=deep,
+                      real=job["continuous"],double=double,maxiter=maxiter,nx=job["nx"],ny=job["ny"],
+                      scaling=job["scaling"],cmap=cmap,antialias=job["antialias"],
+                      metadata={"Software": "pyFractal",
+                                "pyFractal": json.dumps(metadata)})
+    except Exception as e:
+        job["error"] = "%s: %s"%(type(e).__name__,e)
+    else:
+        job["maxiter"] = maxiter
+        job["deep"] = deep
+        job["double"] = double
+    job["seconds"] = time.time()-tstart
+    job["pid"] = os.getpid()
+    return job
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pyFractal.py render",description="Renders views to PNG images without the GUI")
+    parser.add_argument("views",nargs="+",help="JSON or CSV view lists, pyFractal PNGs or directories of them")
+    parser.add_argument("-o","--outdir",default="renders",help="directory to write the images to (default: renders)")
+    parser.add_argument("-j","--workers",type=int,default=1,help="number of worker processes (default: 1)")
+    parser.add_argument("--threads",type=int,help="Numba threads per worker (default: the cores divided between the workers)")
+    parser.add_argument("--nx",type=int,default=4000,help="image width in pixels (default: 4000)")
+    parser.add_argument("--ny",type=int,default=4000,help="image height in pixels (default: 4000)")
+    parser.add_argument("--cmap",default="viridis",help="matplotlib colourmap (default: viridis)")
+    parser.add_argument("--scaling",default="Linear",choices=["Linear","Logarithmic","Sqrt","Cbrt"],help="colour scaling (default: Linear)")
+    parser.add_argument("--continuous",action="store_true",help="render the continuous (smoothed) set")
+    parser.add_argument("--antialias",type=int,default=1,help="supersample the pixels along edges with this many samples per side (default: 1, no anti-aliasing)")
+    parser.add_argument("--report",help="write the per-view timings to this JSON file")
+    add_device_arguments(parser)
+    args = parser.parse_args(argv)
+
+    platform, device, precision = device_settings(args)
+
+    nthreads = args.threads
+    if nthreads is None:
+        nthreads = max(1,os.cpu_count()//max(1,args.workers))
+
+    views = read_views(args.views)
+    if len(views) == 0:
+        print("No views to render")
+        return 1
+
+    os.makedirs(args.outdir,exist_ok=True)
+    defaults = {"cmap": args.cmap, "cmap_inverted": False, "scaling": args.scaling, "continuous": args.continuous,
+                "nx": args.nx, "ny": args.ny, "antialias": args.antialias}
+    outputs = set()
+    for n, job in enumerate(views):
+        for key, value in defaults.items():
+            job.setdefault(key,value)
+        job["precision"] = precision
+
+        name = os.path.basename(job.get("output","view%05d.png"%n))
+        output = os.path.join(args.outdir,name)
+        #never overwrite the image a view was read from, or another view's image
+        if os.path.abspath(output) == os.path.abspath(job["source"]) or output in outputs:
+            output = os.path.join(args.outdir,"%s_%05d.png"%(os.path.splitext(name)[0],n))
+        outputs.add(output)
+        job["output"] = output
+
+    print("Rendering %d views on %d worker processes"%(len(views),args.workers))
+    tstart = time.time()
+    results = []
+    failed = 0
+
+    #spawn rather than fork, so each worker sets up its OpenCL context and Numba threads from scratch
+    context = multiprocessing.get_context("spawn")
+    with context.Pool(args.workers,initializer=init_worker,initargs=(platform,device,nthreads)) as pool:
+        for job in pool.imap_unordered(render_view,views):
+            results.append(job)
+            if "error" in job:
+                failed += 1
+                print("[%d/%d] %s FAILED after %.2fs: %s"%(len(results),len(views),job["source"],job["seconds"],job["error"]))
+            else:
+                print("[%d/%d] %s -> %s: %.2fs (worker %d, maxiter %d%s)"%(len(results),len(views),job["source"],job["output"],
+                      job["seconds"],job["pid"],job["maxiter"]," deep" if job["deep"] else ""))
+
+    total = time.time()-tstart
+    print("Rendered %d of %d views in %.2fs (%.2fs per view)"%(len(views)-failed,len(views),total,total/len(views)))
+
+    if args.report is not None:
+        with open(args.report,"w") as f:
+            json.dump({"total_seconds": total, "workers": args.workers, "views": results},f,indent=1)
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
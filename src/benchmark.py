@@ -0,0 +1,319 @@
+import io
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import contextlib
+import subprocess
+
+import numpy as np
+
+
+#Benchmarks every backend (the Numba fallback and each OpenCL device, in single, double and float-float precision, calculating
+#discrete and continuous images, and optionally the much slower NumPy fallback) on a fixed set of reference views at several resolutions:
+#  python pyFractal.py benchmark -o results.json
+#Each OpenCL device is first tuned for the precision (see tuning.py), or its launch configuration loaded from the
+#tuning cache, which is reported as the tuning time. Each calculation is then run once untimed (which compiles the
+#Numba kernels or builds the OpenCL program, and for some drivers such as PoCL compiles the kernel for the launch; how
+#much longer than usual it takes is reported as the compile time), then timed over several repeats. For OpenCL the kernel and copy-back times are also read from the
+#profiling events. The results are written as JSON, which can be compared against an earlier run:
+#  python pyFractal.py benchmark --compare old.json --threshold 0.1
+#reports every case more than 10% slower than before and exits with status 1 if there are any.
+#  python pyFractal.py benchmark --check
+#first checks that the NumPy fallback gives exactly the same images as the Numba fallback with the short-cuts (see
+#mandelbrot.cardioid_check) off, and with each of them on.
+
+#The reference views: (xmin, xmax, ymin, ymax, maxiter, whether the view needs double precision, which float-float
+#does not quite reach)
+views = {
+    #the whole set
+    "full": (-2.5, 1.5, -2., 2., 256, False),
+    #boundary heavy: filaments and spirals, with a wide spread of escape times
+    "seahorse": (-0.7500, -0.7400, 0.1000, 0.1100, 1024, False),
+    #interior heavy: mostly inside the main cardioid, where the short-cuts matter most
+    "cardioid": (-0.6500, 0.3500, -0.5000, 0.5000, 1024, False),
+    #a zoom beyond single precision, near the limit of double precision
+    "deep": (-0.743643887037151-5E-12, -0.743643887037151+5E-12, 0.131825904205330-5E-12, 0.131825904205330+5E-12, 4096, True),
+}
+
+#default resolutions (square images of this many pixels across)
+sizes = [256, 1024]
+
+
+#A backend to benchmark: a Mandelbrot object calculating discrete (real=False) or continuous images in the precision
+#double (False, True or mandelbrot.floatfloat)
+class Backend():
+    def __init__(self,name,device,mandelbrot,double,real):
+        self.name = name
+        self.device = device
+        self.mandelbrot = mandelbrot
+        self.double = double
+        self.real = real
+
+    #Calculates the view. Returns the image, the kernel time and the copy time in seconds (None for the Numba
+    #fallback, or if the device does not report them)
+    def run(self,xmin,xmax,ymin,ymax,nx,ny,maxiter):
+        readback = self.mandelbrot.calculate_async(xmin,xmax,ymin,ymax,real=self.real,double=self.double,nx=nx,ny=ny,maxiter=maxiter)
+        img = readback.result()
+        if readback.event is None:
+            return img, None, None
+        try:
+            kernel = event_seconds(readback.event)
+            copy = event_seconds(readback.copyevt)
+        except Exception:
+            kernel = copy = None
+        return img, kernel, copy
+
+
+#returns the time an OpenCL event took to execute, in seconds
+def event_seconds(event):
+    import pyopencl as cl
+    tstart = event.get_profiling_info(cl.profiling_info.START)
+    tstop = event.get_profiling_info(cl.profiling_info.END)
+    return (tstop-tstart)/1E9
+
+
+#Returns the backends to benchmark: the Numba fallback (if numba is in kinds and Numba is installed), the NumPy
+#fallback (if numpy is, in double precision only, as it has no float-float kernels) and every OpenCL device (if opencl is)
+def backends(kinds=("numba", "opencl"),nthreads=None):
+    from .mandelbrot import Mandelbrot, floatfloat, precision_name, numpy_platform
+    from . import checkcl
+
+    found = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        if "numba" in kinds:
+            m = Mandelbrot(platform=-1,nthreads=nthreads)
+            if m.backend == "numba":
+                for double in (True, floatfloat):
+                    for real in (False, True):
+                        found.append(Backend("numba/%s/%s"%(precision_name(double),"real" if real else "int"),"Numba (%d threads)"%m.nthreads,m,double,real))
+
+        if "numpy" in kinds:
+            m = Mandelbrot(platform=numpy_platform,nthreads=nthreads)
+            for real in (False, True):
+                found.append(Backend("numpy/double/%s"%("real" if real else "int"),"NumPy (%d threads)"%m.nthreads,m,True,real))
+
+        if "opencl" in kinds:
+            platforms = checkcl.GetPlatformsAndDevices()
+            for p, d in checkcl.GetDeviceList():
+                name = "%s: %s"%(platforms[p]["name"],platforms[p]["devices"][d]["name"])
+                m = Mandelbrot(platform=p,device=d)
+                precisions = [False, True, floatfloat] if m.double_precision else [False, floatfloat]
+                for double in precisions:
+                    for real in (False, True):
+                        found.append(Backend("opencl%d.%d/%s/%s"%(p,d,precision_name(double),"real" if real else "int"),name,m,double,real))
+    return found
+
+
+#returns the number of iterations the view takes (every pixel's escape count, with points in the set counting the
+#whole budget, whether or not the short-cuts spared them), calculated with mandelbrot
+def count_iterations(mandelbrot,xmin,xmax,ymin,ymax,nx,ny,maxiter):
+    with contextlib.redirect_stdout(io.StringIO()):
+        img = mandelbrot.calculate(xmin,xmax,ymin,ymax,double=mandelbrot.double_precision,nx=nx,ny=ny,maxiter=maxiter)
+    return int(np.minimum(img,maxiter).sum(dtype=np.int64))
+
+
+#Benchmarks backend on the view name at nx by ny pixels, repeating the timed calculation repeats times.
+#iterations is the number of iterations the view takes (see count_iterations). Returns the result dictionary
+def benchmark(backend,name,nx,ny,repeats,iterations):
+    xmin, xmax, ymin, ymax, maxiter, double = views[name]
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        #tune the launch configuration first, so the tuning's test renders are not counted as compile time
+        tune = None
+        if backend.mandelbrot.backend.startswith("opencl"):
+            tstart = time.perf_counter()
+            backend.mandelbrot.launchConfig(backend.double)
+            tune = time.perf_counter()-tstart
+
+        #the first run compiles the kernels for this iteration budget (if they have not been already)
+        tstart = time.perf_counter()
+        backend.run(xmin,xmax,ymin,ymax,nx,ny,maxiter)
+        first = time.perf_counter()-tstart
+
+        times = []
+        kernels = []
+        copies = []
+        for r in range(repeats):
+            tstart = time.perf_counter()
+            img, kernel, copy = backend.run(xmin,xmax,ymin,ymax,nx,ny,maxiter)
+            times.append(time.perf_counter()-tstart)
+            kernels.append(kernel)
+            copies.append(copy)
+
+    best = min(times)
+    result = {
+        "backend": backend.name,
+        "device": backend.device,
+        "view": name,
+        "bounds": [xmin, xmax, ymin, ymax],
+        "nx": nx,
+        "ny": ny,
+        "maxiter": maxiter,
+        "seconds": best,
+        "median_seconds": float(np.median(times)),
+        "compile_seconds": max(0.,first-float(np.median(times))),
+        "tune_seconds": tune,
+        "kernel_seconds": None,
+        "transfer_seconds": None,
+        "mpixels_per_second": nx*ny/best/1E6,
+        "iterations": iterations,
+        "giterations_per_second": iterations/best/1E9,
+    }
+    if all(k is not None for k in kernels):
+        result["kernel_seconds"] = min(kernels)
+    if all(c is not None for c in copies):
+        result["transfer_seconds"] = min(copies)
+    return result
+
+
+#Checks the NumPy fallback against the Numba fallback: calculates each of the views names at size by size pixels,
+#discrete and continuous, with each combination of short-cuts in shortcuts. Returns the cases which differ, as
+#(view, real, shortcuts, number of pixels which differ), or None if Numba is not installed
+def check(names,size,shortcuts=(0, 1, 3)):
+    from .mandelbrot import Mandelbrot, numpy_platform
+    mismatches = []
+    with contextlib.redirect_stdout(io.StringIO()):
+        for opts in shortcuts:
+            numba = Mandelbrot(platform=-1,shortcuts=opts)
+            if numba.backend != "numba":
+                return None
+            numpy = Mandelbrot(platform=numpy_platform,shortcuts=opts)
+            for name in names:
+                xmin, xmax, ymin, ymax, maxiter, double = views[name]
+                for real in (False, True):
+                    calculate = "calculate_real" if real else "calculate"
+                    expected = getattr(numba,calculate)(xmin,xmax,ymin,ymax,double=True,nx=size,ny=size,maxiter=maxiter)
+                    img = getattr(numpy,calculate)(xmin,xmax,ymin,ymax,double=True,nx=size,ny=size,maxiter=maxiter)
+                    if not np.array_equal(img,expected,equal_nan=True):
+                        differ = ~((img == expected) | (np.isnan(img) & np.isnan(expected)))
+                        mismatches.append((name, real, opts, int(differ.sum())))
+    return mismatches
+
+
+#returns the key identifying a benchmark case, to match up cases between runs (cases of a reference view which has
+#since changed are not matched)
+def case(result):
+    return (result["backend"], result["device"], result["view"], tuple(result["bounds"]), result["maxiter"], result["nx"], result["ny"])
+
+
+#Compares results against baseline (lists of result dictionaries) and prints the change in the time of each case
+#present in both. Returns the cases more than threshold (a fraction) slower than in the baseline
+def compare(results,baseline,threshold):
+    old = {case(r): r for r in baseline}
+    regressions = []
+    print("%-28s %-10s %6s %10s %10s %8s"%("backend","view","size","before/ms","after/ms","change"))
+    for r in results:
+        b = old.get(case(r))
+        if b is None:
+            continue
+        change = r["seconds"]/b["seconds"]-1
+        flag = ""
+        if change > threshold:
+            flag = "  REGRESSION"
+            regressions.append(r)
+        print("%-28s %-10s %6d %10.2f %10.2f %+7.1f%%%s"%(r["backend"],r["view"],r["nx"],1E3*b["seconds"],1E3*r["seconds"],100*change,flag))
+    return regressions
+
+
+#describes the machine and software the benchmark was run with
+def environment():
+    env = {
+        "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "machine": platform.platform(),
+        "processor": platform.processor(),
+        "cpus": os.cpu_count(),
+        "numpy": np.__version__,
+    }
+    for module in ("numba", "pyopencl"):
+        try:
+            env[module] = __import__(module).__version__
+        except ImportError:
+            env[module] = None
+    try:
+        env["commit"] = subprocess.run(["git","rev-parse","HEAD"],cwd=os.path.dirname(os.path.abspath(__file__)),
+                                       capture_output=True,text=True,check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        env["commit"] = None
+    return env
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pyFractal.py benchmark",description="Benchmarks the calculation backends on reference views")
+    parser.add_argument("-o","--output",help="write the results to this JSON file")
+    parser.add_argument("--compare",metavar="BASELINE",help="compare against the results in this JSON file")
+    parser.add_argument("--threshold",type=float,default=0.1,help="slowdown (a fraction) counted as a regression by --compare (default: 0.1)")
+    parser.add_argument("--views",nargs="+",choices=list(views),default=list(views),help="reference views to run (default: all)")
+    parser.add_argument("--sizes",nargs="+",type=int,default=sizes,help="image sizes in pixels (default: %s)"%" ".join(str(s) for s in sizes))
+    parser.add_argument("--backends",nargs="+",choices=["numba","numpy","opencl"],default=["numba","opencl"],help="backends to run (default: numba and opencl)")
+    parser.add_argument("--only",help="only run backends whose name contains this (e.g. opencl0.0/float)")
+    parser.add_argument("--repeats",type=int,default=3,help="timed runs of each case (default: 3)")
+    parser.add_argument("--threads",type=int,help="Numba (or NumPy) threads (default: all the cores)")
+    parser.add_argument("--check",action="store_true",help="first check the NumPy fallback gives the same images as the Numba fallback")
+    args = parser.parse_args(argv)
+
+    if args.check:
+        size = min(args.sizes)
+        print("Checking the NumPy fallback against the Numba fallback (%d x %d pixels)..."%(size,size))
+        mismatches = check(args.views,size)
+        if mismatches is None:
+            print("Numba is not installed: skipping the check")
+        elif len(mismatches) > 0:
+            for name, real, opts, count in mismatches:
+                print("%s (%s, short-cuts %d): %d pixels differ"%(name,"continuous" if real else "discrete",opts,count))
+            return 1
+        else:
+            print("Identical")
+        print()
+
+    found = backends(args.backends,args.threads)
+    if args.only is not None:
+        found = [b for b in found if args.only in b.name]
+    if len(found) == 0:
+        print("No backends to benchmark")
+        return 1
+    for b in found:
+        print("%-28s %s"%(b.name,b.device))
+    print()
+
+    iterations = {}
+    results = []
+    print("%-28s %-10s %6s %9s %9s %9s %9s %9s %9s %9s"%("backend","view","size","ms","tune","compile","kernel","copy","Mpix/s","Giter/s"))
+    for name in args.views:
+        for n in args.sizes:
+            for b in found:
+                double = views[name][5]
+                if double and b.double is not True:
+                    continue
+                if (name, n) not in iterations:
+                    xmin, xmax, ymin, ymax, maxiter, _ = views[name]
+                    iterations[(name, n)] = count_iterations(b.mandelbrot,xmin,xmax,ymin,ymax,n,n,maxiter)
+
+                r = benchmark(b,name,n,n,args.repeats,iterations[(name, n)])
+                results.append(r)
+                ms = lambda s: "%9.2f"%(1E3*s) if s is not None else "%9s"%"-"
+                print("%-28s %-10s %6d %s %s %s %s %s %9.1f %9.2f"%(b.name,name,n,ms(r["seconds"]),ms(r["tune_seconds"]),ms(r["compile_seconds"]),
+                      ms(r["kernel_seconds"]),ms(r["transfer_seconds"]),r["mpixels_per_second"],r["giterations_per_second"]))
+
+    if args.output is not None:
+        with open(args.output,"w") as f:
+            json.dump({"environment": environment(), "results": results},f,indent=1)
+        print("Wrote %s"%args.output)
+
+    if args.compare is not None:
+        with open(args.compare,"r") as f:
+            baseline = json.load(f)["results"]
+        print()
+        regressions = compare(results,baseline,args.threshold)
+        if len(regressions) > 0:
+            print("%d cases are more than %.0f%% slower than %s"%(len(regressions),100*args.threshold,args.compare))
+            return 1
+        print("No regressions against %s"%args.compare)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+import time
+import collections
+
+import numpy as np
+
+from . import metrics
+
+
+#Reusable OpenCL buffers for the image kernels, so interactive rendering does not allocate a device buffer and a
+#host array every frame. Each slot holds a device buffer for the image, a page-locked (pinned) host buffer it is
+#read back into (which the driver can DMA into directly, unlike ordinary numpy memory), and a small buffer for the
+#short-cut counts. Slots are keyed by their size in bytes, so each image resolution gets its own slots.
+
+#number of image sizes free slots are kept for. Slots of the least recently used size are freed beyond this
+maxsizes = 8
+
+
+class Slot():
+    def __init__(self,context,queue,nbytes):
+        import pyopencl as cl
+        self.nbytes = nbytes
+        self.device = cl.Buffer(context,cl.mem_flags.WRITE_ONLY,nbytes)
+
+        #allocate the host buffer with ALLOC_HOST_PTR and map it once, so it stays pinned for the slot's lifetime
+        self.pinned = cl.Buffer(context,cl.mem_flags.READ_WRITE|cl.mem_flags.ALLOC_HOST_PTR,nbytes)
+        self.host, evt = cl.enqueue_map_buffer(queue,self.pinned,cl.map_flags.READ|cl.map_flags.WRITE,0,(nbytes,),np.uint8)
+        evt.wait()
+
+        self.stats = np.zeros(2,np.int32)
+        self.statsBuf = cl.Buffer(context,cl.mem_flags.READ_WRITE,self.stats.nbytes)
+
+
+class BufferPool():
+    def __init__(self,context,queue):
+        self.context = context
+        self.queue = queue
+
+        #nbytes -> list of free slots, ordered from least to most recently used size
+        self.free = collections.OrderedDict()
+
+    #returns a free slot with nbytes bytes of image buffer, creating one if there are none
+    def acquire(self,nbytes):
+        slots = self.free.get(nbytes)
+        if slots:
+            self.free.move_to_end(nbytes)
+            return slots.pop()
+        return Slot(self.context,self.queue,nbytes)
+
+    #returns a slot to the pool once the image has been copied out of it
+    def release(self,slot):
+        self.free.setdefault(slot.nbytes,[]).append(slot)
+        self.free.move_to_end(slot.nbytes)
+        while len(self.free) > maxsizes:
+            self.free.popitem(last=False)
+
+    def clear(self):
+        self.free.clear()
+
+
+#The result of an image calculation, which may still be running on the device. result() waits for the image
+#(and its short-cut counts) to be read back and returns it. Readbacks for already calculated images (the Numba
+#fallback and boundary subdivision) are made with just the image. report is False for kernels with no short-cut counts.
+#stage is the stage (see metrics.py) the kernel is timed as, and fields describe the calculation for the metrics
+class Readback():
+    def __init__(self,mandelbrot,img=None,slot=None,event=None,copyevt=None,shape=None,dtype=None,report=True,stage="kernel",fields=None):
+        self.mandelbrot = mandelbrot
+        self.img = img
+        self.slot = slot
+        self.event = event
+        self.copyevt = copyevt
+        self.shape = shape
+        self.dtype = dtype
+        self.report = report
+        self.stage = stage
+        self.fields = fields
+        self.tstart = time.perf_counter()
+
+    #True once the image has been read back
+    def done(self):
+        if self.img is not None:
+            return True
+        import pyopencl as cl
+        return self.copyevt.command_execution_status == cl.command_execution_status.COMPLETE
+
+    def result(self):
+        if self.img is not None:
+            return self.img
+
+        self.copyevt.wait()
+        npixels = int(np.prod(self.shape))
+        self.img = self.slot.host.view(self.dtype)[:npixels].reshape(self.shape).copy()
+        if self.report:
+            self.mandelbrot.report(npixels,self.slot.stats)
+        if metrics.active:
+            self.record()
+        self.mandelbrot.pool.release(self.slot)
+        self.slot = None
+
+        return self.img
+
+    #Records the time the kernel waited in the queue, ran for, and took to copy back (from the profiling events, moved
+    #onto the host's clock by taking the kernel to have been queued when this Readback was made), and the counters
+    def record(self):
+        import pyopencl as cl
+        fields = self.fields or {}
+        try:
+            queued = self.event.get_profiling_info(cl.profiling_info.QUEUED)
+            start = self.event.get_profiling_info(cl.profiling_info.START)
+            end = self.event.get_profiling_info(cl.profiling_info.END)
+            copystart = self.copyevt.get_profiling_info(cl.profiling_info.START)
+            copyend = self.copyevt.get_profiling_info(cl.profiling_info.END)
+        except cl.Error:
+            return
+        host = lambda t: self.tstart + (t-queued)/1E9
+        track = fields.get("backend","device")
+        metrics.record("queue",host(queued),(start-queued)/1E9,track=track,**fields)
+        metrics.record(self.stage,host(start),(end-start)/1E9,track=track,**fields)
+        metrics.record("copy",host(copystart),(copyend-copystart)/1E9,track=track+" copy",**fields)
+        if self.report:
+            metrics.count(self.img.size,metrics.iterations(self.img,fields.get("maxiter",0)),time.perf_counter()-self.tstart,
+                          cardioid=int(self.slot.stats[0]),periodic=int(self.slot.stats[1]),**fields)
@@ -1,9 +1,9 @@
-import pyopencl as cl
-
-#Returns the list of platforms and associated devices. If none are available, returns an empty list
+#Returns the list of platforms and associated devices. If none are available (or pyopencl is not installed), returns
+#an empty list
 def GetPlatformsAndDevices():
 
     try:
+        import pyopencl as cl
         platforms = cl.get_platforms()
     except:
         return []
@@ -36,5 +36,14 @@ def GetPlatformsAndDevices():
     
     return p
 
+#Returns the (platform, device) index pairs of every device on the given platform, or of every device on every
+#platform if platform is None. If none are available, returns an empty list
+def GetDeviceList(platform=None):
+    pairs = []
+    for p, d in enumerate(GetPlatformsAndDevices()):
+        if platform is None or p == platform:
+            pairs += [(p, n) for n in range(len(d["devices"]))]
+    return pairs
+
 if __name__ == "__main__":
     print(GetPlatformsAndDevices())
\ No newline at end of file
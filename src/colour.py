@@ -0,0 +1,112 @@
+import numpy as np
+import matplotlib
+
+from .export import scale
+from . import metrics
+
+
+#Turns calculated images into the RGBA images displayed by the GUI. Changing the colourmap or the scaling of the
+#displayed image should not redo any work that does not depend on what changed, so:
+#  - for each scaling, the scaled image is calculated once per image and quantised to lut_size levels spanning its
+#    range (as imshow's automatic limits would), giving an index image
+#  - for each colourmap, a lookup table of the RGBA colour of every level is calculated once
+#so a change of colourmap (or of scaling, once that scaling has been seen) is a single table lookup per pixel.
+#Images much larger than the screen (e.g. 4000 x 4000) are also averaged down in blocks of pixels to no smaller than
+#the screen, as matplotlib would otherwise resample every pixel of them each time the canvas is drawn.
+
+#number of levels the scaled images are quantised to (matplotlib's colourmaps have 256 colours, so this is plenty)
+lut_size = 4096
+
+
+#returns the mean of the finite values in each stride x stride block of img (NaN for blocks with none). Blocks at
+#the right and top edges may be partly outside the image
+def reduce(img,stride):
+    ny, nx = img.shape
+    my = (ny+stride-1)//stride
+    mx = (nx+stride-1)//stride
+    padded = np.full((my*stride,mx*stride),np.nan,dtype=np.float32)
+    padded[:ny,:nx] = img
+
+    finite = np.isfinite(padded)
+    padded[~finite] = 0.
+    sums = padded.reshape(my,stride,mx,stride).sum(axis=(1,3))
+    counts = finite.reshape(my,stride,mx,stride).sum(axis=(1,3))
+    with np.errstate(invalid="ignore"):
+        return sums/counts
+
+
+#returns the index image of img after scaling (and averaging over stride x stride blocks, see reduce): the scaled
+#values quantised to 0 ... lut_size-1 across their finite range, with lut_size marking pixels with no finite value
+#(e.g. log(0))
+def quantise(img,scaling,stride=1):
+    scaled = scale(np.array(img,dtype=np.float32),scaling)
+    finite = np.isfinite(scaled)
+    values = scaled[finite]
+    if len(values) > 0:
+        vmin = values.min()
+        vmax = values.max()
+    else:
+        vmin, vmax = 0., 1.
+    if not vmax > vmin:
+        vmax = vmin + 1
+
+    if stride > 1:
+        scaled = reduce(scaled,stride)
+        finite = np.isfinite(scaled)
+
+    scaled -= vmin
+    scaled *= (lut_size-1)/(vmax-vmin)
+    scaled += 0.5
+    index = np.empty(scaled.shape,dtype=np.uint16)
+    np.clip(scaled,0,lut_size-1,out=scaled)
+    np.copyto(index,scaled,casting="unsafe")
+    index[~finite] = lut_size
+    return index
+
+
+#returns the lookup table of colourmap cmap: the RGBA colours (packed into uint32s) of the lut_size levels, followed
+#by the colourmap's colour for bad values
+def lookup_table(cmap):
+    colourmap = matplotlib.colormaps[cmap]
+    rgba = np.empty((lut_size+1,4),dtype=np.uint8)
+    rgba[:lut_size] = colourmap(np.linspace(0.,1.,lut_size),bytes=True)
+    rgba[lut_size] = colourmap(np.nan,bytes=True)
+    return rgba.view(np.uint32)[:,0]
+
+
+class ColourPipeline():
+    def __init__(self):
+        #the image the index images are for, and its index image for each scaling and stride
+        self.img = None
+        self.indices = {}
+
+        #lookup table for each colourmap
+        self.luts = {}
+
+    #returns the index image of img for scaling and stride, calculating it only if it is not cached
+    def index(self,img,scaling,stride=1):
+        if img is not self.img:
+            self.img = img
+            self.indices = {}
+        if (scaling, stride) not in self.indices:
+            with metrics.timer("scale"):
+                self.indices[(scaling, stride)] = quantise(img,scaling,stride)
+        return self.indices[(scaling, stride)]
+
+    #returns the lookup table for cmap, calculating it only if it is not cached
+    def lut(self,cmap):
+        if cmap not in self.luts:
+            self.luts[cmap] = lookup_table(cmap)
+        return self.luts[cmap]
+
+    #Returns img, scaled with scaling and coloured with the colourmap cmap, as an RGBA image (of uint8s). If the
+    #size (width, height) in pixels it is displayed at is given, images at least twice as large are averaged down
+    #to no smaller than it, otherwise the image is full size (ny x nx x 4)
+    def colour(self,img,scaling,cmap,size=None):
+        stride = 1
+        if size is not None:
+            stride = max(1,int(min(img.shape[1]/max(1,size[0]),img.shape[0]/max(1,size[1]))))
+        index = self.index(img,scaling,stride)
+        with metrics.timer("colour"):
+            rgba = self.lut(cmap)[index]
+        return rgba.view(np.uint8).reshape(index.shape+(4,))
@@ -0,0 +1,230 @@
+import os
+import json
+import time
+from decimal import Decimal
+
+import numpy as np
+import matplotlib
+
+from . import pngs
+from . import metrics
+from .buffers import Readback
+
+
+#Exports images far larger than memory (32k x 32k posters and beyond) with bounded memory use.
+#The image is calculated in bands of whole rows, which are written to a memory-mapped scratch file next to the
+#output. Once all the bands are done, each band is read back, scaled and coloured on its own, and its rows
+#streamed into the PNG encoder. After every band the scratch file is flushed and a checkpoint recording the finished
+#bands is written, so an interrupted export started again with the same settings carries on where it stopped.
+#The range of each band's values is recorded as it is calculated, so the colour scale is known without another pass
+#over the image, and the colouring itself (scaling, normalising and colourmap lookup, straight to the RGBA bytes the
+#PNG needs) runs on the OpenCL device, colouring the next band while the PNG encoder compresses this one.
+#With antialias > 1, each band is anti-aliased (see antialias.py) by supersampling the pixels along edges.
+
+#the number of pixels calculated at once (64 MB of int32/float32 values)
+band_pixels = 16*1024*1024
+
+
+#the display scalings, in the order of the SCALE_... constants of the colour kernels in mandelbrot.cl
+scalings = ["Linear", "Logarithmic", "Sqrt", "Cbrt"]
+
+
+def scratch_name(filename):
+    return filename + ".scratch.npy"
+
+def checkpoint_name(filename):
+    return filename + ".checkpoint.json"
+
+
+#applies the display scaling (as chosen in the GUI) to img in place. img must be a float array
+def scale(img,scaling):
+    if scaling == "Linear":
+        pass
+    elif scaling == "Logarithmic":
+        with np.errstate(divide="ignore"):
+            np.log(img,out=img)
+    elif scaling == "Sqrt":
+        np.sqrt(img,out=img)
+    elif scaling == "Cbrt":
+        np.cbrt(img,out=img)
+    else:
+        raise ValueError("Unknown scaling '%s'"%scaling)
+    return img
+
+
+#Returns the range of the values of img (a band of the image) which each scaling can be applied to: the smallest
+#finite value, the smallest value >= 0 (for Sqrt), the smallest value > 0 (for Logarithmic) and the largest finite
+#value. Each is None if there is no such value
+def value_range(img):
+    #usually every value is finite and positive, which plain min and max show
+    lowest = img.min().item()
+    highest = img.max().item()
+    if np.isfinite(lowest) and np.isfinite(highest) and lowest > 0:
+        return [lowest, lowest, lowest, highest]
+
+    img = np.asarray(img,dtype=np.float64) if img.dtype.kind != "f" else img
+    finite = np.isfinite(img)
+    ranges = [img.min(where=finite,initial=np.inf),
+              img.min(where=finite&(img >= 0),initial=np.inf),
+              img.min(where=finite&(img > 0),initial=np.inf),
+              img.max(where=finite,initial=-np.inf)]
+    return [float(r) if np.isfinite(r) else None for r in ranges]
+
+#Returns the limits vmin, vmax of the colour scale after scaling (see scale): the range of the finite scaled values
+#of the whole image (as in matplotlib's imsave), from the value_range of each band. As the scalings are all increasing,
+#this is just the scaled smallest and largest values they can be applied to
+def colour_limits(ranges,scaling):
+    lowest = {"Linear": 0, "Cbrt": 0, "Sqrt": 1, "Logarithmic": 2}[scaling]
+    lows = [r[lowest] for r in ranges if r[lowest] is not None]
+    highs = [r[3] for r in ranges if r[3] is not None]
+    if len(lows) == 0 or len(highs) == 0 or max(highs) < min(lows):
+        return np.float32(0.), np.float32(1.)
+
+    vmin, vmax = scale(np.array([min(lows),max(highs)],dtype=np.float32),scaling)
+    if not vmax > vmin:
+        vmax = vmin + 1
+    return vmin, vmax
+
+#returns the colours of the matplotlib colourmap cmap as packed RGBA8 values (uint32s)
+def colour_table(cmap):
+    colourmap = matplotlib.colormaps[cmap]
+    rgba = colourmap(np.arange(colourmap.N),bytes=True)
+    return np.ascontiguousarray(rgba).view(np.uint32)[:,0]
+
+#Colours img on the host as the colour kernels in mandelbrot.cl do (see Mandelbrot.colour_async), for the Numba fallback
+def colour_rows(img,scaling,vmin,vmax,table):
+    x = scale(np.array(img[::-1],dtype=np.float32),scaling)
+    x -= vmin
+    x /= (vmax-vmin)
+    x *= len(table)
+    with np.errstate(invalid="ignore"):
+        index = np.where(x >= len(table),len(table)-1,np.where(x >= 0,x,0)).astype(np.intp)
+    return table[index]
+
+
+#returns the checkpoint of a previous export of filename with the same settings, or None if there is none
+def load_checkpoint(filename,settings):
+    try:
+        with open(checkpoint_name(filename),"r") as f:
+            checkpoint = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if checkpoint.get("settings") != settings or not os.path.exists(scratch_name(filename)):
+        return None
+    return checkpoint
+
+#writes the checkpoint, replacing the old one in one step so an interruption never leaves a partial file
+def save_checkpoint(filename,checkpoint):
+    fname = checkpoint_name(filename)
+    with open(fname+".tmp","w") as f:
+        json.dump(checkpoint,f)
+    os.replace(fname+".tmp",fname)
+
+
+#Calculates the nx by ny image of the view with mandelbrot (a Mandelbrot object) and writes it to the PNG filename,
+#coloured with the matplotlib colourmap cmap after applying scaling (see scale). For deep zooms (deep=True) the view
+#is xorigin + (xmin ... xmax), yorigin + (ymin ... ymax) as in Mandelbrot.calculate_deep, otherwise it is
+#xmin ... xmax, ymin ... ymax. metadata is a dictionary of keys and values written to the PNG's tEXt chunks.
+#rows is the number of rows calculated at once (by default enough for band_pixels pixels). If antialias is more than
+#1, pixels whose colour differs from their neighbours' by more than threshold (see antialias.edges) are supersampled
+#with antialias x antialias samples
+def export(mandelbrot,filename,xmin,xmax,ymin,ymax,xorigin=Decimal(0),yorigin=Decimal(0),deep=False,real=False,double=False,
+           maxiter=256,nx=4000,ny=4000,scaling="Linear",cmap="viridis",metadata={},rows=None,antialias=1,threshold=None):
+    from . import antialias as aa
+    if threshold is None:
+        threshold = aa.threshold
+    if rows is None:
+        rows = max(1,band_pixels//nx)
+    nbands = (ny+rows-1)//rows
+
+    if real or antialias > 1:
+        dtype = np.float32
+    else:
+        dtype = np.int32
+
+    #everything that changes the calculated values, so a checkpoint is only resumed with the same settings
+    settings = {
+        "view": [repr(xmin), repr(xmax), repr(ymin), repr(ymax), str(xorigin), str(yorigin)],
+        "deep": deep,
+        "real": real,
+        "double": double,
+        "maxiter": maxiter,
+        "shape": [ny, nx],
+        "rows": rows,
+        "fallback": mandelbrot.fallback,
+    }
+    if antialias > 1:
+        settings["antialias"] = [antialias, threshold, scaling]
+
+    checkpoint = load_checkpoint(filename,settings)
+    if checkpoint is None:
+        checkpoint = {"settings": settings, "done": [], "ranges": [None]*nbands}
+        scratch = np.lib.format.open_memmap(scratch_name(filename),mode="w+",dtype=dtype,shape=(ny,nx))
+    else:
+        print("Resuming export of '%s' (%d of %d bands already done)"%(filename,len(checkpoint["done"]),nbands))
+        scratch = np.load(scratch_name(filename),mmap_mode="r+")
+
+    dy = (ymax-ymin)/ny
+    done = set(checkpoint["done"])
+    ranges = checkpoint.setdefault("ranges",[None]*nbands)
+    todo = [band for band in range(nbands) if band not in done]
+
+    #Starts calculating band. Bands calculated on OpenCL devices are returned while still running, and the next band
+    #(in its own buffers) is queued before this one is collected, so the device calculates it while this one is copied
+    #back and written out. The CPU fallbacks, anti-aliased and deep bands are calculated here, so they are not started
+    #early (the checkpoint of each band is then written before the next is calculated)
+    def start(band):
+        j0 = band*rows
+        j1 = min(ny,j0+rows)
+        if antialias > 1:
+            return Readback(mandelbrot,img=aa.antialias(mandelbrot,xmin,xmax,ymin,ymax,xorigin=xorigin,yorigin=yorigin,deep=deep,real=real,
+                                                        double=double,nx=nx,ny=ny,maxiter=maxiter,rows=(j0,j1),scaling=scaling,
+                                                        samples=antialias,threshold=threshold))
+        elif deep:
+            return Readback(mandelbrot,img=mandelbrot.calculate_deep(xorigin,yorigin,xmin,xmax,ymin+j0*dy,ymin+j1*dy,real=real,nx=nx,ny=j1-j0,maxiter=maxiter))
+        return mandelbrot.calculate_async(xmin,xmax,ymin,ymax,real=real,double=double,nx=nx,ny=ny,maxiter=maxiter,rows=(j0,j1))
+    overlap = not (antialias > 1 or deep or mandelbrot.fallback or mandelbrot.subdivide)
+
+    tstart = time.time()
+    pending = None
+    for k, band in enumerate(todo):
+        j0 = band*rows
+        j1 = min(ny,j0+rows)
+
+        readback = pending if pending is not None else start(band)
+        pending = start(todo[k+1]) if overlap and k+1 < len(todo) else None
+        img = readback.result()
+        scratch[j0:j1] = img
+        scratch.flush()
+
+        ranges[band] = value_range(img)
+        checkpoint["done"].append(band)
+        save_checkpoint(filename,checkpoint)
+        print("Calculated band %d of %d (%.1fs)"%(len(checkpoint["done"]),nbands,time.time()-tstart))
+
+    #the colour scale spans the range of the scaled values (checkpoints from before the ranges were recorded lack them)
+    for band in range(nbands):
+        if ranges[band] is None:
+            ranges[band] = value_range(np.asarray(scratch[band*rows:(band+1)*rows]))
+    vmin, vmax = colour_limits(ranges,scaling)
+    table = colour_table(cmap)
+
+    #the image is displayed with its origin at the bottom, and PNGs are written from the top down. Each band is
+    #queued for colouring before the one before it is encoded
+    print("Writing '%s'..."%filename,end="",flush=True)
+    bands = [(max(0,j1-rows), j1) for j1 in range(ny,0,-rows)]
+    with pngs.PNGWriter(filename,nx,ny,metadata) as png:
+        pending = mandelbrot.colour_async(scratch[bands[0][0]:bands[0][1]],scaling,vmin,vmax,table)
+        for k, (j0, j1) in enumerate(bands):
+            readback = pending
+            if k+1 < len(bands):
+                pending = mandelbrot.colour_async(scratch[bands[k+1][0]:bands[k+1][1]],scaling,vmin,vmax,table)
+            rgba = readback.result().view(np.uint8).reshape((j1-j0,nx,4))
+            with metrics.timer("encode"):
+                png.writeRows(rgba)
+    print(" Done!")
+
+    del scratch
+    os.remove(scratch_name(filename))
+    os.remove(checkpoint_name(filename))
@@ -0,0 +1,510 @@
+import collections
+
+import numba
+import numba.extending
+import numpy as np
+
+from .mandelbrot import maxiter, cardioid_check, periodicity_check, glitch_tolerance
+
+
+#The Numba kernels of the fallback (used when OpenCL is not). They are kept apart from mandelbrot.py so that numba is
+#only imported once they are needed. The compiled kernels are cached on disk (cache=True), so they are only compiled
+#the first time each one is used with each iteration budget, rather than every time pyFractal is started.
+#Numba keys the cache of a kernel made by numba_kernels on its closure variables, and a jitted function (a dispatcher)
+#is given a random identity in each process, so a cached kernel must not refer to one: the functions the kernels
+#call (in_cardioid and iterate) are register_jitable functions, compiled into each kernel, instead.
+
+#Returns True if the point lies inside the main cardioid or the period-2 bulb (and so is in the set)
+@numba.extending.register_jitable
+def in_cardioid(x0, y0):
+    y2 = y0*y0
+
+    xq = x0 - 0.25
+    q = xq*xq + y2
+    if q*(q + xq) < 0.25*y2:
+        return True
+
+    xb = x0 + 1.
+    if xb*xb + y2 < 0.0625:
+        return True
+
+    return False
+
+
+#Float-float arithmetic (see mandelbrot.cl), for the float-float kernels. A float-float is passed as its high and low
+#parts (float32s), and the arithmetic is done on float32s so it gives exactly what the OpenCL kernels do. The exact
+#error of a product of floats is found in double precision (where the product is exact) rather than with fma
+half = np.float32(0.5)
+quarter = np.float32(0.25)
+sixteenth = np.float32(0.0625)
+one = np.float32(1.)
+zero = np.float32(0.)
+
+#returns a + b exactly as a float-float
+@numba.extending.register_jitable
+def two_sum(a, b):
+    s = a + b
+    bb = s - a
+    return s, (a - (s - bb)) + (b - bb)
+
+#returns a + b exactly as a float-float, if |a| >= |b|
+@numba.extending.register_jitable
+def quick_two_sum(a, b):
+    s = a + b
+    return s, b - (s - a)
+
+#returns a*b exactly as a float-float
+@numba.extending.register_jitable
+def two_prod(a, b):
+    p = np.float64(a)*np.float64(b)
+    hi = np.float32(p)
+    return hi, np.float32(p - np.float64(hi))
+
+@numba.extending.register_jitable
+def ff_add(ahi, alo, bhi, blo):
+    shi, slo = two_sum(ahi, bhi)
+    thi, tlo = two_sum(alo, blo)
+    shi, slo = quick_two_sum(shi, slo + thi)
+    return quick_two_sum(shi, slo + tlo)
+
+@numba.extending.register_jitable
+def ff_mul(ahi, alo, bhi, blo):
+    phi, plo = two_prod(ahi, bhi)
+    return quick_two_sum(phi, plo + (ahi*blo + alo*bhi))
+
+@numba.extending.register_jitable
+def ff_mul_float(ahi, alo, b):
+    phi, plo = two_prod(ahi, b)
+    return quick_two_sum(phi, plo + alo*b)
+
+#returns True if a < b
+@numba.extending.register_jitable
+def ff_lt(ahi, alo, bhi, blo):
+    return ahi < bhi or (ahi == bhi and alo < blo)
+
+#returns the float-float coordinate start + (i + 1/2)*step of pixel i (start and step are (hi, lo) tuples)
+@numba.extending.register_jitable
+def ff_coordinate(start, step, i):
+    dhi, dlo = ff_mul_float(step[0], step[1], np.float32(i) + half)
+    return ff_add(start[0], start[1], dhi, dlo)
+
+#in_cardioid in float-float
+@numba.extending.register_jitable
+def in_cardioid_floatfloat(x0hi, x0lo, y0hi, y0lo):
+    y2hi, y2lo = ff_mul(y0hi, y0lo, y0hi, y0lo)
+
+    xqhi, xqlo = ff_add(x0hi, x0lo, -quarter, zero)
+    qhi, qlo = ff_mul(xqhi, xqlo, xqhi, xqlo)
+    qhi, qlo = ff_add(qhi, qlo, y2hi, y2lo)
+    ahi, alo = ff_add(qhi, qlo, xqhi, xqlo)
+    ahi, alo = ff_mul(qhi, qlo, ahi, alo)
+    bhi, blo = ff_mul_float(y2hi, y2lo, quarter)
+    if ff_lt(ahi, alo, bhi, blo):
+        return True
+
+    xbhi, xblo = ff_add(x0hi, x0lo, one, zero)
+    ahi, alo = ff_mul(xbhi, xblo, xbhi, xblo)
+    ahi, alo = ff_add(ahi, alo, y2hi, y2lo)
+    if ff_lt(ahi, alo, sixteenth, zero):
+        return True
+
+    return False
+
+
+#Numba kernels compiled so far, by iteration budget
+_kernels = {}
+
+#Returns the Numba kernels for an iteration budget of niter. As with the MAXITER define of the OpenCL kernels,
+#the budget is a compile time constant (Numba treats the closure variable niter as a constant), and each budget's
+#kernels are only compiled once. The kernels are returned as attributes of a KernelSet
+def numba_kernels(niter=maxiter):
+    if niter in _kernels:
+        return _kernels[niter]
+
+    #Iterates the point (x0, y0) until |z|^2 > escape or niter iterations. Returns the number of iterations, |z|^2 and
+    #which short-cut was taken (0 = none, 1 = cardioid/bulb, 2 = periodic orbit). The short-cuts are the same as in
+    #mandelbrot.cl: the periodicity check compares the orbit exactly against a value saved at iterations 1, 2, 4, 8...
+    #(Brent's method), so it only stops orbits which really are periodic and gives identical results.
+    @numba.extending.register_jitable
+    def iterate(x0, y0, escape, opts):
+        if (opts & cardioid_check) and in_cardioid(x0,y0):
+            return niter, 0., 1
+
+        n=0
+
+        x=0.
+        y=0.
+        z2=0.
+
+        xold=0.
+        yold=0.
+        period=0
+        plimit=1
+
+        while(n < niter):
+            n+=1
+
+            z2 = x
+
+            x = x*x - y*y + x0
+            y = 2.*z2*y + y0
+
+            z2 = x*x + y*y
+
+            if z2 > escape:
+                break
+
+            if opts & periodicity_check:
+                if x == xold and y == yold:
+                    return niter, z2, 2
+                period+=1
+                if period == plimit:
+                    period = 0
+                    plimit *= 2
+                    xold = x
+                    yold = y
+
+        return n, z2, 0
+
+
+    #iterate in float-float, doing exactly what iterate_floatfloat in mandelbrot.cl does (so, unlike iterate, a point
+    #escapes once |z|^2 reaches escape). |z|^2 is calculated in single precision from the high parts
+    @numba.extending.register_jitable
+    def iterate_floatfloat(x0hi, x0lo, y0hi, y0lo, escape, opts):
+        if (opts & cardioid_check) and in_cardioid_floatfloat(x0hi, x0lo, y0hi, y0lo):
+            return niter, zero, 1
+
+        n=0
+
+        xhi=zero
+        xlo=zero
+        yhi=zero
+        ylo=zero
+        z2=zero
+
+        xoldhi=zero
+        xoldlo=zero
+        yoldhi=zero
+        yoldlo=zero
+        period=0
+        plimit=1
+
+        while(n < niter):
+            n+=1
+
+            xyhi, xylo = ff_mul(xhi, xlo, yhi, ylo)
+            x2hi, x2lo = ff_mul(xhi, xlo, xhi, xlo)
+            y2hi, y2lo = ff_mul(yhi, ylo, yhi, ylo)
+            xhi, xlo = ff_add(x2hi, x2lo, -y2hi, -y2lo)
+            xhi, xlo = ff_add(xhi, xlo, x0hi, x0lo)
+            yhi, ylo = ff_add(xyhi + xyhi, xylo + xylo, y0hi, y0lo)
+
+            z2 = xhi*xhi + yhi*yhi
+
+            if z2 >= escape:
+                break
+
+            if opts & periodicity_check:
+                if xhi == xoldhi and xlo == xoldlo and yhi == yoldhi and ylo == yoldlo:
+                    return niter, z2, 2
+                period+=1
+                if period == plimit:
+                    period = 0
+                    plimit *= 2
+                    xoldhi = xhi
+                    xoldlo = xlo
+                    yoldhi = yhi
+                    yoldlo = ylo
+
+        return n, z2, 0
+
+
+    #Calculates the discrete mandelbrot set for the pixels i0 <= i < i1, j0 <= j < j1 of out.
+    #The GIL is released so several tiles can be calculated at once from different threads.
+    #Returns the number of pixels short-circuited by the cardioid/bulb and periodicity checks
+    @numba.jit(nopython=True, nogil=True, cache=True)
+    def int_mandelbrot_tile(out, xmin, dx, ymin, dy, i0, i1, j0, j1, opts):
+        ncardioid = 0
+        nperiodic = 0
+
+        for j in range(j0,j1):
+            y0 = ymin + (j+0.5)*dy
+            for i in range(i0,i1):
+                x0 = xmin + (i+0.5)*dx
+
+                n, z2, shortcut = iterate(x0, y0, 4., opts)
+                if shortcut == 1:
+                    ncardioid += 1
+                elif shortcut == 2:
+                    nperiodic += 1
+                
+                out[j,i] = n
+
+        return ncardioid, nperiodic
+
+
+    #Calculates the continuous mandelbrot set for the pixels i0 <= i < i1, j0 <= j < j1 of out (releases the GIL)
+    @numba.jit(nopython=True, nogil=True, cache=True)
+    def real_mandelbrot_tile(out, xmin, dx, ymin, dy, i0, i1, j0, j1, opts):
+        ln2 = np.log(2.)
+
+        ncardioid = 0
+        nperiodic = 0
+
+        for j in range(j0,j1):
+            y0 = ymin + (j+0.5)*dy
+            for i in range(i0,i1):
+                x0 = xmin + (i+0.5)*dx
+
+                n, z2, shortcut = iterate(x0, y0, 100., opts)
+                if shortcut == 1:
+                    ncardioid += 1
+                elif shortcut == 2:
+                    nperiodic += 1
+                
+                if n == niter:
+                    out[j,i] = float(n)
+                else:
+                    out[j,i] = n + 2. - np.log(np.log(z2))/ln2;
+
+        return ncardioid, nperiodic
+
+
+    #The points kernels calculate only the pixels with flat indices index[k0:k1] (index = i + nx*j), writing
+    #the value of pixel index[k] to out[k]. Like the tile kernels, they release the GIL and return the number of
+    #pixels short-circuited by the cardioid/bulb and periodicity checks
+    @numba.jit(nopython=True, nogil=True, cache=True)
+    def int_mandelbrot_points(out, index, xmin, dx, ymin, dy, nx, k0, k1, opts):
+        ncardioid = 0
+        nperiodic = 0
+
+        for k in range(k0,k1):
+            i = index[k] % nx
+            j = index[k] // nx
+            x0 = xmin + (i+0.5)*dx
+            y0 = ymin + (j+0.5)*dy
+
+            n, z2, shortcut = iterate(x0, y0, 4., opts)
+            if shortcut == 1:
+                ncardioid += 1
+            elif shortcut == 2:
+                nperiodic += 1
+
+            out[k] = n
+
+        return ncardioid, nperiodic
+
+
+    @numba.jit(nopython=True, nogil=True, cache=True)
+    def real_mandelbrot_points(out, index, xmin, dx, ymin, dy, nx, k0, k1, opts):
+        ln2 = np.log(2.)
+
+        ncardioid = 0
+        nperiodic = 0
+
+        for k in range(k0,k1):
+            i = index[k] % nx
+            j = index[k] // nx
+            x0 = xmin + (i+0.5)*dx
+            y0 = ymin + (j+0.5)*dy
+
+            n, z2, shortcut = iterate(x0, y0, 100., opts)
+            if shortcut == 1:
+                ncardioid += 1
+            elif shortcut == 2:
+                nperiodic += 1
+
+            if n == niter:
+                out[k] = float(n)
+            else:
+                out[k] = n + 2. - np.log(np.log(z2))/ln2;
+
+        return ncardioid, nperiodic
+
+
+    #The float-float versions of the tile and points kernels, which take xmin, dx, ymin and dy as float-float (hi, lo)
+    #tuples (see mandelbrot.split_floatfloat)
+    @numba.jit(nopython=True, nogil=True, cache=True)
+    def int_mandelbrot_tile_floatfloat(out, xmin, dx, ymin, dy, i0, i1, j0, j1, opts):
+        ncardioid = 0
+        nperiodic = 0
+
+        for j in range(j0,j1):
+            y0hi, y0lo = ff_coordinate(ymin, dy, j)
+            for i in range(i0,i1):
+                x0hi, x0lo = ff_coordinate(xmin, dx, i)
+
+                n, z2, shortcut = iterate_floatfloat(x0hi, x0lo, y0hi, y0lo, 4., opts)
+                if shortcut == 1:
+                    ncardioid += 1
+                elif shortcut == 2:
+                    nperiodic += 1
+
+                out[j,i] = n
+
+        return ncardioid, nperiodic
+
+
+    @numba.jit(nopython=True, nogil=True, cache=True)
+    def real_mandelbrot_tile_floatfloat(out, xmin, dx, ymin, dy, i0, i1, j0, j1, opts):
+        ln2 = np.log(2.)
+
+        ncardioid = 0
+        nperiodic = 0
+
+        for j in range(j0,j1):
+            y0hi, y0lo = ff_coordinate(ymin, dy, j)
+            for i in range(i0,i1):
+                x0hi, x0lo = ff_coordinate(xmin, dx, i)
+
+                n, z2, shortcut = iterate_floatfloat(x0hi, x0lo, y0hi, y0lo, 100., opts)
+                if shortcut == 1:
+                    ncardioid += 1
+                elif shortcut == 2:
+                    nperiodic += 1
+
+                if n == niter:
+                    out[j,i] = float(n)
+                else:
+                    out[j,i] = n + 2. - np.log(np.log(np.float64(z2)))/ln2
+
+        return ncardioid, nperiodic
+
+
+    @numba.jit(nopython=True, nogil=True, cache=True)
+    def int_mandelbrot_points_floatfloat(out, index, xmin, dx, ymin, dy, nx, k0, k1, opts):
+        ncardioid = 0
+        nperiodic = 0
+
+        for k in range(k0,k1):
+            x0hi, x0lo = ff_coordinate(xmin, dx, index[k] % nx)
+            y0hi, y0lo = ff_coordinate(ymin, dy, index[k] // nx)
+
+            n, z2, shortcut = iterate_floatfloat(x0hi, x0lo, y0hi, y0lo, 4., opts)
+            if shortcut == 1:
+                ncardioid += 1
+            elif shortcut == 2:
+                nperiodic += 1
+
+            out[k] = n
+
+        return ncardioid, nperiodic
+
+
+    @numba.jit(nopython=True, nogil=True, cache=True)
+    def real_mandelbrot_points_floatfloat(out, index, xmin, dx, ymin, dy, nx, k0, k1, opts):
+        ln2 = np.log(2.)
+
+        ncardioid = 0
+        nperiodic = 0
+
+        for k in range(k0,k1):
+            x0hi, x0lo = ff_coordinate(xmin, dx, index[k] % nx)
+            y0hi, y0lo = ff_coordinate(ymin, dy, index[k] // nx)
+
+            n, z2, shortcut = iterate_floatfloat(x0hi, x0lo, y0hi, y0lo, 100., opts)
+            if shortcut == 1:
+                ncardioid += 1
+            elif shortcut == 2:
+                nperiodic += 1
+
+            if n == niter:
+                out[k] = float(n)
+            else:
+                out[k] = n + 2. - np.log(np.log(np.float64(z2)))/ln2
+
+        return ncardioid, nperiodic
+
+
+    #Perturbation kernel for deep zooms (see perturbation.py and perturb_points_double in mandelbrot.cl).
+    #Iterates the offsets (deltas) of the pixels index[k0:k1] from the reference orbit Z[0:nref+1], starting at
+    #iteration skip from the series approximation delta = A*dc + B*dc^2 + C*dc^3. Writes the values (as floats for
+    #both discrete and continuous images) to out and flags glitched pixels in glitched. Returns the number of
+    #glitched pixels (and 0, so it can be run by run_dynamic)
+    @numba.jit(nopython=True, nogil=True, cache=True)
+    def perturb_points(out, glitched, index, Z, nref, A, B, C, skip, dxmin, dx, dymin, dy, nx, escape, real, k0, k1):
+        ln2 = np.log(2.)
+
+        nglitched = 0
+
+        for k in range(k0,k1):
+            i = index[k] % nx
+            j = index[k] // nx
+
+            #offset of this pixel from the reference point
+            dc = complex(dxmin + (i+0.5)*dx, dymin + (j+0.5)*dy)
+            d = ((C*dc + B)*dc + A)*dc
+
+            n = skip
+            z2 = 0.
+            glitch = False
+
+            while n < niter:
+                #the reference has escaped (or ended) before this pixel
+                if n >= nref:
+                    glitch = True
+                    break
+
+                d = (2.*Z[n] + d)*d + dc
+                n += 1
+
+                z = Z[n] + d
+                z2 = z.real*z.real + z.imag*z.imag
+
+                if z2 > escape:
+                    break
+
+                if z2 < glitch_tolerance*(Z[n].real*Z[n].real + Z[n].imag*Z[n].imag):
+                    glitch = True
+                    break
+
+            glitched[k] = glitch
+            if glitch:
+                nglitched += 1
+
+            #(glitched pixels have not escaped, so get their iteration count until they are recalculated)
+            if real and not glitch and n < niter:
+                out[k] = n + 2. - np.log(np.log(z2))/ln2
+            else:
+                out[k] = float(n)
+
+        return nglitched, 0
+
+
+    #single threaded versions, calculating the whole image in one go (these call the tile kernels, so are not cached)
+    @numba.jit(nopython=True, nogil=True)
+    def int_mandelbrot(xmin, dx, ymin, dy, nx, ny, opts=cardioid_check|periodicity_check):
+        out = np.zeros((ny,nx),dtype=np.int32)
+        int_mandelbrot_tile(out, xmin, dx, ymin, dy, 0, nx, 0, ny, opts)
+        return out
+
+
+    @numba.jit(nopython=True, nogil=True)
+    def real_mandelbrot(xmin, dx, ymin, dy, nx, ny, opts=cardioid_check|periodicity_check):
+        out = np.zeros((ny,nx),dtype=np.float32)
+        real_mandelbrot_tile(out, xmin, dx, ymin, dy, 0, nx, 0, ny, opts)
+        return out
+
+    kernels = KernelSet(iterate=iterate,
+                        int_mandelbrot_tile=int_mandelbrot_tile,
+                        real_mandelbrot_tile=real_mandelbrot_tile,
+                        int_mandelbrot_points=int_mandelbrot_points,
+                        real_mandelbrot_points=real_mandelbrot_points,
+                        iterate_floatfloat=iterate_floatfloat,
+                        int_mandelbrot_tile_floatfloat=int_mandelbrot_tile_floatfloat,
+                        real_mandelbrot_tile_floatfloat=real_mandelbrot_tile_floatfloat,
+                        int_mandelbrot_points_floatfloat=int_mandelbrot_points_floatfloat,
+                        real_mandelbrot_points_floatfloat=real_mandelbrot_points_floatfloat,
+                        perturb_points=perturb_points,
+                        int_mandelbrot=int_mandelbrot,
+                        real_mandelbrot=real_mandelbrot)
+    _kernels[niter] = kernels
+    return kernels
+
+
+#the Numba kernels for one iteration budget
+KernelSet = collections.namedtuple("KernelSet",["iterate","int_mandelbrot_tile","real_mandelbrot_tile",
+                                                "int_mandelbrot_points","real_mandelbrot_points","iterate_floatfloat",
+                                                "int_mandelbrot_tile_floatfloat","real_mandelbrot_tile_floatfloat",
+                                                "int_mandelbrot_points_floatfloat","real_mandelbrot_points_floatfloat",
+                                                "perturb_points","int_mandelbrot","real_mandelbrot"])
@@ -0,0 +1,156 @@
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import collections
+from urllib.parse import urlsplit
+
+from .tileserver import tile_containing
+
+
+#Load generator for the tile server (see tileserver.py): python pyFractal.py loadgen
+#Requests tiles from a running server over concurrency keep-alive connections, each sending its next request as soon
+#as the last one is answered, and reports the throughput and the latency percentiles. The tiles are those a viewer
+#panning and zooming about a point would ask for: each request picks a zoom level from zooms and one of the window x
+#window tiles around the point at that level, so some requests repeat (served from the cache, or joining a render in
+#progress) and some are new.
+
+#the point the tiles are around (seahorse valley, whose tiles are all expensive), and the size of the window of tiles
+centre = (-0.745, 0.11)
+window = 4
+
+
+#Returns the paths of n tile requests (see above), of zoom levels zooms[0] ... zooms[1], with the query string query
+def tile_paths(n,zooms,centre=centre,window=window,extension="png",query="",seed=0):
+    rng = random.Random(seed)
+    paths = []
+    for k in range(n):
+        z = rng.randint(zooms[0],zooms[1])
+        x0, y0 = tile_containing(z,*centre)
+        side = min(window,2**z)
+        x = min(max(0,x0-side//2),2**z-side) + rng.randrange(side)
+        y = min(max(0,y0-side//2),2**z-side) + rng.randrange(side)
+        paths.append("/tiles/%d/%d/%d.%s%s"%(z,x,y,extension,"?"+query if query else ""))
+    return paths
+
+
+#sends a GET request for path and reads the response. Returns the status, the headers and the length of the body
+async def fetch(reader,writer,host,path):
+    writer.write(("GET %s HTTP/1.1\r\nHost: %s\r\n\r\n"%(path,host)).encode("latin-1"))
+    await writer.drain()
+    line = await reader.readline()
+    if not line:
+        raise ConnectionError("connection closed by the server")
+    status = int(line.split()[1])
+    headers = {}
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, colon, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip()
+    body = await reader.readexactly(int(headers.get("content-length",0)))
+    return status, headers, len(body)
+
+
+#One client connection: takes paths from the end of paths until there are none left, appending (latency, status,
+#X-Cache header, bytes) to results for each (with no status if it could not connect or the connection failed).
+#Reconnects if the server closes the connection
+async def client(host,port,paths,results):
+    reader = writer = None
+    while paths:
+        path = paths.pop()
+        tstart = time.perf_counter()
+        try:
+            if writer is None:
+                reader, writer = await asyncio.open_connection(host,port)
+            status, headers, nbytes = await fetch(reader,writer,host,path)
+        except (OSError, asyncio.IncompleteReadError):
+            results.append((time.perf_counter()-tstart, None, None, 0))
+            if writer is not None:
+                writer.close()
+            writer = None
+            continue
+        results.append((time.perf_counter()-tstart, status, headers.get("x-cache"), nbytes))
+        if headers.get("connection","").lower() == "close":
+            writer.close()
+            writer = None
+    if writer is not None:
+        writer.close()
+
+
+#returns the p-th percentile (0 ... 100) of the sorted list values, by the nearest rank
+def percentile(values,p):
+    k = max(0,min(len(values)-1,int(-(-p*len(values)//100))-1))
+    return values[k]
+
+
+#Sends the requests for paths to the server at host:port over concurrency connections. Returns a summary of the
+#results: the time taken, requests per second, bytes per second, the counts of each status and of each way tiles were
+#served (see TileServer.getTile), and the latency percentiles (in seconds) of the successful requests
+async def run(host,port,paths,concurrency):
+    paths = list(reversed(paths))
+    results = []
+    tstart = time.perf_counter()
+    await asyncio.gather(*[client(host,port,paths,results) for k in range(concurrency)])
+    total = time.perf_counter()-tstart
+
+    latencies = sorted(r[0] for r in results if r[1] == 200)
+    summary = {
+        "requests": len(results),
+        "seconds": total,
+        "concurrency": concurrency,
+        "requests_per_second": len(results)/total,
+        "bytes_per_second": sum(r[3] for r in results)/total,
+        "statuses": dict(collections.Counter(str(r[1]) for r in results)),
+        "cache": dict(collections.Counter(r[2] for r in results if r[2] is not None)),
+    }
+    if latencies:
+        summary["latency"] = {"mean": sum(latencies)/len(latencies), "p50": percentile(latencies,50),
+                              "p90": percentile(latencies,90), "p99": percentile(latencies,99), "max": latencies[-1]}
+    return summary
+
+
+#returns a description of the summary from run, for printing
+def describe(summary):
+    lines = ["%d requests in %.2fs on %d connections: %.1f requests/s, %.2f MB/s"%(summary["requests"],summary["seconds"],
+             summary["concurrency"],summary["requests_per_second"],summary["bytes_per_second"]/1E6),
+             "Statuses: %s"%", ".join("%s x %d"%s for s in sorted(summary["statuses"].items())),
+             "Served: %s"%", ".join("%s x %d"%s for s in sorted(summary["cache"].items()))]
+    if "latency" in summary:
+        lines.append("Latency (ms): "+", ".join("%s %.1f"%(name,1000*value) for name, value in summary["latency"].items()))
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pyFractal.py loadgen",description="Measures the throughput and latency of the tile server")
+    parser.add_argument("--url",default="http://127.0.0.1:8080",help="the tile server (default: http://127.0.0.1:8080)")
+    parser.add_argument("-n","--requests",type=int,default=2000,help="number of requests (default: 2000)")
+    parser.add_argument("-c","--concurrency",type=int,default=32,help="number of connections (default: 32)")
+    parser.add_argument("--zooms",type=int,nargs=2,default=[2,8],metavar=("MIN","MAX"),help="zoom levels to request (default: 2 8)")
+    parser.add_argument("--centre",type=float,nargs=2,default=list(centre),metavar=("X","Y"),help="point the tiles are around (default: %g %g)"%centre)
+    parser.add_argument("--window",type=int,default=window,help="side of the window of tiles around the point at each level (default: %d)"%window)
+    parser.add_argument("--format",default="png",choices=["png","f32"],help="tile format (default: png)")
+    parser.add_argument("--query",default="",help="query string added to every request, e.g. 'continuous=1&cmap=magma'")
+    parser.add_argument("--seed",type=int,default=0,help="random seed of the requests (default: 0)")
+    parser.add_argument("--report",help="write the results to this JSON file")
+    args = parser.parse_args(argv)
+
+    url = urlsplit(args.url)
+    host, port = url.hostname or "127.0.0.1", url.port or 80
+    paths = tile_paths(args.requests,args.zooms,tuple(args.centre),args.window,args.format,args.query,args.seed)
+
+    print("Sending %d requests to %s:%d on %d connections..."%(len(paths),host,port,args.concurrency))
+    summary = asyncio.run(run(host,port,paths,args.concurrency))
+    print(describe(summary))
+
+    if args.report is not None:
+        with open(args.report,"w") as f:
+            json.dump(summary,f,indent=1)
+    return 0 if summary["statuses"].get("200",0) == summary["requests"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
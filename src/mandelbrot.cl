@@ -1,22 +1,67 @@
+//The double precision code is only built on devices which support it (cl_khr_fp64 is defined), so the program also
+//builds on devices without it, which use the single and float-float precision kernels
+#ifdef cl_khr_fp64
 #pragma OPENCL EXTENSION cl_khr_fp64 : enable
+#endif
 
-//Calculates the Mandelbrot set 
+//Calculates the Mandelbrot set
 
 //output: out (the image array)
 //inputs: xmin, ymin  (x and y start coordinates)
 //inputs dx, dy  (pixel size in x and y)
 //inputs:  nx, ny (number of points in x and y)
+//inputs:  opts (which short-cuts to use, a combination of CARDIOID_CHECK and PERIODICITY_CHECK)
+//output:  stats (stats[0] is incremented for every point found in the cardioid/bulb, stats[1] for every periodic point)
 
-//Calculates using floating point x and y values (accurate down to 1E-6 ish)
-__kernel void mandelbrot_float(__global int *out, __private float xmin, __private float dx, __private float ymin, __private float dy, __private int nx, __private int ny){
-    //coords of thhis kernel instance
-    int idx = get_global_id(1);
-    int idy = get_global_id(0);
-    
-    //get the x0 and y0 values
-    float x0 = xmin + idx*dx + (dx/2);
-    float y0 = ymin + idy*dy + (dy/2);
+//The maximum number of iterations is a compile time constant (set with -DMAXITER=... when building the program)
+//so the compiler can specialise the kernels for each iteration budget
+#ifndef MAXITER
+#define MAXITER 256
+#endif
+
+//skip points inside the main cardioid or the period-2 bulb (they are always in the set)
+#define CARDIOID_CHECK 1
+//stop iterating once the orbit returns exactly to a previous value (it is periodic, so is in the set)
+#define PERIODICITY_CHECK 2
+
+//Returns 1 if the point lies inside the main cardioid or the period-2 bulb
+int in_cardioid_float(float x0, float y0){
+    float y2 = y0*y0;
+
+    float xq = x0 - 0.25f;
+    float q = xq*xq + y2;
+    if (q*(q + xq) < 0.25f*y2) return 1;
+
+    float xb = x0 + 1.f;
+    if (xb*xb + y2 < 0.0625f) return 1;
+
+    return 0;
+}
+
+#ifdef cl_khr_fp64
+int in_cardioid_double(double x0, double y0){
+    double y2 = y0*y0;
+
+    double xq = x0 - 0.25;
+    double q = xq*xq + y2;
+    if (q*(q + xq) < 0.25*y2) return 1;
+
+    double xb = x0 + 1.;
+    if (xb*xb + y2 < 0.0625) return 1;
 
+    return 0;
+}
+#endif
+
+//Iterates the point (x0, y0) until |z|^2 >= escape or for MAXITER iterations. Returns the number of iterations
+//and stores the final |z|^2 in z2out.
+
+//The periodicity check uses Brent's method: the orbit is saved at iterations 1, 2, 4, 8, ... and each
+//new value is compared with the saved one. The comparison is exact, so a point is only short-circuited if
+//its orbit really has entered a cycle, and the results are identical to iterating all the way.
+
+//Uses floating point x and y values (accurate down to 1E-6 ish)
+int iterate_float(float x0, float y0, float escape, int opts, __global int *stats, float *z2out){
     float x = 0.;
     float y = 0.;
 
@@ -26,10 +71,21 @@ __kernel void mandelbrot_float(__global int *out, __private float xmin, __privat
 
     float z2 = x*x + y*y;
 
-    while(z2 < 4 && n<256){
+    if ((opts & CARDIOID_CHECK) && in_cardioid_float(x0,y0)){
+        n = MAXITER;
+        atomic_inc(&stats[0]);
+    }
+
+    //the saved value of the orbit for the periodicity check
+    float xold = 0.;
+    float yold = 0.;
+    int period = 0;
+    int plimit = 1;
+
+    while(z2 < escape && n<MAXITER){
         //use this temporarily to hold the original x value
         z2 = x;
-        
+
         //update x and y
         // (x+iy)^2 + x0 + iy0 = (x^2 - y^2 + x0) + (2*y*x + y0)i
         x = x*x - y*y + x0;
@@ -37,22 +93,30 @@ __kernel void mandelbrot_float(__global int *out, __private float xmin, __privat
 
         z2 = x*x + y*y;
         n+=1;
-    }
 
-    out[idx + nx*idy] = n;
+        if (opts & PERIODICITY_CHECK){
+            if (x == xold && y == yold){
+                n = MAXITER;
+                atomic_inc(&stats[1]);
+                break;
+            }
+            period+=1;
+            if (period == plimit){
+                period = 0;
+                plimit *= 2;
+                xold = x;
+                yold = y;
+            }
+        }
+    }
 
+    *z2out = z2;
+    return n;
 }
 
-//calculates using double precision x and y values, accurate down to 1E-14 ish
-__kernel void mandelbrot_double(__global int *out, __private double xmin, __private double dx, __private double ymin, __private double dy, __private int nx, __private int ny){
-    //coords of thhis kernel instance
-    int idx = get_global_id(1);
-    int idy = get_global_id(0);
-    
-    //get the x0 and y0 values
-    double x0 = xmin + idx*dx + (dx/2);
-    double y0 = ymin + idy*dy + (dy/2);
-
+#ifdef cl_khr_fp64
+//Uses double precision x and y values, accurate down to 1E-14 ish
+int iterate_double(double x0, double y0, double escape, int opts, __global int *stats, double *z2out){
     double x = 0.;
     double y = 0.;
 
@@ -62,10 +126,21 @@ __kernel void mandelbrot_double(__global int *out, __private double xmin, __priv
 
     double z2 = x*x + y*y;
 
-    while(z2 < 4 && n<256){
+    if ((opts & CARDIOID_CHECK) && in_cardioid_double(x0,y0)){
+        n = MAXITER;
+        atomic_inc(&stats[0]);
+    }
+
+    //the saved value of the orbit for the periodicity check
+    double xold = 0.;
+    double yold = 0.;
+    int period = 0;
+    int plimit = 1;
+
+    while(z2 < escape && n<MAXITER){
         //use this temporarily to hold the original x value
         z2 = x;
-        
+
         //update x and y
         // (x+iy)^2 + x0 + iy0 = (x^2 - y^2 + x0) + (2*y*x + y0)i
         x = x*x - y*y + x0;
@@ -73,100 +148,754 @@ __kernel void mandelbrot_double(__global int *out, __private double xmin, __priv
 
         z2 = x*x + y*y;
         n+=1;
+
+        if (opts & PERIODICITY_CHECK){
+            if (x == xold && y == yold){
+                n = MAXITER;
+                atomic_inc(&stats[1]);
+                break;
+            }
+            period+=1;
+            if (period == plimit){
+                period = 0;
+                plimit *= 2;
+                xold = x;
+                yold = y;
+            }
+        }
+    }
+
+    *z2out = z2;
+    return n;
+}
+#endif
+
+//Converts the number of iterations and the final |z|^2 into the continuous (real-valued) pixel value
+float smooth_float(int n, float z2){
+    const float ln2 = log((float)2.);
+
+    if (n==MAXITER){
+        return MAXITER;
+    } else {
+        return (float) n + 2. - log(log(z2))/ln2;
     }
+}
 
-    out[idx + nx*idy] = n;
+#ifdef cl_khr_fp64
+float smooth_double(int n, double z2){
+    const float ln2 = log((float)2.);
 
+    if (n==MAXITER){
+        return MAXITER;
+    } else {
+        return (float) n + 2. - log(log((float)z2))/ln2;
+    }
 }
+#endif
+
+
+
+//The image kernels calculate ny rows of an image, starting at row row0 (so a band of rows of a larger image can be
+//calculated with exactly the same coordinates as the whole image), writing pixel (idx, idy) to out[idx + nx*idy].
+//They may be launched with the global size rounded up to a whole number of work-groups, so ignore pixels outside it
+
+//Calculates the discrete mandelbrot set using single precision
+__kernel void mandelbrot_float(__global int *out, __private float xmin, __private float dx, __private float ymin, __private float dy, __private int nx, __private int ny, __private int row0, __private int opts, __global int *stats){
+    //coords of thhis kernel instance
+    int idx = get_global_id(1);
+    int idy = get_global_id(0);
+    if (idx >= nx || idy >= ny) return;
+
+    //get the x0 and y0 values
+    float x0 = xmin + idx*dx + (dx/2);
+    float y0 = ymin + (row0+idy)*dy + (dy/2);
+
+    float z2;
+    out[idx + nx*idy] = iterate_float(x0,y0,4,opts,stats,&z2);
+
+}
+
+#ifdef cl_khr_fp64
+//Calculates the discrete mandelbrot set using double precision
+__kernel void mandelbrot_double(__global int *out, __private double xmin, __private double dx, __private double ymin, __private double dy, __private int nx, __private int ny, __private int row0, __private int opts, __global int *stats){
+    //coords of thhis kernel instance
+    int idx = get_global_id(1);
+    int idy = get_global_id(0);
+    if (idx >= nx || idy >= ny) return;
+
+    //get the x0 and y0 values
+    double x0 = xmin + idx*dx + (dx/2);
+    double y0 = ymin + (row0+idy)*dy + (dy/2);
+
+    double z2;
+    out[idx + nx*idy] = iterate_double(x0,y0,4,opts,stats,&z2);
+
+}
+#endif
 
 
 
 
 //calculates the real-valued mandelbrot set (returns a real not an int)
-__kernel void real_mandelbrot_float(__global float *out, __private float xmin, __private float dx, __private float ymin, __private float dy, __private int nx, __private int ny){
+__kernel void real_mandelbrot_float(__global float *out, __private float xmin, __private float dx, __private float ymin, __private float dy, __private int nx, __private int ny, __private int row0, __private int opts, __global int *stats){
     //coords of thhis kernel instance
     int idx = get_global_id(1);
     int idy = get_global_id(0);
-    
+    if (idx >= nx || idy >= ny) return;
+
     //get the x0 and y0 values
     float x0 = xmin + idx*dx + (dx/2);
-    float y0 = ymin + idy*dy + (dy/2);
+    float y0 = ymin + (row0+idy)*dy + (dy/2);
 
-    float x = 0.;
-    float y = 0.;
+    float z2;
+    int n = iterate_float(x0,y0,100,opts,stats,&z2);
 
-    const float ln2 = log((float)2.);
+    out[idx + nx*idy] = smooth_float(n,z2);
+
+}
+
+
+#ifdef cl_khr_fp64
+//calculates the real-valued mandelbrot set (returns a real not an int) using double precision
+__kernel void real_mandelbrot_double(__global float *out, __private double xmin, __private double dx, __private double ymin, __private double dy, __private int nx, __private int ny, __private int row0, __private int opts, __global int *stats){
+    //coords of thhis kernel instance
+    int idx = get_global_id(1);
+    int idy = get_global_id(0);
+    if (idx >= nx || idy >= ny) return;
+
+    //get the x0 and y0 values
+    double x0 = xmin + idx*dx + (dx/2);
+    double y0 = ymin + (row0+idy)*dy + (dy/2);
+
+    double z2;
+    int n = iterate_double(x0,y0,100,opts,stats,&z2);
+
+    out[idx + nx*idy] = smooth_double(n,z2);
+
+}
+#endif
+
+
+
+//Float-float kernels: each coordinate is the unevaluated sum hi + lo of two floats (a float2 (hi, lo), with lo no
+//bigger than half a unit in the last place of hi), giving about 48 bits of precision (accurate down to 1E-13 ish)
+//from single precision arithmetic only. This is several times the work of single precision, but on devices without
+//double precision, or whose double precision is much slower than single, it zooms far deeper than single precision.
+//The sums and products are made exact with the error-free transformations below (fma gives the exact error of a
+//product), so they must not be contracted (into fma) or reassociated by the compiler.
+#pragma OPENCL FP_CONTRACT OFF
+
+//returns a + b exactly as a float-float
+float2 two_sum(float a, float b){
+    float s = a + b;
+    float bb = s - a;
+    return (float2)(s, (a - (s - bb)) + (b - bb));
+}
+
+//returns a + b exactly as a float-float, if |a| >= |b|
+float2 quick_two_sum(float a, float b){
+    float s = a + b;
+    return (float2)(s, b - (s - a));
+}
+
+//returns a*b exactly as a float-float
+float2 two_prod(float a, float b){
+    float p = a*b;
+    return (float2)(p, fma(a,b,-p));
+}
+
+float2 ff_add(float2 a, float2 b){
+    float2 s = two_sum(a.x,b.x);
+    float2 t = two_sum(a.y,b.y);
+    s = quick_two_sum(s.x,s.y + t.x);
+    return quick_two_sum(s.x,s.y + t.y);
+}
+
+float2 ff_mul(float2 a, float2 b){
+    float2 p = two_prod(a.x,b.x);
+    return quick_two_sum(p.x,p.y + (a.x*b.y + a.y*b.x));
+}
+
+float2 ff_mul_float(float2 a, float b){
+    float2 p = two_prod(a.x,b);
+    return quick_two_sum(p.x,p.y + a.y*b);
+}
+
+//returns 1 if a < b
+int ff_lt(float2 a, float2 b){
+    return a.x < b.x || (a.x == b.x && a.y < b.y);
+}
+
+//Returns 1 if the point lies inside the main cardioid or the period-2 bulb (in float-float, as for deep zooms near
+//their edges single precision would put points which escape inside them)
+int in_cardioid_floatfloat(float2 x0, float2 y0){
+    float2 y2 = ff_mul(y0,y0);
+
+    float2 xq = ff_add(x0,(float2)(-0.25f,0.f));
+    float2 q = ff_add(ff_mul(xq,xq),y2);
+    if (ff_lt(ff_mul(q,ff_add(q,xq)),ff_mul_float(y2,0.25f))) return 1;
+
+    float2 xb = ff_add(x0,(float2)(1.f,0.f));
+    if (ff_lt(ff_add(ff_mul(xb,xb),y2),(float2)(0.0625f,0.f))) return 1;
+
+    return 0;
+}
+
+//Iterates the point (x0, y0) like iterate_float, in float-float. |z|^2 is only compared with the escape radius,
+//so it is calculated from the high parts in single precision
+int iterate_floatfloat(float2 x0, float2 y0, float escape, int opts, __global int *stats, float *z2out){
+    float2 x = (float2)(0.f,0.f);
+    float2 y = (float2)(0.f,0.f);
 
     int n=0;
 
-    // z_(n+1) = z_(n)^2 + (x0 + iy0)
+    float z2 = 0.f;
 
-    float z2 = x*x + y*y;
+    if ((opts & CARDIOID_CHECK) && in_cardioid_floatfloat(x0,y0)){
+        n = MAXITER;
+        atomic_inc(&stats[0]);
+    }
 
-    while(z2 < 100 && n<256){
-        //use this temporarily to hold the original x value
-        z2 = x;
-        
-        //update x and y
+    //the saved value of the orbit for the periodicity check
+    float2 xold = (float2)(0.f,0.f);
+    float2 yold = (float2)(0.f,0.f);
+    int period = 0;
+    int plimit = 1;
+
+    while(z2 < escape && n<MAXITER){
         // (x+iy)^2 + x0 + iy0 = (x^2 - y^2 + x0) + (2*y*x + y0)i
-        x = x*x - y*y + x0;
-        y = 2*z2*y + y0;
+        float2 xy = ff_mul(x,y);
+        x = ff_add(ff_add(ff_mul(x,x),-ff_mul(y,y)),x0);
+        y = ff_add(2.f*xy,y0);
 
-        z2 = x*x + y*y;
+        z2 = x.x*x.x + y.x*y.x;
         n+=1;
+
+        if (opts & PERIODICITY_CHECK){
+            if (all(x == xold) && all(y == yold)){
+                n = MAXITER;
+                atomic_inc(&stats[1]);
+                break;
+            }
+            period+=1;
+            if (period == plimit){
+                period = 0;
+                plimit *= 2;
+                xold = x;
+                yold = y;
+            }
+        }
     }
 
+    *z2out = z2;
+    return n;
+}
 
-    if (n==256){
-        out[idx + nx*idy] = 256.;
-    } else {
-        out[idx + nx*idy] = (float) n + 2. - log(log(z2))/ln2;
+//The float-float kernels take each of xmin, dx, ymin and dy as its high and low parts, and calculate the coordinates
+//as xmin + (idx + 1/2)*dx
+
+//Calculates the discrete mandelbrot set using float-float precision
+__kernel void mandelbrot_floatfloat(__global int *out, __private float xminhi, __private float xminlo, __private float dxhi, __private float dxlo, __private float yminhi, __private float yminlo, __private float dyhi, __private float dylo, __private int nx, __private int ny, __private int row0, __private int opts, __global int *stats){
+    int idx = get_global_id(1);
+    int idy = get_global_id(0);
+    if (idx >= nx || idy >= ny) return;
+
+    float2 x0 = ff_add((float2)(xminhi,xminlo),ff_mul_float((float2)(dxhi,dxlo),idx + 0.5f));
+    float2 y0 = ff_add((float2)(yminhi,yminlo),ff_mul_float((float2)(dyhi,dylo),(row0+idy) + 0.5f));
+
+    float z2;
+    out[idx + nx*idy] = iterate_floatfloat(x0,y0,4,opts,stats,&z2);
+}
+
+//calculates the real-valued mandelbrot set using float-float precision
+__kernel void real_mandelbrot_floatfloat(__global float *out, __private float xminhi, __private float xminlo, __private float dxhi, __private float dxlo, __private float yminhi, __private float yminlo, __private float dyhi, __private float dylo, __private int nx, __private int ny, __private int row0, __private int opts, __global int *stats){
+    int idx = get_global_id(1);
+    int idy = get_global_id(0);
+    if (idx >= nx || idy >= ny) return;
+
+    float2 x0 = ff_add((float2)(xminhi,xminlo),ff_mul_float((float2)(dxhi,dxlo),idx + 0.5f));
+    float2 y0 = ff_add((float2)(yminhi,yminlo),ff_mul_float((float2)(dyhi,dylo),(row0+idy) + 0.5f));
+
+    float z2;
+    int n = iterate_floatfloat(x0,y0,100,opts,stats,&z2);
+
+    out[idx + nx*idy] = smooth_float(n,z2);
+}
+#pragma OPENCL FP_CONTRACT DEFAULT
+
+
+
+//Vector kernels: each work-item calculates WIDTH neighbouring pixels of a row (WIDTH is set when building the program,
+//with -DWIDTH=2, 4 or 8) in the lanes of vectors, so on CPUs the pixels are iterated together by SIMD instructions.
+//The lanes are iterated until all of them have finished, and each lane does exactly what iterate_float/iterate_double
+//does for its pixel (a lane which has finished is left as it is), so the images are identical to the scalar kernels'.
+//Every lane still iterating has done the same number of iterations, so the lanes share the periodicity check's schedule
+#ifdef WIDTH
+
+#define CAT_(a,b) a##b
+#define CAT(a,b) CAT_(a,b)
+#define floatV CAT(float,WIDTH)
+#define doubleV CAT(double,WIDTH)
+#define intV CAT(int,WIDTH)
+#define longV CAT(long,WIDTH)
+#define convert_floatV CAT(convert_float,WIDTH)
+#define convert_doubleV CAT(convert_double,WIDTH)
+#define convert_longV CAT(convert_long,WIDTH)
+#define vstoreV CAT(vstore,WIDTH)
+
+//the offset of each lane's pixel from the work-item's first pixel
+#if WIDTH == 2
+#define LANES (int2)(0,1)
+#elif WIDTH == 4
+#define LANES (int4)(0,1,2,3)
+#elif WIDTH == 8
+#define LANES (int8)(0,1,2,3,4,5,6,7)
+#endif
+
+//Iterates the points (x0, y0) of the lanes which are set (-1) in active. Returns the number of iterations of each lane
+//and stores the final |z|^2 in z2out and the short-cut taken (0 none, 1 cardioid/bulb, 2 periodic orbit) in cutout
+intV iterate_floatV(floatV x0, floatV y0, float escape, int opts, intV active, floatV *z2out, intV *cutout){
+    floatV x = 0.f;
+    floatV y = 0.f;
+    floatV z2 = 0.f;
+    intV n = 0;
+    intV cut = 0;
+
+    if (opts & CARDIOID_CHECK){
+        floatV y2 = y0*y0;
+        floatV xq = x0 - 0.25f;
+        floatV q = xq*xq + y2;
+        floatV xb = x0 + 1.f;
+        intV inside = active & ((q*(q + xq) < 0.25f*y2) | (xb*xb + y2 < 0.0625f));
+        n = select(n,(intV)MAXITER,inside);
+        cut = select(cut,(intV)1,inside);
+        active &= ~inside;
+    }
+
+    //the saved value of the orbit for the periodicity check
+    floatV xold = 0.f;
+    floatV yold = 0.f;
+    int period = 0;
+    int plimit = 1;
+
+    while (any(active)){
+        floatV xn = x*x - y*y + x0;
+        floatV yn = 2.f*x*y + y0;
+        x = select(x,xn,active);
+        y = select(y,yn,active);
+        z2 = select(z2,x*x + y*y,active);
+        n -= active;
+
+        if (opts & PERIODICITY_CHECK){
+            intV periodic = active & (x == xold) & (y == yold);
+            n = select(n,(intV)MAXITER,periodic);
+            cut = select(cut,(intV)2,periodic);
+            active &= ~periodic;
+
+            period+=1;
+            if (period == plimit){
+                period = 0;
+                plimit *= 2;
+                xold = x;
+                yold = y;
+            }
+        }
+
+        active &= (z2 < escape) & (n < MAXITER);
     }
-    
 
+    *z2out = z2;
+    *cutout = cut;
+    return n;
 }
 
+#ifdef cl_khr_fp64
+longV iterate_doubleV(doubleV x0, doubleV y0, double escape, int opts, longV active, doubleV *z2out, longV *cutout){
+    doubleV x = 0.;
+    doubleV y = 0.;
+    doubleV z2 = 0.;
+    longV n = 0;
+    longV cut = 0;
+
+    if (opts & CARDIOID_CHECK){
+        doubleV y2 = y0*y0;
+        doubleV xq = x0 - 0.25;
+        doubleV q = xq*xq + y2;
+        doubleV xb = x0 + 1.;
+        longV inside = active & ((q*(q + xq) < 0.25*y2) | (xb*xb + y2 < 0.0625));
+        n = select(n,(longV)MAXITER,inside);
+        cut = select(cut,(longV)1,inside);
+        active &= ~inside;
+    }
 
-//calculates the real-valued mandelbrot set (returns a real not an int) using double precision 
-__kernel void real_mandelbrot_double(__global float *out, __private double xmin, __private double dx, __private double ymin, __private double dy, __private int nx, __private int ny){
-    //coords of thhis kernel instance
-    int idx = get_global_id(1);
+    //the saved value of the orbit for the periodicity check
+    doubleV xold = 0.;
+    doubleV yold = 0.;
+    int period = 0;
+    int plimit = 1;
+
+    while (any(active)){
+        doubleV xn = x*x - y*y + x0;
+        doubleV yn = 2.*x*y + y0;
+        x = select(x,xn,active);
+        y = select(y,yn,active);
+        z2 = select(z2,x*x + y*y,active);
+        n -= active;
+
+        if (opts & PERIODICITY_CHECK){
+            longV periodic = active & (x == xold) & (y == yold);
+            n = select(n,(longV)MAXITER,periodic);
+            cut = select(cut,(longV)2,periodic);
+            active &= ~periodic;
+
+            period+=1;
+            if (period == plimit){
+                period = 0;
+                plimit *= 2;
+                xold = x;
+                yold = y;
+            }
+        }
+
+        active &= (z2 < escape) & (n < MAXITER);
+    }
+
+    *z2out = z2;
+    *cutout = cut;
+    return n;
+}
+#endif
+
+//adds the short-cuts taken by the lanes of a work-item to stats (with one atomic operation each, rather than one per pixel)
+void count_cuts(const int *cut, int npixels, __global int *stats){
+    int ncardioid = 0;
+    int nperiodic = 0;
+    for (int k=0; k<npixels; k++){
+        ncardioid += (cut[k] == 1);
+        nperiodic += (cut[k] == 2);
+    }
+    if (ncardioid) atomic_add(&stats[0],ncardioid);
+    if (nperiodic) atomic_add(&stats[1],nperiodic);
+}
+
+//The vector image kernels are launched with global size (ny, nx/WIDTH rounded up): work-item (idy, i) calculates the
+//pixels WIDTH*i ... WIDTH*i + WIDTH-1 of row idy (the lanes past the end of the row are not iterated)
+__kernel void mandelbrot_float_vector(__global int *out, __private float xmin, __private float dx, __private float ymin, __private float dy, __private int nx, __private int ny, __private int row0, __private int opts, __global int *stats){
+    int idx = get_global_id(1)*WIDTH;
     int idy = get_global_id(0);
-    
-    //get the x0 and y0 values
+    if (idx >= nx || idy >= ny) return;
+
+    intV i = idx + LANES;
+    floatV x0 = xmin + convert_floatV(i)*dx + (dx/2);
+    float y0 = ymin + (row0+idy)*dy + (dy/2);
+
+    floatV z2;
+    intV cut;
+    intV n = iterate_floatV(x0,(floatV)y0,4,opts,i < nx,&z2,&cut);
+
+    int nout[WIDTH], cutout[WIDTH];
+    vstoreV(n,0,nout);
+    vstoreV(cut,0,cutout);
+    int npixels = min(WIDTH,nx-idx);
+    for (int k=0; k<npixels; k++) out[idx + k + nx*idy] = nout[k];
+    count_cuts(cutout,npixels,stats);
+}
+
+#ifdef cl_khr_fp64
+__kernel void mandelbrot_double_vector(__global int *out, __private double xmin, __private double dx, __private double ymin, __private double dy, __private int nx, __private int ny, __private int row0, __private int opts, __global int *stats){
+    int idx = get_global_id(1)*WIDTH;
+    int idy = get_global_id(0);
+    if (idx >= nx || idy >= ny) return;
+
+    intV i = idx + LANES;
+    doubleV x0 = xmin + convert_doubleV(i)*dx + (dx/2);
+    double y0 = ymin + (row0+idy)*dy + (dy/2);
+
+    doubleV z2;
+    longV cut;
+    longV n = iterate_doubleV(x0,(doubleV)y0,4,opts,convert_longV(i < nx),&z2,&cut);
+
+    long nout[WIDTH], cutlong[WIDTH];
+    vstoreV(n,0,nout);
+    vstoreV(cut,0,cutlong);
+    int npixels = min(WIDTH,nx-idx);
+    int cutout[WIDTH];
+    for (int k=0; k<npixels; k++){
+        out[idx + k + nx*idy] = (int)nout[k];
+        cutout[k] = (int)cutlong[k];
+    }
+    count_cuts(cutout,npixels,stats);
+}
+#endif
+
+__kernel void real_mandelbrot_float_vector(__global float *out, __private float xmin, __private float dx, __private float ymin, __private float dy, __private int nx, __private int ny, __private int row0, __private int opts, __global int *stats){
+    int idx = get_global_id(1)*WIDTH;
+    int idy = get_global_id(0);
+    if (idx >= nx || idy >= ny) return;
+
+    intV i = idx + LANES;
+    floatV x0 = xmin + convert_floatV(i)*dx + (dx/2);
+    float y0 = ymin + (row0+idy)*dy + (dy/2);
+
+    floatV z2;
+    intV cut;
+    intV n = iterate_floatV(x0,(floatV)y0,100,opts,i < nx,&z2,&cut);
+
+    int nout[WIDTH], cutout[WIDTH];
+    float z2out[WIDTH];
+    vstoreV(n,0,nout);
+    vstoreV(cut,0,cutout);
+    vstoreV(z2,0,z2out);
+    int npixels = min(WIDTH,nx-idx);
+    for (int k=0; k<npixels; k++) out[idx + k + nx*idy] = smooth_float(nout[k],z2out[k]);
+    count_cuts(cutout,npixels,stats);
+}
+
+#ifdef cl_khr_fp64
+__kernel void real_mandelbrot_double_vector(__global float *out, __private double xmin, __private double dx, __private double ymin, __private double dy, __private int nx, __private int ny, __private int row0, __private int opts, __global int *stats){
+    int idx = get_global_id(1)*WIDTH;
+    int idy = get_global_id(0);
+    if (idx >= nx || idy >= ny) return;
+
+    intV i = idx + LANES;
+    doubleV x0 = xmin + convert_doubleV(i)*dx + (dx/2);
+    double y0 = ymin + (row0+idy)*dy + (dy/2);
+
+    doubleV z2;
+    longV cut;
+    longV n = iterate_doubleV(x0,(doubleV)y0,100,opts,convert_longV(i < nx),&z2,&cut);
+
+    long nout[WIDTH], cutlong[WIDTH];
+    double z2out[WIDTH];
+    vstoreV(n,0,nout);
+    vstoreV(cut,0,cutlong);
+    vstoreV(z2,0,z2out);
+    int npixels = min(WIDTH,nx-idx);
+    int cutout[WIDTH];
+    for (int k=0; k<npixels; k++){
+        out[idx + k + nx*idy] = smooth_double((int)nout[k],z2out[k]);
+        cutout[k] = (int)cutlong[k];
+    }
+    count_cuts(cutout,npixels,stats);
+}
+#endif
+
+#endif
+
+
+//The points kernels calculate only the pixels listed in index (as flat indices idx + nx*idy of the nx by ny image),
+//writing the value of pixel index[k] to out[k]. The coordinates are calculated exactly as in the kernels above,
+//so the values are identical to those of the full image.
+
+__kernel void mandelbrot_points_float(__global int *out, __global const int *index, __private float xmin, __private float dx, __private float ymin, __private float dy, __private int nx, __private int ny, __private int opts, __global int *stats){
+    int k = get_global_id(0);
+    int idx = index[k] % nx;
+    int idy = index[k] / nx;
+
+    float x0 = xmin + idx*dx + (dx/2);
+    float y0 = ymin + idy*dy + (dy/2);
+
+    float z2;
+    out[k] = iterate_float(x0,y0,4,opts,stats,&z2);
+}
+
+#ifdef cl_khr_fp64
+__kernel void mandelbrot_points_double(__global int *out, __global const int *index, __private double xmin, __private double dx, __private double ymin, __private double dy, __private int nx, __private int ny, __private int opts, __global int *stats){
+    int k = get_global_id(0);
+    int idx = index[k] % nx;
+    int idy = index[k] / nx;
+
     double x0 = xmin + idx*dx + (dx/2);
     double y0 = ymin + idy*dy + (dy/2);
 
-    double x = 0.;
-    double y = 0.;
+    double z2;
+    out[k] = iterate_double(x0,y0,4,opts,stats,&z2);
+}
+#endif
 
-    const float ln2 = log((float)2.);
+__kernel void real_mandelbrot_points_float(__global float *out, __global const int *index, __private float xmin, __private float dx, __private float ymin, __private float dy, __private int nx, __private int ny, __private int opts, __global int *stats){
+    int k = get_global_id(0);
+    int idx = index[k] % nx;
+    int idy = index[k] / nx;
 
-    int n=0;
+    float x0 = xmin + idx*dx + (dx/2);
+    float y0 = ymin + idy*dy + (dy/2);
 
-    // z_(n+1) = z_(n)^2 + (x0 + iy0)
+    float z2;
+    int n = iterate_float(x0,y0,100,opts,stats,&z2);
+    out[k] = smooth_float(n,z2);
+}
 
-    double z2 = x*x + y*y;
+#ifdef cl_khr_fp64
+__kernel void real_mandelbrot_points_double(__global float *out, __global const int *index, __private double xmin, __private double dx, __private double ymin, __private double dy, __private int nx, __private int ny, __private int opts, __global int *stats){
+    int k = get_global_id(0);
+    int idx = index[k] % nx;
+    int idy = index[k] / nx;
 
-    while(z2 < 100 && n<256){
-        //use this temporarily to hold the original x value
-        z2 = x;
-        
-        //update x and y
-        // (x+iy)^2 + x0 + iy0 = (x^2 - y^2 + x0) + (2*y*x + y0)i
-        x = x*x - y*y + x0;
-        y = 2*z2*y + y0;
+    double x0 = xmin + idx*dx + (dx/2);
+    double y0 = ymin + idy*dy + (dy/2);
 
-        z2 = x*x + y*y;
+    double z2;
+    int n = iterate_double(x0,y0,100,opts,stats,&z2);
+    out[k] = smooth_double(n,z2);
+}
+#endif
+
+__kernel void mandelbrot_points_floatfloat(__global int *out, __global const int *index, __private float xminhi, __private float xminlo, __private float dxhi, __private float dxlo, __private float yminhi, __private float yminlo, __private float dyhi, __private float dylo, __private int nx, __private int ny, __private int opts, __global int *stats){
+    int k = get_global_id(0);
+    int idx = index[k] % nx;
+    int idy = index[k] / nx;
+
+    float2 x0 = ff_add((float2)(xminhi,xminlo),ff_mul_float((float2)(dxhi,dxlo),idx + 0.5f));
+    float2 y0 = ff_add((float2)(yminhi,yminlo),ff_mul_float((float2)(dyhi,dylo),idy + 0.5f));
+
+    float z2;
+    out[k] = iterate_floatfloat(x0,y0,4,opts,stats,&z2);
+}
+
+__kernel void real_mandelbrot_points_floatfloat(__global float *out, __global const int *index, __private float xminhi, __private float xminlo, __private float dxhi, __private float dxlo, __private float yminhi, __private float yminlo, __private float dyhi, __private float dylo, __private int nx, __private int ny, __private int opts, __global int *stats){
+    int k = get_global_id(0);
+    int idx = index[k] % nx;
+    int idy = index[k] / nx;
+
+    float2 x0 = ff_add((float2)(xminhi,xminlo),ff_mul_float((float2)(dxhi,dxlo),idx + 0.5f));
+    float2 y0 = ff_add((float2)(yminhi,yminlo),ff_mul_float((float2)(dyhi,dylo),idy + 0.5f));
+
+    float z2;
+    int n = iterate_floatfloat(x0,y0,100,opts,stats,&z2);
+    out[k] = smooth_float(n,z2);
+}
+
+
+
+
+//Perturbation kernel for deep zooms beyond double precision. Each pixel is iterated as a small offset (delta)
+//from a high precision reference orbit Z (calculated on the host), so only the deltas need to fit in a double:
+//  delta_(n+1) = 2*Z_n*delta_n + delta_n^2 + dc
+//where dc is the offset of the pixel from the reference point. The first skip iterations are skipped using the
+//series approximation delta_skip = A*dc + B*dc^2 + C*dc^3. Pixels whose orbit gets too close to zero compared with
+//the reference orbit, or which outlive it, lose precision ("glitch") and are flagged so they can be recalculated
+//with a new reference.
+
+//output: out (the pixel values, as floats for both discrete and continuous images)
+//output: glitched (1 for glitched pixels, 0 otherwise)
+//inputs: index (the flat pixel indices idx + nx*idy to calculate)
+//inputs: Z, nref (the reference orbit Z_0 ... Z_nref)
+//inputs: A, B, C, skip (the series approximation coefficients at iteration skip)
+//inputs: dxmin, dx, dymin, dy (offset of the first pixel from the reference and the pixel size)
+//inputs: escape (escape radius squared), real (1 for the continuous set)
+
+#define GLITCH_TOLERANCE 1E-6
+
+#ifdef cl_khr_fp64
+__kernel void perturb_points_double(__global float *out, __global int *glitched, __global const int *index, __global const double2 *Z, __private int nref, __private double Ar, __private double Ai, __private double Br, __private double Bi, __private double Cr, __private double Ci, __private int skip, __private double dxmin, __private double dx, __private double dymin, __private double dy, __private int nx, __private double escape, __private int real){
+    int k = get_global_id(0);
+    int idx = index[k] % nx;
+    int idy = index[k] / nx;
+
+    //offset of this pixel from the reference point
+    double dcr = dxmin + (idx+0.5)*dx;
+    double dci = dymin + (idy+0.5)*dy;
+
+    //delta = ((C*dc + B)*dc + A)*dc
+    double tr = Cr*dcr - Ci*dci + Br;
+    double ti = Cr*dci + Ci*dcr + Bi;
+    double ur = tr*dcr - ti*dci + Ar;
+    double ui = tr*dci + ti*dcr + Ai;
+    double dr = ur*dcr - ui*dci;
+    double di = ur*dci + ui*dcr;
+
+    int n = skip;
+    double z2 = 0.;
+    int glitch = 0;
+
+    while(n < MAXITER){
+        //the reference has escaped (or ended) before this pixel
+        if (n >= nref){
+            glitch = 1;
+            break;
+        }
+
+        //delta = (2*Z_n + delta)*delta + dc
+        double2 Zn = Z[n];
+        double ar = 2*Zn.x + dr;
+        double ai = 2*Zn.y + di;
+        double nr = ar*dr - ai*di + dcr;
+        double ni = ar*di + ai*dr + dci;
+        dr = nr;
+        di = ni;
         n+=1;
-    }
 
+        //the full value of z for this pixel
+        Zn = Z[n];
+        double zr = Zn.x + dr;
+        double zi = Zn.y + di;
+        z2 = zr*zr + zi*zi;
+
+        if (z2 > escape) break;
 
-    if (n==256){
-        out[idx + nx*idy] = 256.;
+        if (z2 < GLITCH_TOLERANCE*(Zn.x*Zn.x + Zn.y*Zn.y)){
+            glitch = 1;
+            break;
+        }
+    }
+
+    glitched[k] = glitch;
+    //(glitched pixels have not escaped, so get their iteration count until they are recalculated)
+    if (real && !glitch){
+        out[k] = smooth_double(n,z2);
     } else {
-        out[idx + nx*idy] = (float) n + 2. - log(log((float)z2))/ln2;
+        out[k] = n;
+    }
+}
+#endif
+
+
+//Scalings applied to the image values before they are coloured (see scale in export.py)
+#define SCALE_LINEAR 0
+#define SCALE_LOG 1
+#define SCALE_SQRT 2
+#define SCALE_CBRT 3
+
+//Returns the colour (packed RGBA8) of the image value v: applies the scaling, maps vmin ... vmin + range to 0 ... 1 and
+//looks the result up in lut (ncolours colours) as matplotlib's colourmaps do. Values below the range (and NaNs) take
+//the first colour, values above it the last
+inline uint colour_value(float v, int scaling, float vmin, float range, __global const uint *lut, int ncolours){
+    if (scaling == SCALE_LOG){
+        v = log(v);
+    } else if (scaling == SCALE_SQRT){
+        v = sqrt(v);
+    } else if (scaling == SCALE_CBRT){
+        v = cbrt(v);
+    }
+
+    float x = (v - vmin)/range;
+    x *= ncolours;
+
+    int i = 0;
+    if (x >= ncolours){
+        i = ncolours-1;
+    } else if (x >= 0){
+        i = (int)x;
     }
-    
+    return lut[i];
+}
+
+//The colour kernels colour ny rows of an nx wide image (see colour_value), writing the colours with the rows in
+//reverse order, as PNGs are written from the top down and row 0 is the bottom of the image
+
+//Colours a discrete image
+__kernel void colour_int(__global uint *out, __global const int *in, __private int nx, __private int ny, __private int scaling, __private float vmin, __private float range, __global const uint *lut, __private int ncolours){
+    int idx = get_global_id(1);
+    int idy = get_global_id(0);
+
+    out[idx + nx*(ny-1-idy)] = colour_value((float)in[idx + nx*idy],scaling,vmin,range,lut,ncolours);
+}
+
+//Colours a continuous image
+__kernel void colour_float(__global uint *out, __global const float *in, __private int nx, __private int ny, __private int scaling, __private float vmin, __private float range, __global const uint *lut, __private int ncolours){
+    int idx = get_global_id(1);
+    int idy = get_global_id(0);
 
+    out[idx + nx*(ny-1-idy)] = colour_value(in[idx + nx*idy],scaling,vmin,range,lut,ncolours);
 }
@@ -1,23 +1,197 @@
-import pyopencl as cl
 import numpy as np
 import time
 import sys
-import numba
-import matplotlib.pyplot as plt
 import os
+import hashlib
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+
+from .buffers import BufferPool, Readback
+from . import metrics
 
 nx = 1000
 ny = 1000
 
 
+#maximum number of iterations the kernels run for before a point is deemed to be in the set
+maxiter = 256
+
+#short-cuts the kernels can take for points in the set (these must match the defines in mandelbrot.cl)
+#skip points inside the main cardioid or the period-2 bulb
+cardioid_check = 1
+#stop iterating points whose orbit has become periodic
+periodicity_check = 2
+
+#The precisions the kernels calculate in, as passed in the double argument of the calculate functions: single (False),
+#double (True), or float-float (floatfloat), which represents each coordinate as the sum of two floats (see
+#mandelbrot.cl), giving nearly double precision on devices without it
+floatfloat = "floatfloat"
+
+#pixels whose |z|^2 falls below this fraction of the reference orbit's |Z|^2 are glitched in the perturbation kernels
+glitch_tolerance = 1E-6
+
+#the passes of a progressive calculation, as the spacing (in pixels) of the samples calculated by each pass
+progressive_steps = (8, 4, 2, 1)
+
+#raised by a calculation that was abandoned because its Mandelbrot object's cancel event was set
+class Cancelled(Exception):
+    pass
+
+#size (in pixels) of the square tiles the Numba and NumPy fallbacks split the image into
+tilesize = 64
+
+#directory built OpenCL programs are cached in between runs (None to always build them from source)
+program_cache = os.path.join(".pyfractalcache","programs")
+
+#if True, the launch configuration of the image kernels is tuned for each device (see tuning.py)
+autotune = True
+
+#the platform number of the NumPy fallback (see npkernels.py), for when neither OpenCL nor Numba is available. Platform
+#-1 is the Numba fallback, and -2 every OpenCL device (see multidevice.py)
+numpy_platform = -3
+
+
+#returns the name of the precision double (see floatfloat) in the kernel names: "float", "double" or "floatfloat"
+def precision_name(double):
+    if double == floatfloat:
+        return "floatfloat"
+    return "double" if double else "float"
+
+#returns the kernel arguments giving the coordinates xmin, dx, ymin and dy in the precision double. Float-float kernels
+#take the high and low parts of each
+def coordinates(double,xmin,dx,ymin,dy):
+    if double == floatfloat:
+        return tuple(part for v in (xmin,dx,ymin,dy) for part in split_floatfloat(v))
+    elif double:
+        return (np.float64(xmin),np.float64(dx),np.float64(ymin),np.float64(dy))
+    return (np.float32(xmin),np.float32(dx),np.float32(ymin),np.float32(dy))
+
+#returns the float-float (hi, lo) nearest to x: hi is x rounded to a float, and lo the rest rounded to a float
+def split_floatfloat(x):
+    hi = np.float32(x)
+    return hi, np.float32(x-np.float64(hi))
+
+
+#returns a string identifying device and its driver, so that anything cached for the device is redone if either changes
+def device_key(device):
+    return "|".join([device.platform.name,device.name,device.version,device.driver_version])
+
+
+#Builds the OpenCL program source for device with the build options, loading its binary from the program cache if it
+#has been built before (and saving it there if not). Binaries are keyed by the device, its driver version, the source
+#and the options, so updating the driver or changing the kernels builds the program afresh
+def build_program(context,device,source,options):
+    import pyopencl as cl
+    key = "\0".join([device_key(device),source]+options)
+    fname = None
+    if program_cache is not None:
+        fname = os.path.join(program_cache,hashlib.sha256(key.encode()).hexdigest()+".bin")
+        if os.path.exists(fname):
+            try:
+                with open(fname,"rb") as f:
+                    binary = f.read()
+                return cl.Program(context,[device],[binary]).build(options=options)
+            except (OSError, cl.Error) as e:
+                print("Could not load cached OpenCL program %s: %s"%(fname,e))
+
+    print("Building OpenCL program (%s)"%" ".join(options))
+    program = cl.Program(context,source).build(options=options)
+
+    if fname is not None:
+        try:
+            os.makedirs(program_cache,exist_ok=True)
+            with open(fname+".tmp","wb") as f:
+                f.write(program.get_info(cl.program_info.BINARIES)[0])
+            os.replace(fname+".tmp",fname)
+        except (OSError, cl.Error) as e:
+            print("Could not cache OpenCL program %s: %s"%(fname,e))
+    return program
+
+
+#The OpenCL context of a device, with its command queues and the programs built for it. These are shared by every
+#Mandelbrot object on the device (see shared_context), so changing device and back, or making another Mandelbrot object,
+#neither sets the device up nor builds its programs again
+class SharedContext():
+    def __init__(self,device):
+        import pyopencl as cl
+        self.context = cl.Context(devices=[device])
+
+        #set up command queue
+        self.queue = cl.CommandQueue(self.context,properties=cl.command_queue_properties.PROFILING_ENABLE)
+
+        #images are read back on a second queue, so the copy of one frame overlaps the calculation of the next
+        self.copy_queue = cl.CommandQueue(self.context,properties=cl.command_queue_properties.PROFILING_ENABLE)
+
+        #read program source
+        curpath = os.path.dirname(os.path.abspath(__file__))
+        with open(os.path.join(curpath,"mandelbrot.cl"),"r") as f:
+            self.source = f.read()
+
+        #programs built so far, by iteration budget and vector width
+        self.programs = {}
+
+        #the tuned launch configuration of the image kernels (see Mandelbrot.launchConfig), by precision
+        self.tuning = {}
+
+#shared contexts by (platform, device) index
+_contexts = {}
+
+#returns the SharedContext of device (the device with index device on platform index platform), setting it up if
+#this is the first time it is used
+def shared_context(platform,device,d):
+    if (platform, device) not in _contexts:
+        _contexts[(platform, device)] = SharedContext(d)
+    return _contexts[(platform, device)]
+
+
 class Mandelbrot():
-    def __init__(self,platform=0,device=2):
-        #If the platform is < 0 we request to use the fallback
+    def __init__(self,platform=0,device=2,nthreads=None,shortcuts=cardioid_check|periodicity_check):
+        #which short-cuts to take for points in the set. These never change the result, so can be
+        #switched off (shortcuts=0) to compare the output against the full calculation
+        self.shortcuts = shortcuts
+
+        #if True, calculate and calculate_real use boundary subdivision (see subdivide.py), only calculating the
+        #borders of rectangles and filling in those with uniform borders. subdivide_tolerance is how much the
+        #border of a continuous image may vary and still be filled in (0 gives exactly the same image)
+        self.subdivide = False
+        self.subdivide_tolerance = 0.
+
+        #number of pixels calculated and short-circuited by the last calculation
+        self.stats = {"pixels": 0, "cardioid": 0, "periodic": 0}
+
+        #a threading.Event which, when set, abandons the calculation in progress (raising Cancelled) at the next
+        #tile, subdivision level or reference orbit. This lets a render thread drop frames nobody wants any more
+        self.cancel = None
+
+        #number of CPU threads used by the fallback (None uses all cores), and the size of the tiles it splits images into
+        if nthreads is None:
+            nthreads = os.cpu_count()
+        self.nthreads = max(1,nthreads)
+        self.tilesize = tilesize
+
+        #If the platform is < 0 we request to use the fallback: Numba (platform -1), or NumPy (platform numpy_platform,
+        #or if Numba is not installed)
         if platform < 0:
             self.fallback = True
-            print("Using Numba Python fallback")
+            #the fallback always calculates in double precision
+            self.double_precision = True
+            self.backend = "numba"
+            if platform != numpy_platform:
+                try:
+                    import numba
+                except ImportError:
+                    print("Numba is not installed")
+                    platform = numpy_platform
+            if platform == numpy_platform:
+                from .npkernels import tilesize as numpy_tilesize
+                self.backend = "numpy"
+                self.tilesize = numpy_tilesize
+                print("Using NumPy fallback (%d threads)"%self.nthreads)
+            else:
+                print("Using Numba Python fallback (%d threads)"%self.nthreads)
         #setup OpenCL
         else: 
+            import pyopencl as cl
             self.fallback = False
             #get platform
             platforms = cl.get_platforms()
@@ -38,196 +212,492 @@ class Mandelbrot():
             print("Using device %s"%d.get_info(cl.device_info.NAME))
 
             self.device=d
-            
-            #set up context 
-            self.context = cl.Context(devices=[self.device])
-        
-            #set up command queue
-            self.queue = cl.CommandQueue(self.context,properties=cl.command_queue_properties.PROFILING_ENABLE)
-            
-            curpath = os.path.dirname(os.path.abspath(__file__))
+            self.backend = "opencl:"+d.get_info(cl.device_info.NAME).strip()
 
-            #read program source
-            f=open(os.path.join(curpath,"mandelbrot.cl"),"r")
-            src=f.read()
-            f.close()
+            #whether the device supports double precision
+            self.double_precision = d.get_info(cl.device_info.PREFERRED_VECTOR_WIDTH_DOUBLE) > 0
             
-            #create program
-            self.program = cl.Program(self.context,src)
-            self.program.build()
-        
-
-
-
-    def calculate(self,xmin=-2,xmax=1,ymin=-1.5,ymax=1.5,double=False,nx=1000,ny=1000):
+            #the context, queues and programs, shared with any other Mandelbrot objects on the device
+            shared = shared_context(platform,device,d)
+            self.context = shared.context
+            self.queue = shared.queue
+            self.copy_queue = shared.copy_queue
+            self.source = shared.source
+            self.programs = shared.programs
+            self.tuning = shared.tuning
+            self.autotune = autotune
+
+            #device and pinned host buffers reused between calculations
+            self.pool = BufferPool(self.context,self.queue)
+
+            #the kernels retrieved from the programs (retrieving a kernel creates a new kernel object each time, so they
+            #are kept rather than looked up every frame. They hold their arguments, so are not shared)
+            self.kernels = {}
+
+    #Returns the OpenCL program specialised for an iteration budget of niter (which is compiled in with the MAXITER
+    #define, so the compiler can optimise for it), with vector kernels calculating width pixels per work-item if width
+    #is more than 1. Programs are built (or loaded from the program cache) the first time they are needed and then kept
+    def getProgram(self,niter,width=1):
+        if (niter, width) not in self.programs:
+            options = ["-DMAXITER=%d"%niter]
+            if width > 1:
+                options.append("-DWIDTH=%d"%width)
+            self.programs[(niter, width)] = build_program(self.context,self.device,self.source,options)
+        return self.programs[(niter, width)]
+
+    #Returns the kernels of the fallback (the Numba kernels, or the NumPy kernels of the NumPy backend, which have the
+    #same names and arguments) for an iteration budget of niter
+    def fallbackKernels(self,niter):
+        if self.backend == "numpy":
+            from .npkernels import numpy_kernels
+            return numpy_kernels(niter)
+        return numba_kernels(niter)
+
+    #raises Cancelled if the calculation in progress should be abandoned
+    def checkCancel(self):
+        if self.cancel is not None and self.cancel.is_set():
+            raise Cancelled()
+
+    #Returns the kernel called name from the program for an iteration budget of niter (and vector width width)
+    def getKernel(self,name,niter,width=1):
+        if (name,niter,width) not in self.kernels:
+            import pyopencl as cl
+            self.kernels[(name,niter,width)] = cl.Kernel(self.getProgram(niter,width),name)
+        return self.kernels[(name,niter,width)]
+
+    #Returns the launch configuration (width, local) of the image kernels in the precision double: the number of
+    #pixels each work-item calculates and the work-group shape (None leaves it to the driver). If autotune is set, this
+    #is tuned for the device the first time it is needed (see tuning.py), otherwise it is one pixel per work-item
+    def launchConfig(self,double):
+        precision = precision_name(double)
+        if precision not in self.tuning:
+            if not self.autotune:
+                return 1, None
+            from .tuning import tune
+            self.tuning[precision] = tune(self,double)
+        return self.tuning[precision]
+
+    #Queues the image kernel name ("mandelbrot" or "real_mandelbrot") calculating rows row0 ... row0+ny-1 of the nx
+    #wide view into buf, with width pixels per work-item in work-groups of shape local (see launchConfig), and the
+    #short-cut counts into statsBuf. Returns the kernel's event
+    def launch(self,name,buf,xmin,dx,ymin,dy,nx,ny,row0,double,maxiter,statsBuf,width=1,local=None):
+        name += "_"+precision_name(double)
+        coords = coordinates(double,xmin,dx,ymin,dy)
+        if width > 1:
+            name += "_vector"
+
+        #round the global size up to whole work-groups (the kernels ignore the work-items past the edges)
+        size = [ny, (nx+width-1)//width]
+        if local is not None:
+            size = [(n+l-1)//l*l for n, l in zip(size,local)]
+
+        kernel = self.getKernel(name,maxiter,width)
+        return kernel(self.queue,tuple(size),local,buf,*coords,np.int32(nx),np.int32(ny),np.int32(row0),np.int32(self.shortcuts),statsBuf)
+
+    #describes a calculation for the metrics (see metrics.py)
+    def describe(self,real,double,maxiter):
+        if double == floatfloat and self.backend != "numpy":
+            precision = "float-float"
+        else:
+            precision = "double" if double or self.fallback else "single"
+        return {"backend": self.backend, "precision": precision,
+                "kind": "continuous" if real else "discrete", "maxiter": maxiter}
+
+    #maxiter is the iteration budget (see choose_maxiter)
+    def calculate(self,xmin=-2,xmax=1,ymin=-1.5,ymax=1.5,double=False,nx=1000,ny=1000,maxiter=maxiter):
+        return self.calculate_async(xmin,xmax,ymin,ymax,real=False,double=double,nx=nx,ny=ny,maxiter=maxiter).result()
+
+    #maxiter is the iteration budget (see choose_maxiter)
+    def calculate_real(self,xmin=-2,xmax=1,ymin=-1.5,ymax=1.5,double=False,nx=1000,ny=1000,maxiter=maxiter):
+        return self.calculate_async(xmin,xmax,ymin,ymax,real=True,double=double,nx=nx,ny=ny,maxiter=maxiter).result()
+
+    #Starts calculating the discrete (real=False) or continuous (real=True) image of the view and returns a Readback
+    #(see buffers.py) whose result() is the image. On OpenCL devices this returns as soon as the kernel and the copy back
+    #to pinned host memory are queued, so the caller can queue the next frame (whose calculation then overlaps this
+    #frame's copy) before collecting this one. The Numba fallback and boundary subdivision calculate the image before returning.
+    #If rows = (j0, j1) is given, only the rows j0 <= j < j1 of the nx by ny image are calculated (as a (j1-j0, nx) image)
+    def calculate_async(self,xmin=-2,xmax=1,ymin=-1.5,ymax=1.5,real=False,double=False,nx=1000,ny=1000,maxiter=maxiter,rows=None):
+        if real:
+            dtype = np.float32
+        else:
+            dtype = np.int32
 
         dx = (xmax-xmin)/nx
         dy = (ymax-ymin)/ny
+
+        if rows is None:
+            rows = (0, ny)
+        j0, j1 = rows
+
+        if self.subdivide:
+            from .subdivide import subdivide
+            tolerance = self.subdivide_tolerance if real else 0.
+            return Readback(self,img=subdivide(self,xmin,xmax,ymin+j0*dy,ymin+j1*dy,real=real,double=double,nx=nx,ny=j1-j0,tolerance=tolerance,maxiter=maxiter))
+        ny = j1-j0
         
         #use the python fallback
         if self.fallback:
-            print('Calculating discrete mandelbrot set (Numba fallback)')
-            tstart = time.time()
-            img = int_mandelbrot(xmin,dx, ymin,dy,nx,ny)
-            tstop = time.time()
-            print("Time taken = %fms"%((tstop-tstart)*1000))
-            return img
-
-        #create data buffers
-        img = np.zeros(nx*ny,np.int32)
-        imgBuf = cl.Buffer(self.context,cl.mem_flags.WRITE_ONLY,img.nbytes)
+            kernels = self.fallbackKernels(maxiter)
+            if double == floatfloat:
+                kernel = kernels.real_mandelbrot_tile_floatfloat if real else kernels.int_mandelbrot_tile_floatfloat
+                coords = [split_floatfloat(v) for v in (xmin,dx,ymin+j0*dy,dy)]
+            else:
+                kernel = kernels.real_mandelbrot_tile if real else kernels.int_mandelbrot_tile
+                coords = (xmin,dx,ymin+j0*dy,dy)
+            tstart = time.perf_counter()
+            img, stats = tiled_mandelbrot(kernel,dtype,*coords,nx,ny,nthreads=self.nthreads,tile=self.tilesize,opts=self.shortcuts,cancel=self.cancel)
+            self.report(nx*ny,stats)
+            if metrics.active:
+                self.measure(img,stats,tstart,self.describe(real,double,maxiter))
+            return Readback(self,img=img)
+
+        import pyopencl as cl
+        self.checkCancel()
+
+        slot = self.pool.acquire(nx*ny*np.dtype(dtype).itemsize)
+        cl.enqueue_fill_buffer(self.queue,slot.statsBuf,np.int32(0),0,slot.stats.nbytes)
+
+        if real:
+            name = "real_mandelbrot"
+        else:
+            name = "mandelbrot"
 
-        
         #run kernel on GPU
-        if double == False:
-            print("Calculating discrete mandelbrot set using single precision numbers")
-            event=self.program.mandelbrot_float(self.queue,(nx,ny),None,imgBuf,np.float32(xmin),np.float32(dx),np.float32(ymin),np.float32(dy),np.int32(nx),np.int32(ny))
+        width, local = self.launchConfig(double)
+        event = self.launch(name,slot.device,xmin,dx,ymin,dy,nx,ny,j0,double,maxiter,slot.statsBuf,width,local)
+        self.queue.flush()
+
+        #read the image back into pinned memory once the kernel has finished, without waiting for it here
+        #(the image is copied last, so once it has arrived so have the short-cut counts)
+        cl.enqueue_copy(self.copy_queue,slot.stats,slot.statsBuf,wait_for=[event],is_blocking=False)
+        copyevt=cl.enqueue_copy(self.copy_queue,slot.host,slot.device,wait_for=[event],is_blocking=False)
+        self.copy_queue.flush()
+
+        return Readback(self,slot=slot,event=event,copyevt=copyevt,shape=(ny,nx),dtype=dtype,fields=self.describe(real,double,maxiter))
+
+    #Starts colouring img (rows of a discrete or continuous image) for writing to a PNG: applies scaling (see
+    #export.scale), maps vmin ... vmax to the colours of table (packed RGBA8 colours, see export.colour_table) as
+    #matplotlib's colourmaps do, and reverses the rows so they run from the top down. Returns a Readback whose result()
+    #is the colours (a uint32 per pixel). On OpenCL devices the colour kernels do this, and it returns as soon as they
+    #and the copy back are queued, so the next rows can be queued before these are collected
+    def colour_async(self,img,scaling,vmin,vmax,table):
+        from .export import scalings, colour_rows
+        if self.fallback:
+            with metrics.timer("colour",backend=self.backend):
+                return Readback(self,img=colour_rows(img,scaling,vmin,vmax,table))
+
+        import pyopencl as cl
+        ny, nx = img.shape
+        if img.dtype == np.int32:
+            name = "colour_int"
         else:
-            print("Calculating discrete mandelbrot set using double precision numbers")
-            event=self.program.mandelbrot_double(self.queue,(nx,ny),None,imgBuf,np.float64(xmin),np.float64(dx),np.float64(ymin),np.float64(dy),np.int32(nx),np.int32(ny))
-        
-        
-        #wait for it to complete
-        event.wait()
+            name = "colour_float"
+            img = img.astype(np.float32,copy=False)
+        inBuf = cl.Buffer(self.context,cl.mem_flags.READ_ONLY|cl.mem_flags.COPY_HOST_PTR,hostbuf=np.ascontiguousarray(img))
+        lutBuf = cl.Buffer(self.context,cl.mem_flags.READ_ONLY|cl.mem_flags.COPY_HOST_PTR,hostbuf=table)
+
+        slot = self.pool.acquire(nx*ny*4)
+        vmin = np.float32(vmin)
+        event = self.getKernel(name,maxiter)(self.queue,(ny,nx),None,slot.device,inBuf,np.int32(nx),np.int32(ny),np.int32(scalings.index(scaling)),vmin,np.float32(vmax)-vmin,lutBuf,np.int32(len(table)))
+        self.queue.flush()
+
+        copyevt = cl.enqueue_copy(self.copy_queue,slot.host,slot.device,wait_for=[event],is_blocking=False)
+        self.copy_queue.flush()
+
+        return Readback(self,slot=slot,event=event,copyevt=copyevt,shape=(ny,nx),dtype=np.uint32,report=False,stage="colour",fields={"backend": self.backend})
+
+    #Calculates the image progressively, coarse to fine. Each pass calculates every steps[k]-th pixel in x and y
+    #(the first pass with steps=(8,4,2,1) is 1/8 resolution), skipping the pixels earlier passes already calculated,
+    #so all the passes together cost the same as calculating the image once. Yields (step, img) after each pass, where
+    #img is the nx by ny image with each sample filling the step by step block of pixels above and to its right.
+    #The last pass (step 1) gives exactly the same image as calculate/calculate_real
+    def calculate_progressive(self,xmin=-2,xmax=1,ymin=-1.5,ymax=1.5,real=False,double=False,nx=1000,ny=1000,maxiter=maxiter,steps=progressive_steps):
+        if real:
+            dtype = np.float32
+        else:
+            dtype = np.int32
 
-        copyevt=cl.enqueue_copy(self.queue,img,imgBuf)
+        values = np.zeros((ny,nx),dtype=dtype)
+        done = np.zeros((ny,nx),dtype=np.bool_)
 
-        img = img.reshape((nx,ny))
-        try:
-            tstart=event.get_profiling_info(cl.profiling_info.START)
-            tstop = event.get_profiling_info(cl.profiling_info.END)
-            print("Kernel execution time = %f ms"%((tstop-tstart)/1E6))
-
-            tstart=copyevt.get_profiling_info(cl.profiling_info.START)
-            tstop = copyevt.get_profiling_info(cl.profiling_info.END)
-            print("Copy time = %f ms"%((tstop-tstart)/1E6))
-        except cl._cl.RuntimeError as e:
-            print(e)
-        
-        return img
+        for step in steps:
+            self.checkCancel()
+
+            new = np.zeros((ny,nx),dtype=np.bool_)
+            new[::step,::step] = True
+            new &= ~done
+            done |= new
+
+            index = np.flatnonzero(new)
+            values.flat[index] = self.calculate_points(index,xmin,xmax,ymin,ymax,real=real,double=double,nx=nx,ny=ny,maxiter=maxiter)
 
-    def calculate_real(self,xmin=-2,xmax=1,ymin=-1.5,ymax=1.5,double=False,nx=1000,ny=1000):
+            if step == 1:
+                yield step, values
+            else:
+                coarse = values[::step,::step]
+                yield step, np.repeat(np.repeat(coarse,step,axis=0),step,axis=1)[:ny,:nx]
+
+    #Calculates only the pixels of the nx by ny image of the view whose flat indices (i + nx*j) are in index.
+    #Returns a 1D array with the value of each of these pixels, identical to the values calculate/calculate_real give them
+    def calculate_points(self,index,xmin=-2,xmax=1,ymin=-1.5,ymax=1.5,real=False,double=False,nx=1000,ny=1000,maxiter=maxiter):
+        return self.calculate_points_async(index,xmin,xmax,ymin,ymax,real=real,double=double,nx=nx,ny=ny,maxiter=maxiter).result()
+
+    #Starts calculating the pixels listed in index (see calculate_points) and returns a Readback whose result() is
+    #their values. As with calculate_async, on OpenCL devices this returns as soon as the kernel and the copy back are
+    #queued, so the next batch of points can be queued before this one is collected
+    def calculate_points_async(self,index,xmin=-2,xmax=1,ymin=-1.5,ymax=1.5,real=False,double=False,nx=1000,ny=1000,maxiter=maxiter):
         
         dx = (xmax-xmin)/nx
         dy = (ymax-ymin)/ny
-        
-        #use the python fallback
-        if self.fallback:
-            print('Calculating continuous mandelbrot set (Numba fallback)')
-            tstart = time.time()
-            img = real_mandelbrot(xmin,dx, ymin,dy,nx,ny)
-            tstop = time.time()
-            print("Time taken = %fms"%((tstop-tstart)*1000))
-            return img
 
-        rimg = np.zeros(nx*ny,dtype=np.float32)
-        rimgBuf = cl.Buffer(self.context,cl.mem_flags.WRITE_ONLY,rimg.nbytes)
+        index = np.ascontiguousarray(index,dtype=np.int32)
+        npoints = len(index)
 
-        
-        #run kernel on GPU
-        if double == False:
-            print("Calculating continuous mandelbrot set using single precision numbers")
-            event=self.program.real_mandelbrot_float(self.queue,(nx,ny),None,rimgBuf,np.float32(xmin),np.float32(dx),np.float32(ymin),np.float32(dy),np.int32(nx),np.int32(ny))
+        if real:
+            dtype = np.float32
         else:
-            print("Calculating continuous mandelbrot set using double precision numbers")
-            event=self.program.real_mandelbrot_double(self.queue,(nx,ny),None,rimgBuf,np.float64(xmin),np.float64(dx),np.float64(ymin),np.float64(dy),np.int32(nx),np.int32(ny))
+            dtype = np.int32
         
+        if npoints == 0:
+            return Readback(self,img=np.zeros(0,dtype=dtype))
+
+        tstart = time.perf_counter()
+
+        #use the python fallback
+        if self.fallback:
+            kernels = self.fallbackKernels(maxiter)
+            if double == floatfloat:
+                kernel = kernels.real_mandelbrot_points_floatfloat if real else kernels.int_mandelbrot_points_floatfloat
+                coords = [split_floatfloat(v) for v in (xmin,dx,ymin,dy)]
+            else:
+                kernel = kernels.real_mandelbrot_points if real else kernels.int_mandelbrot_points
+                coords = (xmin,dx,ymin,dy)
+            values, stats = points_mandelbrot(kernel,dtype,index,*coords,nx,nthreads=self.nthreads,tile=self.tilesize,opts=self.shortcuts,cancel=self.cancel)
+            self.report(npoints,stats)
+            if metrics.active:
+                self.measure(values,stats,tstart,self.describe(real,double,maxiter))
+            return Readback(self,img=values)
+
+        import pyopencl as cl
+        self.checkCancel()
+
+        slot = self.pool.acquire(npoints*np.dtype(dtype).itemsize)
+        cl.enqueue_fill_buffer(self.queue,slot.statsBuf,np.int32(0),0,slot.stats.nbytes)
+        indexBuf = cl.Buffer(self.context,cl.mem_flags.READ_ONLY|cl.mem_flags.COPY_HOST_PTR,hostbuf=index)
+
+        if real:
+            name = "real_mandelbrot_points"
+        else:
+            name = "mandelbrot_points"
+        kernel = self.getKernel(name+"_"+precision_name(double),maxiter)
+        event = kernel(self.queue,(npoints,),None,slot.device,indexBuf,*coordinates(double,xmin,dx,ymin,dy),np.int32(nx),np.int32(ny),np.int32(self.shortcuts),slot.statsBuf)
+        self.queue.flush()
+
+        cl.enqueue_copy(self.copy_queue,slot.stats,slot.statsBuf,wait_for=[event],is_blocking=False)
+        copyevt = cl.enqueue_copy(self.copy_queue,slot.host,slot.device,wait_for=[event],is_blocking=False)
+        self.copy_queue.flush()
+
+        return Readback(self,slot=slot,event=event,copyevt=copyevt,shape=(npoints,),dtype=dtype,fields=self.describe(real,double,maxiter))
+
+    #Calculates a deep zoom using perturbation theory (see perturbation.py). The view is
+    #xorigin + xmin ... xorigin + xmax, yorigin + ymin ... yorigin + ymax, where xorigin and yorigin are exact
+    #(decimal.Decimal) values and xmin ... ymax are floats, so views far smaller than double precision can resolve
+    #can be described. Returns the image like calculate/calculate_real
+    def calculate_deep(self,xorigin,yorigin,xmin=-2,xmax=1,ymin=-1.5,ymax=1.5,real=False,nx=1000,ny=1000,maxiter=maxiter):
+        from .perturbation import deep_mandelbrot
+        return deep_mandelbrot(self,xorigin,yorigin,xmin,xmax,ymin,ymax,real=real,nx=nx,ny=ny,maxiter=maxiter)
+
+    #Calculates only the pixels of the deep zoom image (see calculate_deep) whose flat indices (i + nx*j) are in index.
+    #Returns a 1D array with the value of each of these pixels, like calculate_points
+    def calculate_deep_points(self,index,xorigin,yorigin,xmin=-2,xmax=1,ymin=-1.5,ymax=1.5,real=False,nx=1000,ny=1000,maxiter=maxiter):
+        from .perturbation import deep_points
+        return deep_points(self,index,xorigin,yorigin,xmin,xmax,ymin,ymax,real=real,nx=nx,ny=ny,maxiter=maxiter)
+
+    #Runs the perturbation kernel on the pixels in index (flat indices i + nx*j). Z[0:nref+1] is the reference
+    #orbit, A, B, C the series approximation coefficients at iteration skip, and (dxmin, dymin) the offset of
+    #pixel (0, 0) from the reference point. Returns the pixel values (floats) and a boolean array flagging
+    #glitched pixels. Uses the Numba fallback if the device has no double precision
+    def calculate_perturbed(self,index,Z,nref,A,B,C,skip,dxmin,dx,dymin,dy,nx,real=False,maxiter=maxiter):
         
-        #wait for it to complete
-        event.wait()
+        escape = 100. if real else 4.
 
-        copyevt=cl.enqueue_copy(self.queue,rimg,rimgBuf)
+        index = np.ascontiguousarray(index,dtype=np.int32)
+        npoints = len(index)
 
-        rimg = rimg.reshape((nx,ny))
+        if self.fallback or not self.double_precision:
+            values = np.zeros(npoints,dtype=np.float32)
+            glitched = np.zeros(npoints,dtype=np.bool_)
 
-        try:
-            tstart=event.get_profiling_info(cl.profiling_info.START)
-            tstop = event.get_profiling_info(cl.profiling_info.END)
-            print("Kernel execution time = %f ms"%((tstop-tstart)/1E6))
+            chunk = self.tilesize*self.tilesize
+            chunks = [(k0,min(k0+chunk,npoints)) for k0 in range(0,npoints,chunk)]
 
-            tstart=copyevt.get_profiling_info(cl.profiling_info.START)
-            tstop = copyevt.get_profiling_info(cl.profiling_info.END)
-            print("Copy time = %f ms"%((tstop-tstart)/1E6))
-        except cl._cl.RuntimeError as e:
-            print(e)
+            def run(c):
+                return self.fallbackKernels(maxiter).perturb_points(values,glitched,index,Z,nref,A,B,C,skip,dxmin,dx,dymin,dy,nx,escape,real,c[0],c[1])
 
-        # print(rimg.max(), rimg.min())
-        
-        return rimg
+            run_dynamic(chunks,run,self.nthreads,self.cancel)
 
-@numba.jit(nopython=True)
-def int_mandelbrot(xmin, dx, ymin, dy, nx, ny):
-    out = np.zeros((ny,nx),dtype=np.int32)
+            return values, glitched
 
-    for j in range(ny):
-        y0 = ymin + (j+0.5)*dy
-        for i in range(nx):
-            n=0
+        import pyopencl as cl
+        Z = np.ascontiguousarray(Z,dtype=np.complex128)
 
-            x=0.
-            y=0.
+        values = np.zeros(npoints,dtype=np.float32)
+        glitched = np.zeros(npoints,dtype=np.int32)
+        valuesBuf = cl.Buffer(self.context,cl.mem_flags.WRITE_ONLY,values.nbytes)
+        glitchedBuf = cl.Buffer(self.context,cl.mem_flags.WRITE_ONLY,glitched.nbytes)
+        indexBuf = cl.Buffer(self.context,cl.mem_flags.READ_ONLY|cl.mem_flags.COPY_HOST_PTR,hostbuf=index)
+        ZBuf = cl.Buffer(self.context,cl.mem_flags.READ_ONLY|cl.mem_flags.COPY_HOST_PTR,hostbuf=Z)
 
-            x0 = xmin + (i+0.5)*dx
-            
+        event = self.getKernel("perturb_points_double",maxiter)(self.queue,(npoints,),None,valuesBuf,glitchedBuf,indexBuf,ZBuf,np.int32(nref),
+                                                   np.float64(A.real),np.float64(A.imag),np.float64(B.real),np.float64(B.imag),np.float64(C.real),np.float64(C.imag),
+                                                   np.int32(skip),np.float64(dxmin),np.float64(dx),np.float64(dymin),np.float64(dy),np.int32(nx),np.float64(escape),np.int32(real))
+        event.wait()
 
-            while(n < 256):
-                n+=1
+        cl.enqueue_copy(self.queue,values,valuesBuf)
+        cl.enqueue_copy(self.queue,glitched,glitchedBuf)
+
+        return values, glitched.astype(np.bool_)
+
+    #records how many of the pixels were short-circuited by the cardioid/bulb and periodicity checks
+    def report(self,npixels,stats):
+        self.stats = {"pixels": npixels, "cardioid": int(stats[0]), "periodic": int(stats[1])}
+
+    #records the time taken by a calculation of values (an image or the values of points) started at tstart on the
+    #host, and its counters, in the metrics (see metrics.py). fields describe the calculation
+    def measure(self,values,stats,tstart,fields):
+        seconds = time.perf_counter()-tstart
+        metrics.record("kernel",tstart,seconds,**fields)
+        metrics.count(values.size,metrics.iterations(values,fields["maxiter"]),seconds,cardioid=int(stats[0]),periodic=int(stats[1]),**fields)
+
+#Returns the Numba kernels for an iteration budget of niter (see kernels.py, which is only imported, along with numba,
+#when the kernels are first needed)
+def numba_kernels(niter=maxiter):
+    from .kernels import numba_kernels
+    return numba_kernels(niter)
+
+
+#smallest and largest iteration budgets choose_maxiter will pick
+min_maxiter = 256
+max_maxiter = 65536
+
+#Chooses the iteration budget for a view of the given width. Deeper views need more iterations before the
+#detail near the set escapes, so the budget grows with the zoom depth. If the previous frame (img, calculated
+#with a budget of previous) is given, its escape statistics adjust this: if more than 1% of its escaped pixels
+#needed over half the budget, the budget was too small and is doubled; if none needed more than a quarter of it
+#the budget is halved. Budgets are powers of two so only a few specialised kernels ever need compiling
+def choose_maxiter(width, img=None, previous=None):
+    depth = max(0.,np.log10(4./width))
+    n = 50*depth**1.25
+
+    if img is not None and previous is not None:
+        escaped = img[img < previous]
+        if len(escaped) > 0:
+            late = np.count_nonzero(escaped > 0.5*previous)/len(escaped)
+            if late > 0.01:
+                n = max(n,2*previous)
+            elif escaped.max() < 0.25*previous:
+                n = min(n,previous/2)
+            else:
+                n = max(n,previous)
+        else:
+            #nothing escaped: we are looking at the inside of the set, where more iterations show nothing new
+            n = min(n,previous)
 
-                z2 = x
+    n = 2**int(np.ceil(np.log2(max(n,1))))
+    return int(min(max_maxiter,max(min_maxiter,n)))
 
-                x = x*x - y*y + x0
-                y = 2.*z2*y + y0
 
-                z2 = x*x + y*y
+#thread pools used by run_dynamic, one per thread count (so they are only created once)
+_pools = {}
 
-                if z2 > 4:
-                    break
-            
-            out[j,i] = n
-    return out
+#Runs run(task) for every task on nthreads threads. The threads take the tasks one at a time from a shared
+#counter as soon as they finish their previous one. As the cost of a pixel varies a lot (points in the set
+#take 256 iterations, points far outside take 1 or 2) this balances the load much better than giving
+#each thread a fixed block of rows.
+#run must return the (cardioid, periodic) short-cut counts, which are summed and returned.
+#If cancel (a threading.Event) is set, the threads stop taking tasks and Cancelled is raised
+def run_dynamic(tasks, run, nthreads=None, cancel=None):
+    if nthreads is None:
+        nthreads = os.cpu_count()
+    nthreads = max(1,min(nthreads,len(tasks)))
 
+    #next(counter) is atomic under the GIL, so it can be used as the work queue
+    counter = itertools.count()
 
-@numba.jit(nopython=True)
-def real_mandelbrot(xmin, dx, ymin, dy, nx, ny):
-    out = np.zeros((ny,nx),dtype=np.float32)
+    def worker():
+        ncardioid = 0
+        nperiodic = 0
+        while True:
+            k = next(counter)
+            if k >= len(tasks) or (cancel is not None and cancel.is_set()):
+                return ncardioid, nperiodic
+            c, p = run(tasks[k])
+            ncardioid += c
+            nperiodic += p
+    
+    if nthreads == 1:
+        stats = list(worker())
+        if cancel is not None and cancel.is_set():
+            raise Cancelled()
+        return stats
 
-    ln2 = np.log(2.)
+    if nthreads not in _pools:
+        _pools[nthreads] = ThreadPoolExecutor(max_workers=nthreads)
+    pool = _pools[nthreads]
 
-    for j in range(ny):
-        y0 = ymin + (j+0.5)*dy
-        for i in range(nx):
-            n=0
+    futures = [pool.submit(worker) for t in range(nthreads)]
+    stats = [0, 0]
+    for future in futures:
+        #re-raises any exception from the worker
+        c, p = future.result()
+        stats[0] += c
+        stats[1] += p
 
-            x=0.
-            y=0.
+    if cancel is not None and cancel.is_set():
+        raise Cancelled()
 
-            x0 = xmin + (i+0.5)*dx
-            
+    return stats
 
-            while(n < 256):
-                n+=1
 
-                z2 = x
+#Calculates an image using one of the tile kernels above on nthreads threads, splitting it into square tiles.
+#Returns the image and the number of pixels short-circuited by the cardioid/bulb and periodicity checks
+def tiled_mandelbrot(kernel, dtype, xmin, dx, ymin, dy, nx, ny, nthreads=None, tile=None, opts=cardioid_check|periodicity_check, cancel=None):
+    if tile is None:
+        tile = tilesize
 
-                x = x*x - y*y + x0
-                y = 2.*z2*y + y0
+    out = np.zeros((ny,nx),dtype=dtype)
 
-                z2 = x*x + y*y
+    tiles = []
+    for j0 in range(0,ny,tile):
+        for i0 in range(0,nx,tile):
+            tiles.append((i0,min(i0+tile,nx),j0,min(j0+tile,ny)))
+
+    def run(t):
+        i0, i1, j0, j1 = t
+        return kernel(out, xmin, dx, ymin, dy, i0, i1, j0, j1, opts)
+
+    stats = run_dynamic(tiles, run, nthreads, cancel)
+
+    return out, stats
 
-                if z2 > 100:
-                    break
-            
-            if n == 256:
-                out[j,i] = float(n)
-            else:
-                out[j,i] = n + 2. - np.log(np.log(z2))/ln2;
-    return out
 
+#Calculates the pixels listed in index using one of the points kernels above on nthreads threads,
+#splitting the list into chunks of tile^2 pixels (tilesize^2 by default). Returns the values and the short-cut counts
+def points_mandelbrot(kernel, dtype, index, xmin, dx, ymin, dy, nx, nthreads=None, tile=None, opts=cardioid_check|periodicity_check, cancel=None):
+    if tile is None:
+        tile = tilesize
 
+    out = np.zeros(len(index),dtype=dtype)
 
+    chunk = tile*tile
+    chunks = [(k0,min(k0+chunk,len(index))) for k0 in range(0,len(index),chunk)]
 
+    def run(c):
+        return kernel(out, index, xmin, dx, ymin, dy, nx, c[0], c[1], opts)
 
+    stats = run_dynamic(chunks, run, nthreads, cancel)
 
+    return out, stats
 
 
 if __name__ == "__main__":
@@ -240,13 +710,14 @@ if __name__ == "__main__":
 
 
     tstart = time.time()
-    img = real_mandelbrot(-2.,4./nx, -2, 4./ny,nx,ny)
+    img = numba_kernels().real_mandelbrot(-2.,4./nx, -2, 4./ny,nx,ny)
     tstop = time.time()
     print("Time = %f"%(tstop-tstart))
     tstart = time.time()
-    img = real_mandelbrot(-2.,4./nx, -2, 4./ny,nx,ny)
+    img = numba_kernels().real_mandelbrot(-2.,4./nx, -2, 4./ny,nx,ny)
     tstop = time.time()
     print("Time = %f"%(tstop-tstart))
 
+    import matplotlib.pyplot as plt
     plt.imshow(img,origin="lower")
     plt.show()
\ No newline at end of file
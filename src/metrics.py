@@ -0,0 +1,248 @@
+import os
+import json
+import time
+import atexit
+import threading
+import contextlib
+import collections
+
+
+#Instrumentation: timings of the stages of each frame and counters of the work done, delivered as events to whatever
+#hooks have subscribed (a rolling summary for the GUI's status bar, a JSON lines log, a Chrome trace, ...).
+#Every event is a dictionary:
+#  - {"type": "stage", "stage": ..., "start": ..., "seconds": ..., "track": ..., ...} for a timed stage, one of
+#    stages below. start is on the time.perf_counter() clock (OpenCL device times are moved onto it), and track is
+#    the thread (or device queue) it ran on
+#  - {"type": "count", "pixels": ..., "iterations": ..., "seconds": ..., ...} for a finished calculation, with the
+#    short-cut counts (cardioid, periodic) and what calculated it (backend, precision, kind, maxiter)
+#  - {"type": "counter", "counter": ..., "value": ..., ...} for one of counters below, e.g. how many pixels of a
+#    frame were reused from the last one
+#both with the wall clock time the event was made at. With no hooks subscribed, nothing is timed or counted: callers
+#check active (or use timer, which then does nothing) before doing any work for an event, so this can stay in
+#production code.
+#Setting the environment variable PYFRACTAL_METRICS to a file name logs every event to it as JSON lines ("-" logs
+#to stdout), and PYFRACTAL_TRACE writes a Chrome trace (for chrome://tracing or ui.perfetto.dev) of the stages.
+
+#the stages of a frame which are timed
+stages = ["queue", "kernel", "copy", "scale", "colour", "draw", "encode"]
+
+#the counters recorded:
+#  reused_pixels - pixels of a frame taken from the last frame (see reuse.py), of total
+#  subdivision_calculated - pixels of a frame calculated by boundary subdivision (see subdivide.py), of total
+#  glitched_pixels - pixels left glitched by reference orbit reference of a deep zoom (see perturbation.py), of total,
+#                    after skipping skipped iterations with the series approximation
+#  device_share - the share of each frame given to device by a MultiMandelbrot (see multidevice.py)
+#  antialiased_pixels - pixels of a band of an export supersampled with samples samples (see antialias.py), of total
+#  abandoned_frames - frames abandoned by the render thread as newer ones were requested (see renderer.py)
+counters = ["reused_pixels", "subdivision_calculated", "glitched_pixels", "device_share", "antialiased_pixels", "abandoned_frames"]
+
+#the subscribed hooks, each called with every event (possibly from several threads)
+hooks = []
+
+#True if any hooks are subscribed
+active = False
+
+#the timer used while no hooks are subscribed
+_null = contextlib.nullcontext()
+
+
+#subscribes hook (a callable taking an event) to the events
+def subscribe(hook):
+    global active
+    hooks.append(hook)
+    active = True
+
+def unsubscribe(hook):
+    global active
+    if hook in hooks:
+        hooks.remove(hook)
+    active = len(hooks) > 0
+
+
+def emit(event):
+    event["time"] = time.time()
+    for hook in list(hooks):
+        hook(event)
+
+
+#records the stage (see stages), which started at start (on the time.perf_counter() clock) and took seconds.
+#fields are added to the event
+def record(stage,start,seconds,track=None,**fields):
+    if not active:
+        return
+    event = {"type": "stage", "stage": stage, "start": start, "seconds": seconds,
+             "track": track if track is not None else threading.current_thread().name}
+    event.update(fields)
+    emit(event)
+
+
+#records a finished calculation of pixels pixels taking iterations iterations in seconds
+def count(pixels,iterations,seconds,**fields):
+    if not active:
+        return
+    event = {"type": "count", "pixels": pixels, "iterations": iterations, "seconds": seconds}
+    event.update(fields)
+    emit(event)
+
+
+#records value of counter (see counters). fields are added to the event
+def counter(name,value,**fields):
+    if not active:
+        return
+    event = {"type": "counter", "counter": name, "value": value}
+    event.update(fields)
+    emit(event)
+
+
+#Times the enclosed block as stage:
+#  with metrics.timer("draw"):
+#      ...
+class Timer():
+    def __init__(self,stage,fields):
+        self.stage = stage
+        self.fields = fields
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self,*exc):
+        record(self.stage,self.start,time.perf_counter()-self.start,**self.fields)
+        return False
+
+def timer(stage,**fields):
+    if not active:
+        return _null
+    return Timer(stage,fields)
+
+
+#returns the number of iterations the values (escape counts, or continuous values which approximate them) of a
+#calculation took, with points in the set counting the whole budget maxiter
+def iterations(values,maxiter):
+    import numpy as np
+    if values.dtype.kind == "f":
+        return int(np.nansum(np.clip(values,0,maxiter),dtype=np.float64))
+    return int(np.minimum(values,maxiter).sum(dtype=np.int64))
+
+
+#Keeps the events of the last window frames' stages and calculations, and summarises them for the status bar
+class RollingStats():
+    def __init__(self,window=20):
+        self.lock = threading.Lock()
+        self.times = {stage: collections.deque(maxlen=window) for stage in stages}
+        self.counts = collections.deque(maxlen=window)
+
+    def __call__(self,event):
+        with self.lock:
+            if event["type"] == "stage":
+                self.times[event["stage"]].append(event["seconds"])
+            elif event["type"] == "count":
+                self.counts.append(event)
+
+    #returns the mean time (in seconds) of stage over the window, or None if it has not been seen
+    def mean(self,stage):
+        with self.lock:
+            times = self.times[stage]
+            if len(times) == 0:
+                return None
+            return sum(times)/len(times)
+
+    #Returns a one line summary: the mean time of each stage, and the rate and backend of the calculations
+    def summary(self):
+        parts = []
+        for stage in stages:
+            t = self.mean(stage)
+            if t is not None:
+                parts.append("%s %.1f ms"%(stage,1E3*t))
+        text = ", ".join(parts)
+
+        with self.lock:
+            counts = list(self.counts)
+        seconds = sum(c["seconds"] for c in counts)
+        if seconds > 0:
+            last = counts[-1]
+            text += " | %.1f Mpixel/s, %.2f Giter/s | %s, %s precision"%(sum(c["pixels"] for c in counts)/seconds/1E6,
+                    sum(c["iterations"] for c in counts)/seconds/1E9,last.get("backend","?"),last.get("precision","?"))
+        return text
+
+
+#Writes every event to a file (or stdout) as a line of JSON
+class JSONLinesWriter():
+    def __init__(self,filename):
+        self.lock = threading.Lock()
+        if filename == "-":
+            self.file = None
+        else:
+            self.file = open(filename,"a")
+
+    def __call__(self,event):
+        line = json.dumps(event,default=str)
+        with self.lock:
+            if self.file is None:
+                print(line,flush=True)
+            else:
+                self.file.write(line+"\n")
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+
+
+#Writes the stages as a Chrome trace (in the JSON array format, which the viewers accept even if the program exits
+#before the closing bracket is written), with a row per track and the counters as counter events
+class ChromeTraceWriter():
+    def __init__(self,filename):
+        self.lock = threading.Lock()
+        self.file = open(filename,"w")
+        self.file.write("[\n")
+        self.first = True
+        self.pid = os.getpid()
+        self.tids = {}
+
+    def write(self,entry):
+        if not self.first:
+            self.file.write(",\n")
+        self.first = False
+        self.file.write(json.dumps(entry,default=str))
+
+    #returns the trace's thread id for track, naming the row the first time it is seen
+    def tid(self,track):
+        if track not in self.tids:
+            self.tids[track] = len(self.tids)+1
+            self.write({"name": "thread_name", "ph": "M", "pid": self.pid, "tid": self.tids[track], "args": {"name": track}})
+        return self.tids[track]
+
+    def __call__(self,event):
+        with self.lock:
+            if self.file is None:
+                return
+            if event["type"] == "stage":
+                args = {k: v for k, v in event.items() if k not in ("type","stage","start","seconds","track","time")}
+                self.write({"name": event["stage"], "ph": "X", "pid": self.pid, "tid": self.tid(event["track"]),
+                            "ts": 1E6*event["start"], "dur": 1E6*event["seconds"], "args": args})
+            elif event["type"] == "count":
+                self.write({"name": "pixels", "ph": "C", "pid": self.pid, "ts": 1E6*time.perf_counter(),
+                            "args": {"pixels": event["pixels"], "iterations": event["iterations"]}})
+            elif event["type"] == "counter":
+                self.write({"name": event["counter"], "ph": "C", "pid": self.pid, "ts": 1E6*time.perf_counter(),
+                            "args": {event.get("device",event["counter"]): event["value"]}})
+
+    def close(self):
+        with self.lock:
+            if self.file is not None:
+                self.file.write("\n]\n")
+                self.file.close()
+                self.file = None
+
+
+#subscribes the writers asked for by the PYFRACTAL_METRICS and PYFRACTAL_TRACE environment variables (see above),
+#closing them when the program exits
+def from_environment():
+    for variable, writer in (("PYFRACTAL_METRICS", JSONLinesWriter), ("PYFRACTAL_TRACE", ChromeTraceWriter)):
+        filename = os.environ.get(variable)
+        if filename:
+            hook = writer(filename)
+            subscribe(hook)
+            atexit.register(hook.close)
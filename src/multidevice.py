@@ -0,0 +1,188 @@
+import numpy as np
+
+from .mandelbrot import Mandelbrot, maxiter, cardioid_check, periodicity_check
+from . import checkcl
+from . import metrics
+
+
+#Renders each frame on several OpenCL devices at once (which may be on different platforms, e.g. a CPU runtime and
+#a GPU). The frame is split into bands of rows, one per device, which are queued on all the devices before any is
+#waited for, then stitched back together. The bands are sized so every device should finish at the same time:
+#each device's throughput (iterations per second) is measured from its kernel time every frame, and the cost of
+#each row is estimated from the previous frame's iteration counts (for the small view changes of interactive
+#use, the last frame is a good map of where the expensive pixels are).
+#Only whole-frame calculations are split: calculate_points, calculate_perturbed and boundary subdivision run on
+#the first device.
+
+#weight of the latest measurement in each device's throughput estimate
+throughput_smoothing = 0.5
+
+
+class MultiMandelbrot(Mandelbrot):
+    #devices is a list of (platform, device) index pairs. By default every device on every platform is used
+    def __init__(self,devices=None,nthreads=None,shortcuts=cardioid_check|periodicity_check):
+        if devices is None:
+            devices = checkcl.GetDeviceList()
+        if len(devices) == 0:
+            raise ValueError("No OpenCL devices to render on")
+
+        super(MultiMandelbrot, self).__init__(platform=devices[0][0],device=devices[0][1],nthreads=nthreads,shortcuts=shortcuts)
+
+        #a Mandelbrot object for each device (this one for the first)
+        self.members = [self]
+        for platform, device in devices[1:]:
+            self.members.append(Mandelbrot(platform=platform,device=device,nthreads=nthreads,shortcuts=shortcuts))
+
+        #double precision is only used if every device supports it
+        self.double_precision = all(m.double_precision for m in self.members)
+
+        #estimated iterations per second of each device (only their ratios matter, so they start equal)
+        self.throughput = np.ones(len(self.members))
+
+        #iterations needed by each row of the last frame, or None before the first frame
+        self.rowcost = None
+
+    #Splits ny rows into one band per device. Returns the first row of each band, followed by ny
+    def split(self,ny):
+        if self.rowcost is None:
+            cost = np.ones(ny)
+        else:
+            #stretch the last frame's row costs over this frame's rows
+            cost = np.interp(np.linspace(0.,1.,ny),np.linspace(0.,1.,len(self.rowcost)),self.rowcost)
+        total = np.concatenate(([0.],np.cumsum(cost)))
+
+        #cut the rows where the cumulative cost reaches each device's share of the total
+        share = np.cumsum(self.throughput/self.throughput.sum())[:-1]
+        cuts = np.searchsorted(total,share*total[-1])
+        return [0] + [int(c) for c in np.clip(cuts,0,ny)] + [ny]
+
+    #Calculates the frame (or its rows j0 <= j < j1 if rows = (j0, j1) is given) in bands across the devices.
+    #Returns a MultiReadback, whose result() is the stitched image
+    def calculate_async(self,xmin=-2,xmax=1,ymin=-1.5,ymax=1.5,real=False,double=False,nx=1000,ny=1000,maxiter=maxiter,rows=None):
+        if self.subdivide or len(self.members) == 1:
+            return Mandelbrot.calculate_async(self,xmin,xmax,ymin,ymax,real=real,double=double,nx=nx,ny=ny,maxiter=maxiter,rows=rows)
+
+        self.checkCancel()
+
+        if rows is None:
+            rows = (0, ny)
+        bounds = [rows[0]+j for j in self.split(rows[1]-rows[0])]
+
+        #queue every band before waiting for any of them
+        readbacks = []
+        for k, member in enumerate(self.members):
+            j0, j1 = bounds[k], bounds[k+1]
+            if j1 > j0:
+                readbacks.append(Mandelbrot.calculate_async(member,xmin,xmax,ymin,ymax,real=real,double=double,nx=nx,ny=ny,maxiter=maxiter,rows=(j0,j1)))
+            else:
+                readbacks.append(None)
+
+        dx = (xmax-xmin)/nx
+        dy = (ymax-ymin)/ny
+        return MultiReadback(self,readbacks,maxiter,(xmin,dx,ymin+rows[0]*dy,dy))
+
+    #Returns the estimated cost (in iterations) of each pixel of img, whose pixel (i, j) is centred on
+    #x0 + (i+0.5)*dx, y0 + (j+0.5)*dy: escaped pixels cost the iterations they took and pixels in the set the whole
+    #budget, unless a short-cut spared them. Those in the cardioid or bulb (if the check is on) cost next to nothing,
+    #and in each band (bandimgs) the share of the rest the periodicity check caught (from the band's short-cut counts,
+    #stats) is taken off
+    def pixelcost(self,img,bandimgs,stats,maxiter,x0,dx,y0,dy):
+        cost = np.minimum(img,maxiter).astype(np.float64) + 1.
+        jj, ii = np.nonzero(img >= maxiter)
+        if len(jj) == 0:
+            return cost
+
+        if self.shortcuts & cardioid_check:
+            from .npkernels import in_cardioid
+            inside = in_cardioid(x0+(ii+0.5)*dx,y0+(jj+0.5)*dy)
+            cost[jj[inside],ii[inside]] = 1.
+            jj, ii = jj[~inside], ii[~inside]
+
+        if self.shortcuts & periodicity_check:
+            j1 = 0
+            for band, bandstats in zip(bandimgs,stats):
+                if band is None:
+                    continue
+                j0, j1 = j1, j1+band.shape[0]
+                inband = (jj >= j0) & (jj < j1)
+                n = np.count_nonzero(inband)
+                if n > 0:
+                    iterated = max(0.,1.-bandstats["periodic"]/n)
+                    cost[jj[inband],ii[inband]] = 1. + iterated*maxiter
+        return cost
+
+    #updates the throughput estimates and the row cost map from a finished frame (img, see pixelcost for the view
+    #x0, dx, y0, dy), the time each band took and each band's short-cut counts (stats)
+    def rebalance(self,img,bandimgs,times,stats,maxiter,x0,dx,y0,dy):
+        cost = self.pixelcost(img,bandimgs,stats,maxiter,x0,dx,y0,dy)
+        self.rowcost = cost.sum(axis=1)
+
+        j1 = 0
+        for k, (band, t) in enumerate(zip(bandimgs,times)):
+            if band is None:
+                continue
+            j0, j1 = j1, j1+band.shape[0]
+            if t is None or t <= 0:
+                continue
+            measured = cost[j0:j1].sum()/t
+            self.throughput[k] = (1-throughput_smoothing)*self.throughput[k] + throughput_smoothing*measured
+
+        if metrics.active:
+            for member, t in zip(self.members,self.throughput):
+                metrics.counter("device_share",float(t/self.throughput.sum()),device=member.backend)
+
+
+#The result of a frame calculated by a MultiMandelbrot: collects the bands from all the devices and stitches them
+class MultiReadback():
+    #view is (xmin, dx, ymin, dy) of the frame's first row (see MultiMandelbrot.pixelcost)
+    def __init__(self,mandelbrot,readbacks,maxiter,view):
+        self.mandelbrot = mandelbrot
+        self.readbacks = readbacks
+        self.maxiter = maxiter
+        self.view = view
+        self.img = None
+
+    def done(self):
+        return all(r is None or r.done() for r in self.readbacks)
+
+    def result(self):
+        if self.img is not None:
+            return self.img
+
+        import pyopencl as cl
+        bands = []
+        times = []
+        bandstats = []
+        stats = {"pixels": 0, "cardioid": 0, "periodic": 0}
+        for member, readback in zip(self.mandelbrot.members,self.readbacks):
+            if readback is None:
+                bands.append(None)
+                times.append(None)
+                bandstats.append(None)
+                continue
+            bands.append(readback.result())
+            bandstats.append(member.stats)
+            for key in stats:
+                stats[key] += member.stats[key]
+            try:
+                tstart = readback.event.get_profiling_info(cl.profiling_info.START)
+                tstop = readback.event.get_profiling_info(cl.profiling_info.END)
+                times.append((tstop-tstart)/1E9)
+            except cl._cl.RuntimeError:
+                times.append(None)
+
+        self.img = np.concatenate([b for b in bands if b is not None],axis=0)
+        self.mandelbrot.stats = stats
+        self.mandelbrot.rebalance(self.img,bands,times,bandstats,self.maxiter,*self.view)
+
+        return self.img
+
+
+#Returns the Mandelbrot object for the platform and device settings: a MultiMandelbrot over every device of the
+#platform if device is -1, or over every device of every platform if platform is -2, otherwise a Mandelbrot
+def create_mandelbrot(platform,device,**kwargs):
+    if platform == -2:
+        return MultiMandelbrot(**kwargs)
+    if platform >= 0 and device == -1:
+        return MultiMandelbrot(devices=checkcl.GetDeviceList(platform),**kwargs)
+    return Mandelbrot(platform=platform,device=device,**kwargs)
@@ -0,0 +1,374 @@
+import collections
+import threading
+
+import numpy as np
+
+from .mandelbrot import maxiter, cardioid_check, periodicity_check, glitch_tolerance
+
+
+#The kernels of the NumPy backend, for when neither OpenCL nor Numba is available. They take the same arguments and
+#give the same values as the Numba kernels (see kernels.py), so the image is split into tiles and the tiles shared
+#between threads in the same way (NumPy releases the GIL while it works on arrays, so threads still help a little).
+#Rather than iterating each pixel to the end in turn, a tile's pixels are iterated together, a whole array operation
+#at a time, on a compacted list of the pixels still iterating: whenever some escape (or are found to be periodic)
+#their results are recorded and they are dropped from the list, so later iterations only work on the pixels left.
+#The tiles are split into chunks of chunk pixels, small enough that a chunk's arrays stay in the CPU's cache but
+#large enough that NumPy's overhead for each operation is small, and the arrays are preallocated scratch buffers kept
+#by each thread, so the iterations themselves allocate nothing (only compacting the list allocates, the list of the
+#pixels kept). This is still several times slower than Numba: it is for when nothing faster can be installed.
+#There are no float-float kernels: the float-float entries convert their coordinates to double precision (which is
+#more precise) and calculate in that.
+
+#the most pixels iterated together (the 21 arrays of 16384 values are 2.4 MB), and the size (in pixels) of the square
+#tiles the image is split into, one chunk each
+chunk = 16384
+tilesize = 128
+
+
+#The preallocated arrays a thread iterates a chunk with. Each of the per-pixel arrays (the pixel's position in the
+#chunk, its c and z, and the z saved by the periodicity check) is kept twice, as compaction copies the pixels kept
+#from one into the other
+class Scratch():
+    def __init__(self,size,dtype=np.float64):
+        self.size = size
+        self.pos = [np.empty(size,dtype=np.intp) for k in range(2)]
+        self.cx = [np.empty(size,dtype=dtype) for k in range(2)]
+        self.cy = [np.empty(size,dtype=dtype) for k in range(2)]
+        self.x = [np.empty(size,dtype=dtype) for k in range(2)]
+        self.y = [np.empty(size,dtype=dtype) for k in range(2)]
+        self.xold = [np.empty(size,dtype=dtype) for k in range(2)]
+        self.yold = [np.empty(size,dtype=dtype) for k in range(2)]
+
+        #temporaries
+        self.x2 = np.empty(size,dtype=dtype)
+        self.y2 = np.empty(size,dtype=dtype)
+        self.z2 = np.empty(size,dtype=dtype)
+        self.t = np.empty(size,dtype=dtype)
+        self.escaped = np.empty(size,dtype=np.bool_)
+        self.periodic = np.empty(size,dtype=np.bool_)
+        self.same = np.empty(size,dtype=np.bool_)
+
+        #the results: the iteration count and final |z|^2 of each pixel of the chunk
+        self.n = np.empty(size,dtype=np.int32)
+        self.zn2 = np.empty(size,dtype=dtype)
+
+#each thread's Scratch
+_local = threading.local()
+
+def scratch():
+    if getattr(_local,"scratch",None) is None:
+        _local.scratch = Scratch(chunk)
+    return _local.scratch
+
+
+#Returns a boolean array flagging the points (x0, y0) inside the main cardioid or the period-2 bulb (see in_cardioid
+#in kernels.py)
+def in_cardioid(x0, y0):
+    y2 = y0*y0
+
+    xq = x0 - 0.25
+    q = xq*xq + y2
+    inside = q*(q + xq) < 0.25*y2
+
+    xb = x0 + 1.
+    inside |= xb*xb + y2 < 0.0625
+    return inside
+
+
+#Iterates the m points whose c are in s.cx[0][:m], s.cy[0][:m] (a Scratch) for up to niter iterations, until
+#|z|^2 > escape, with the same short-cuts as iterate in kernels.py. Leaves each point's iteration count and final |z|^2
+#in s.n[:m] and s.zn2[:m]. Returns the number of points short-circuited by the cardioid/bulb and periodicity checks
+def iterate(s, m, niter, escape, opts):
+    ncardioid = 0
+    nperiodic = 0
+    s.zn2[:m] = 0.
+
+    #the points in the cardioid or bulb are done without iterating
+    np.copyto(s.pos[0][:m],np.arange(m))
+    live = 0
+    if opts & cardioid_check:
+        inside = in_cardioid(s.cx[0][:m],s.cy[0][:m])
+        ncardioid = int(np.count_nonzero(inside))
+        if ncardioid > 0:
+            s.n[:m][inside] = niter
+            keep = np.flatnonzero(~inside)
+            for a in (s.pos, s.cx, s.cy):
+                np.take(a[0][:m],keep,out=a[1][:len(keep)])
+            live = 1
+            m = len(keep)
+
+    pos, cx, cy = s.pos[live][:m], s.cx[live][:m], s.cy[live][:m]
+    x, y = s.x[live][:m], s.y[live][:m]
+    xold, yold = s.xold[live][:m], s.yold[live][:m]
+    x[:] = 0.
+    y[:] = 0.
+    xold[:] = 0.
+    yold[:] = 0.
+    period = 0
+    plimit = 1
+
+    n = 0
+    while n < niter and m > 0:
+        n += 1
+        x2, y2, z2 = s.x2[:m], s.y2[:m], s.z2[:m]
+        escaped, periodic = s.escaped[:m], s.periodic[:m]
+
+        #z = z^2 + c, in the same order of operations as the other kernels, so the values are the same
+        np.multiply(x,x,out=x2)
+        np.multiply(y,y,out=y2)
+        np.multiply(x,2.,out=z2)
+        np.multiply(z2,y,out=y)
+        np.add(y,cy,out=y)
+        np.subtract(x2,y2,out=x)
+        np.add(x,cx,out=x)
+
+        np.multiply(x,x,out=x2)
+        np.multiply(y,y,out=y2)
+        np.add(x2,y2,out=z2)
+
+        np.greater(z2,escape,out=escaped)
+        nescaped = np.count_nonzero(escaped)
+
+        #Brent's method, as in the other kernels. Every point started together, so they all save their z at the same
+        #iterations
+        nfound = 0
+        if opts & periodicity_check:
+            np.equal(x,xold,out=periodic)
+            np.equal(y,yold,out=s.same[:m])
+            periodic &= s.same[:m]
+            nfound = np.count_nonzero(periodic)
+            period += 1
+            if period == plimit:
+                period = 0
+                plimit *= 2
+                np.copyto(xold,x)
+                np.copyto(yold,y)
+
+        if nescaped == 0 and nfound == 0:
+            continue
+
+        #record the points which are done and drop them from the list (periodic is only set if the check ran)
+        if nescaped > 0:
+            done = pos[escaped]
+            s.n[done] = n
+            s.zn2[done] = z2[escaped]
+        if nfound > 0:
+            done = pos[periodic]
+            s.n[done] = niter
+            s.zn2[done] = z2[periodic]
+            nperiodic += int(nfound)
+            escaped |= periodic
+
+        keep = np.flatnonzero(~escaped)
+        old = live
+        live = 1-live
+        m = len(keep)
+        for a in (s.pos, s.cx, s.cy, s.x, s.y, s.xold, s.yold):
+            np.take(a[old][:len(escaped)],keep,out=a[live][:m])
+        pos, cx, cy = s.pos[live][:m], s.cx[live][:m], s.cy[live][:m]
+        x, y = s.x[live][:m], s.y[live][:m]
+        xold, yold = s.xold[live][:m], s.yold[live][:m]
+
+    #the points still iterating reached the budget
+    s.n[pos] = niter
+    return ncardioid, nperiodic
+
+
+#returns the product of the complex numbers ax + i*ay and bx + i*by (arrays or numbers) as its real and imaginary parts
+def cmul(ax, ay, bx, by):
+    return ax*bx - ay*by, ax*by + ay*bx
+
+
+#Returns the continuous values of points which took n iterations to reach |z|^2 = z2 (the budget niter for points in
+#the set), as real_mandelbrot_tile in kernels.py
+def continuous(n, z2, niter):
+    with np.errstate(invalid="ignore",divide="ignore"):
+        values = n + 2. - np.log(np.log(z2))/np.log(2.)
+    return np.where(n == niter,n.astype(np.float64),values)
+
+
+#Calculates the points listed (as i, j pixel coordinates) in the chunks of ipix, jpix, writing their values to
+#out (a 1D view). Returns the short-cut counts
+def calculate(out, ipix, jpix, xmin, dx, ymin, dy, niter, escape, real, opts):
+    s = scratch()
+    ncardioid = 0
+    nperiodic = 0
+    for c0 in range(0,len(ipix),s.size):
+        c1 = min(len(ipix),c0+s.size)
+        m = c1-c0
+
+        cx = s.cx[0][:m]
+        cy = s.cy[0][:m]
+        np.add(ipix[c0:c1],0.5,out=cx)
+        cx *= dx
+        cx += xmin
+        np.add(jpix[c0:c1],0.5,out=cy)
+        cy *= dy
+        cy += ymin
+
+        c, p = iterate(s,m,niter,escape,opts)
+        ncardioid += c
+        nperiodic += p
+
+        if real:
+            out[c0:c1] = continuous(s.n[:m],s.zn2[:m],niter)
+        else:
+            out[c0:c1] = s.n[:m]
+    return ncardioid, nperiodic
+
+
+#Returns the NumPy kernels for an iteration budget of niter (see kernels.py: these have the same names and arguments)
+def numpy_kernels(niter=maxiter):
+
+    #Calculates the discrete mandelbrot set for the pixels i0 <= i < i1, j0 <= j < j1 of out.
+    #Returns the number of pixels short-circuited by the cardioid/bulb and periodicity checks
+    def int_mandelbrot_tile(out, xmin, dx, ymin, dy, i0, i1, j0, j1, opts):
+        jpix, ipix = np.mgrid[j0:j1,i0:i1]
+        values = np.empty((j1-j0)*(i1-i0),dtype=out.dtype)
+        stats = calculate(values,ipix.ravel(),jpix.ravel(),xmin,dx,ymin,dy,niter,4.,False,opts)
+        out[j0:j1,i0:i1] = values.reshape((j1-j0,i1-i0))
+        return stats
+
+    #Calculates the continuous mandelbrot set for the pixels i0 <= i < i1, j0 <= j < j1 of out
+    def real_mandelbrot_tile(out, xmin, dx, ymin, dy, i0, i1, j0, j1, opts):
+        jpix, ipix = np.mgrid[j0:j1,i0:i1]
+        values = np.empty((j1-j0)*(i1-i0),dtype=out.dtype)
+        stats = calculate(values,ipix.ravel(),jpix.ravel(),xmin,dx,ymin,dy,niter,100.,True,opts)
+        out[j0:j1,i0:i1] = values.reshape((j1-j0,i1-i0))
+        return stats
+
+    #The points kernels calculate only the pixels with flat indices index[k0:k1] (index = i + nx*j), writing
+    #the value of pixel index[k] to out[k]
+    def int_mandelbrot_points(out, index, xmin, dx, ymin, dy, nx, k0, k1, opts):
+        return calculate(out[k0:k1],index[k0:k1] % nx,index[k0:k1] // nx,xmin,dx,ymin,dy,niter,4.,False,opts)
+
+    def real_mandelbrot_points(out, index, xmin, dx, ymin, dy, nx, k0, k1, opts):
+        return calculate(out[k0:k1],index[k0:k1] % nx,index[k0:k1] // nx,xmin,dx,ymin,dy,niter,100.,True,opts)
+
+    #the float-float kernels calculate in double precision
+    def double(kernel):
+        def floatfloat_kernel(out, *args):
+            args = [np.float64(a[0])+np.float64(a[1]) if isinstance(a,tuple) else a for a in args]
+            return kernel(out, *args)
+        return floatfloat_kernel
+
+    #Perturbation kernel for deep zooms (see perturb_points in kernels.py), iterating the pixels index[k0:k1]
+    #together as the other kernels do, a chunk at a time in the thread's Scratch: the deltas are kept in x, y, the dc
+    #in cx, cy, and the pixels which escape or glitch are dropped from the list as in iterate. Every pixel starts at
+    #iteration skip, so they all reach the end of the reference orbit at the same iteration. The complex arithmetic is
+    #done on the real and imaginary parts, in the same order as Numba does it (NumPy's own complex multiplication may
+    #round differently)
+    def perturb_points(out, glitched, index, Z, nref, A, B, C, skip, dxmin, dx, dymin, dy, nx, escape, real, k0, k1):
+        s = scratch()
+        nglitched = 0
+        for c0 in range(k0,k1,s.size):
+            c1 = min(k1,c0+s.size)
+            m = c1-c0
+            glitch = glitched[c0:c1]
+            glitch[:] = False
+            s.n[:m] = niter
+            s.zn2[:m] = 0.
+
+            np.copyto(s.pos[0][:m],np.arange(m))
+            dcx, dcy = s.cx[0][:m], s.cy[0][:m]
+            np.add(index[c0:c1] % nx,0.5,out=dcx)
+            dcx *= dx
+            dcx += dxmin
+            np.add(index[c0:c1] // nx,0.5,out=dcy)
+            dcy *= dy
+            dcy += dymin
+
+            #the series approximation ((C*dc + B)*dc + A)*dc
+            ddx, ddy = cmul(C.real,C.imag,dcx,dcy)
+            ddx += B.real
+            ddy += B.imag
+            ddx, ddy = cmul(ddx,ddy,dcx,dcy)
+            ddx += A.real
+            ddy += A.imag
+            ddx, ddy = cmul(ddx,ddy,dcx,dcy)
+            np.copyto(s.x[0][:m],ddx)
+            np.copyto(s.y[0][:m],ddy)
+
+            live = 0
+            pos, dcx, dcy, ddx, ddy = s.pos[0][:m], s.cx[0][:m], s.cy[0][:m], s.x[0][:m], s.y[0][:m]
+            k = skip
+            while k < niter and m > 0:
+                #the reference has escaped (or ended) before these pixels
+                if k >= nref:
+                    s.n[pos] = k
+                    glitch[pos] = True
+                    break
+
+                #delta = (2*Z + delta)*delta + dc
+                tx, ty, zx, zy = s.x2[:m], s.y2[:m], s.z2[:m], s.t[:m]
+                np.add(2.*Z[k].real,ddx,out=tx)
+                np.add(2.*Z[k].imag,ddy,out=ty)
+                np.multiply(tx,ddx,out=zx)
+                np.multiply(ty,ddy,out=zy)
+                tx *= ddy
+                ty *= ddx
+                np.subtract(zx,zy,out=ddx)
+                np.add(tx,ty,out=ddy)
+                ddx += dcx
+                ddy += dcy
+                k += 1
+
+                #|Z + delta|^2
+                np.add(Z[k].real,ddx,out=zx)
+                np.add(Z[k].imag,ddy,out=zy)
+                zx *= zx
+                zy *= zy
+                zx += zy
+                zabs = zx
+
+                escaped, bad, done = s.escaped[:m], s.periodic[:m], s.same[:m]
+                np.greater(zabs,escape,out=escaped)
+                np.less(zabs,glitch_tolerance*(Z[k].real*Z[k].real + Z[k].imag*Z[k].imag),out=bad)
+                np.logical_not(escaped,out=done)
+                bad &= done
+                np.logical_or(escaped,bad,out=done)
+                if np.count_nonzero(done) == 0:
+                    continue
+
+                #record the pixels which are done and drop them from the list
+                finished = pos[done]
+                s.n[finished] = k
+                s.zn2[finished] = zabs[done]
+                if np.count_nonzero(bad) > 0:
+                    glitch[pos[bad]] = True
+
+                np.logical_not(done,out=done)
+                keep = np.flatnonzero(done)
+                old = live
+                live = 1-live
+                l = m
+                m = len(keep)
+                for a in (s.pos, s.cx, s.cy, s.x, s.y):
+                    np.take(a[old][:l],keep,out=a[live][:m])
+                pos, dcx, dcy, ddx, ddy = s.pos[live][:m], s.cx[live][:m], s.cy[live][:m], s.x[live][:m], s.y[live][:m]
+
+            m = c1-c0
+            if real:
+                out[c0:c1] = np.where(glitch,s.n[:m].astype(np.float64),continuous(s.n[:m],s.zn2[:m],niter))
+            else:
+                out[c0:c1] = s.n[:m]
+            nglitched += int(np.count_nonzero(glitch))
+        return nglitched, 0
+
+    return NumpyKernels(int_mandelbrot_tile=int_mandelbrot_tile,
+                        real_mandelbrot_tile=real_mandelbrot_tile,
+                        int_mandelbrot_points=int_mandelbrot_points,
+                        real_mandelbrot_points=real_mandelbrot_points,
+                        int_mandelbrot_tile_floatfloat=double(int_mandelbrot_tile),
+                        real_mandelbrot_tile_floatfloat=double(real_mandelbrot_tile),
+                        int_mandelbrot_points_floatfloat=double(int_mandelbrot_points),
+                        real_mandelbrot_points_floatfloat=double(real_mandelbrot_points),
+                        perturb_points=perturb_points)
+
+
+#the NumPy kernels for one iteration budget (the kernels Mandelbrot uses of the Numba KernelSet)
+NumpyKernels = collections.namedtuple("NumpyKernels",["int_mandelbrot_tile","real_mandelbrot_tile",
+                                                      "int_mandelbrot_points","real_mandelbrot_points",
+                                                      "int_mandelbrot_tile_floatfloat","real_mandelbrot_tile_floatfloat",
+                                                      "int_mandelbrot_points_floatfloat","real_mandelbrot_points_floatfloat",
+                                                      "perturb_points"])
@@ -0,0 +1,174 @@
+import math
+import decimal
+from decimal import Decimal
+
+import numpy as np
+
+from . import metrics
+
+
+#Deep zooms using perturbation theory.
+#Double precision runs out once the pixel size approaches 1E-15 of the coordinates. Instead, we calculate one
+#reference orbit Z_n (at the reference point C) on the host with arbitrary precision decimal arithmetic, and
+#iterate each pixel c = C + dc as a small offset delta_n = z_n - Z_n from it:
+#    delta_(n+1) = 2*Z_n*delta_n + delta_n^2 + dc
+#The deltas are tiny but only need double's relative precision, so this runs in double precision on the device
+#(or with Numba), costing about the same as a normal double precision render.
+#
+#Series approximation: for small dc, delta_n = A_n*dc + B_n*dc^2 + C_n*dc^3 + ..., with
+#    A_(n+1) = 2*Z_n*A_n + 1,  B_(n+1) = 2*Z_n*B_n + A_n^2,  C_(n+1) = 2*Z_n*C_n + 2*A_n*B_n
+#so while the series is accurate for every pixel in the view we skip straight to that iteration.
+#
+#Glitches: pixels whose orbits pass much closer to 0 than the reference's (or outlive it) lose precision. The
+#kernels flag these, and they are recalculated with a new reference point chosen from among them.
+
+#arithmetic context for exact view coordinates (enough digits for any zoom double deltas can reach)
+context = decimal.Context(prec=400)
+
+#the series is used until its cubic term exceeds this fraction of its linear term for the furthest pixel
+series_tolerance = 1E-6
+
+#the reference orbit is iterated until |Z|^2 exceeds this (well past the escape radius, so pixels escaping
+#slightly later than the reference can still use it)
+reference_bailout = 1E8
+
+#maximum number of reference orbits per image
+maxrefs = 16
+
+
+#returns the exact decimal value of x (a float, string or Decimal)
+def exact(x):
+    if isinstance(x,float):
+        return Decimal(x)
+    return context.create_decimal(x)
+
+
+#adds exact values together at the precision of context
+def add(*values):
+    total = Decimal(0)
+    for v in values:
+        total = context.add(total,exact(v))
+    return total
+
+
+#number of decimal digits needed to calculate the reference orbit for pixel size dx
+def digits(dx):
+    return max(30,int(-math.log10(dx))+20)
+
+
+#Calculates the reference orbit at cx + i*cy (Decimals) with prec significant digits, for up to maxiter iterations.
+#Returns Z (complex doubles) and nref, the index of the last value in Z
+def reference_orbit(cx,cy,prec,maxiter=256):
+    ctx = decimal.Context(prec=prec)
+    cx = ctx.plus(cx)
+    cy = ctx.plus(cy)
+    bailout = Decimal(reference_bailout)
+
+    Z = np.zeros(maxiter+1,dtype=np.complex128)
+
+    x = Decimal(0)
+    y = Decimal(0)
+    for n in range(maxiter+1):
+        Z[n] = complex(float(x),float(y))
+
+        x2 = ctx.multiply(x,x)
+        y2 = ctx.multiply(y,y)
+        if ctx.add(x2,y2) > bailout:
+            return Z[:n+1], n
+
+        xy = ctx.multiply(x,y)
+        x = ctx.add(ctx.subtract(x2,y2),cx)
+        y = ctx.add(ctx.add(xy,xy),cy)
+
+    return Z, maxiter
+
+
+#Calculates the series approximation coefficients along the reference orbit Z[0:nref+1], stopping once the
+#cubic term becomes significant for a pixel dmax from the reference (or the deltas stop being small).
+#Returns A, B, C and the iteration they are for
+def series(Z,nref,dmax):
+    A = 0j
+    B = 0j
+    C = 0j
+    skip = 0
+
+    for n in range(nref-1):
+        z = Z[n]
+        A1 = 2*z*A + 1
+        B1 = 2*z*B + A*A
+        C1 = 2*z*C + 2*A*B
+
+        if not abs(C1)*dmax*dmax <= series_tolerance*abs(A1):
+            break
+        if not abs(A1)*dmax < 1E-3:
+            break
+
+        A, B, C = A1, B1, C1
+        skip = n+1
+
+    return A, B, C, skip
+
+
+#Calculates the nx by ny image of the view xorigin + (xmin ... xmax), yorigin + (ymin ... ymax) using perturbation
+#theory, where xorigin and yorigin are exact values (Decimal or string) and xmin ... ymax are floats relative to them.
+#mandelbrot is the Mandelbrot object whose kernels to use. Returns the image like Mandelbrot.calculate(_real)
+def deep_mandelbrot(mandelbrot,xorigin,yorigin,xmin,xmax,ymin,ymax,real=False,nx=1000,ny=1000,maxiter=256):
+    index = np.arange(nx*ny,dtype=np.int32)
+    values = deep_points(mandelbrot,index,xorigin,yorigin,xmin,xmax,ymin,ymax,real=real,nx=nx,ny=ny,maxiter=maxiter)
+    return values.reshape((ny,nx))
+
+
+#Calculates only the pixels of the deep zoom image (see deep_mandelbrot) whose flat indices (i + nx*j) are in points.
+#Returns a 1D array with the value of each of these pixels
+def deep_points(mandelbrot,points,xorigin,yorigin,xmin,xmax,ymin,ymax,real=False,nx=1000,ny=1000,maxiter=256):
+    dx = (xmax-xmin)/nx
+    dy = (ymax-ymin)/ny
+    prec = digits(min(abs(dx),abs(dy)))
+
+    values = np.zeros(nx*ny,dtype=np.float32)
+    index = np.ascontiguousarray(points,dtype=np.int32)
+    if len(index) == 0:
+        return np.zeros(0,dtype=np.float32 if real else np.int32)
+
+    #the first reference is the centre of the view
+    rx = (xmin+xmax)/2
+    ry = (ymin+ymax)/2
+
+    for nrefs in range(maxrefs):
+        mandelbrot.checkCancel()
+        Z, nref = reference_orbit(add(xorigin,rx),add(yorigin,ry),prec,maxiter)
+
+        #offset of pixel (0, 0) from the reference
+        dxmin = xmin - rx
+        dymin = ymin - ry
+
+        #furthest pixel from the reference
+        i = index % nx
+        j = index // nx
+        ddx = max(abs(dxmin + (i.min()+0.5)*dx),abs(dxmin + (i.max()+0.5)*dx))
+        ddy = max(abs(dymin + (j.min()+0.5)*dy),abs(dymin + (j.max()+0.5)*dy))
+        dmax = math.hypot(ddx,ddy)
+
+        A, B, C, skip = series(Z,nref,dmax)
+
+        v, glitched = mandelbrot.calculate_perturbed(index,Z,nref,A,B,C,skip,dxmin,dx,dymin,dy,nx,real=real,maxiter=maxiter)
+        values[index] = v
+
+        metrics.counter("glitched_pixels",int(np.count_nonzero(glitched)),total=len(index),reference=nrefs+1,skipped=int(skip))
+
+        index = index[glitched]
+        if len(index) == 0:
+            break
+
+        #re-reference on the glitched pixel nearest the centre of the glitched pixels
+        gi = index % nx
+        gj = index // nx
+        k = np.argmin((gi-gi.mean())**2 + (gj-gj.mean())**2)
+        rx = xmin + (gi[k]+0.5)*dx
+        ry = ymin + (gj[k]+0.5)*dy
+
+    values = values[points]
+    if real:
+        return values
+    else:
+        return values.astype(np.int32)
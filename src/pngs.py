@@ -1,4 +1,8 @@
+import io
 import glob
+import zlib
+
+import numpy as np
 
 #Returns the name of the next available imagename. OF the form "img*.png", where * is a number
 def GetNextFile():
@@ -81,6 +85,101 @@ def getNextChunk(f):
 
 
 
+#writes a chunk with the given name (a 4 character string) and data (bytes) to f
+def writeChunk(f,name,data):
+    name = name.encode("ascii")
+    f.write(len(data).to_bytes(4,"big"))
+    f.write(name)
+    f.write(data)
+    f.write(zlib.crc32(data,zlib.crc32(name)).to_bytes(4,"big"))
+
+
+#Writes an 8 bit RGBA PNG image a few rows at a time (from the top of the image down), so images far larger
+#than memory can be written. metadata is a dictionary of keys and values written to tEXt chunks.
+#The compressed data is written out in IDAT chunks of up to chunksize bytes as it is produced.
+#filename may also be a file opened for writing in binary mode, which is left open
+class PNGWriter():
+    def __init__(self,filename,width,height,metadata={},chunksize=1024*1024):
+        self.width = width
+        self.height = height
+        self.chunksize = chunksize
+        self.rows = 0
+
+        if isinstance(filename,str):
+            self.f = open(filename,"wb")
+            self.owner = True
+        else:
+            self.f = filename
+            self.owner = False
+        self.f.write(bytearray.fromhex("89504e470d0a1a0a"))
+
+        #8 bit depth, colour type 6 (RGBA), default compression and filter method, no interlacing
+        header = width.to_bytes(4,"big") + height.to_bytes(4,"big") + bytes([8,6,0,0,0])
+        writeChunk(self.f,"IHDR",header)
+
+        for key, value in metadata.items():
+            writeChunk(self.f,"tEXt",key.encode("latin-1") + b"\0" + value.encode("latin-1"))
+
+        self.compressor = zlib.compressobj(6)
+        self.pending = b""
+
+    #writes rgba (a (rows, width, 4) uint8 array) as the next rows of the image
+    def writeRows(self,rgba):
+        rows = rgba.shape[0]
+        if rgba.shape[1:] != (self.width,4):
+            raise ValueError("Expected rows of shape (%d, 4), got %s"%(self.width,str(rgba.shape[1:])))
+        if self.rows + rows > self.height:
+            raise ValueError("Too many rows written: the image is only %d rows high"%self.height)
+
+        #each scanline starts with its filter type (0, no filter)
+        scanlines = np.zeros((rows,4*self.width+1),dtype=np.uint8)
+        scanlines[:,1:] = rgba.reshape((rows,4*self.width))
+
+        self.pending += self.compressor.compress(scanlines.tobytes())
+        self.flush()
+        self.rows += rows
+
+    #writes the compressed data so far out in IDAT chunks. If everything is False, chunks smaller than chunksize are held back
+    def flush(self,everything=False):
+        while len(self.pending) >= self.chunksize or (everything and len(self.pending) > 0):
+            writeChunk(self.f,"IDAT",self.pending[:self.chunksize])
+            self.pending = self.pending[self.chunksize:]
+
+    #finishes the image (which must have had all its rows written) and closes the file
+    def close(self):
+        if self.rows != self.height:
+            self.closeFile()
+            raise ValueError("Only %d of the %d rows of the image were written"%(self.rows,self.height))
+        self.pending += self.compressor.flush()
+        self.flush(everything=True)
+        writeChunk(self.f,"IEND",b"")
+        self.closeFile()
+
+    #closes the file, if the writer opened it
+    def closeFile(self):
+        if self.owner:
+            self.f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,exc_type,exc_value,traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.closeFile()
+
+
+#returns rgba (a (height, width, 4) uint8 array, from the top of the image down) encoded as a PNG, as bytes
+def encode(rgba,metadata={},level=6):
+    f = io.BytesIO()
+    with PNGWriter(f,rgba.shape[1],rgba.shape[0],metadata) as png:
+        png.compressor = zlib.compressobj(level)
+        png.writeRows(rgba)
+    return f.getvalue()
+
+
+
 if __name__ == "__main__":
     print(GetNextFile())
     print(GetImageMetadata("img11.png"))
\ No newline at end of file
@@ -0,0 +1,84 @@
+import threading
+import traceback
+
+from PyQt5 import QtCore
+
+from .mandelbrot import Cancelled
+from . import metrics
+
+
+#Calculates frames on a background thread so the GUI stays responsive while the fractal is calculated.
+#Only the most recently requested frame is ever calculated: a new request replaces any request still waiting,
+#and cancels the frame being calculated (which stops at its next tile, see Mandelbrot.cancel). Each request is
+#given a generation number, and finished frames are delivered with theirs through the frameReady signal, so the
+#receiver can also ignore any frame which finished just as a newer one was requested. A frame may also deliver
+#intermediate results (e.g. the coarse passes of a progressive calculation) the same way before it finishes.
+class RenderThread(QtCore.QThread):
+    #emitted with the generation and the result of each finished frame
+    frameReady = QtCore.pyqtSignal(int, object)
+
+    def __init__(self,parent=None):
+        super(RenderThread, self).__init__(parent)
+
+        #held while a frame is calculated. Hold it to use a Mandelbrot object from another thread (e.g. for an export)
+        self.lock = threading.Lock()
+
+        self.condition = threading.Condition()
+        self.generation = 0
+        self.job = None
+        self.cancel = threading.Event()
+        self.stopping = False
+
+    #Requests a frame: calls work(show) on the render thread with mandelbrot.cancel set up so that the calculation can
+    #be abandoned, and emits frameReady with its return value. work can call show(result) to deliver intermediate
+    #results before it returns. Returns the frame's generation number
+    def request(self,mandelbrot,work):
+        with self.condition:
+            self.cancel.set()
+            self.cancel = threading.Event()
+            self.generation += 1
+            self.job = (self.generation, mandelbrot, work, self.cancel)
+            self.condition.notify()
+            return self.generation
+
+    #True if generation is the most recently requested frame
+    def isLatest(self,generation):
+        return generation == self.generation
+
+    #stops the thread once the frame in progress is abandoned
+    def stop(self):
+        with self.condition:
+            self.stopping = True
+            self.cancel.set()
+            self.condition.notify()
+        self.wait()
+
+    def run(self):
+        while True:
+            with self.condition:
+                while self.job is None and not self.stopping:
+                    self.condition.wait()
+                if self.stopping:
+                    return
+                generation, mandelbrot, work, cancel = self.job
+                self.job = None
+
+            with self.lock:
+                mandelbrot.cancel = cancel
+                try:
+                    result = work(lambda r: self.deliver(generation,r))
+                except Cancelled:
+                    metrics.counter("abandoned_frames",1,generation=generation)
+                    continue
+                except Exception:
+                    traceback.print_exc()
+                    continue
+                finally:
+                    mandelbrot.cancel = None
+
+            self.deliver(generation,result)
+
+    #emits frameReady with result, unless a newer frame has been requested since
+    def deliver(self,generation,result):
+        if self.isLatest(generation):
+            self.frameReady.emit(generation,result)
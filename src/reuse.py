@@ -0,0 +1,100 @@
+import collections
+
+import numpy as np
+
+from . import perturbation
+from . import metrics
+
+
+#Reuses the pixels of the last calculated frame for the next one, so moving around costs in proportion to the area
+#newly brought into view rather than to the size of the window.
+#  - after a pan, the new view is snapped to whole pixels of the last frame, so it is a shifted copy of the last frame
+#    apart from the strips along its edges which have just come into view
+#  - after zooming out by a factor of two, the view is snapped so that every other pixel centre of the last frame lands
+#    on a pixel centre of the new one, and those pixels (a quarter of the part of the new frame the last one covered)
+#    are reused
+#Only the pixels not taken from the last frame are calculated (with Mandelbrot.calculate_points or, for deep zooms,
+#calculate_deep_points). The reused pixels were calculated from coordinates which differ from the new frame's own
+#only by rounding error.
+
+#a calculated frame: its image, the view it shows (xorigin + (xmin ... xmax), yorigin + (ymin ... ymax)) and the
+#settings it was calculated with, including the backend (Mandelbrot.backend) and the tolerance of boundary subdivision
+#(see tolerance), as pixels of another backend or tolerance differ from those the new frame would calculate
+Frame = collections.namedtuple("Frame",["img","xorigin","yorigin","xmin","xmax","ymin","ymax","real","double","deep","maxiter","backend","tolerance"])
+
+#how far (relative to the pixel size) the pixel sizes of two frames can differ and still be treated as equal
+pixel_tolerance = 1E-6
+
+
+#returns the tolerance of the boundary subdivision of mandelbrot's images (only continuous images are changed by it, see
+#TileCache.key)
+def tolerance(mandelbrot,real):
+    return mandelbrot.subdivide_tolerance if mandelbrot.subdivide and real else 0.
+
+
+#returns the distance of origin + x from origin0 + x0, in pixels of size d
+def offset(origin,x,origin0,x0,d):
+    if origin == origin0:
+        return (x-x0)/d
+    return float(perturbation.context.subtract(perturbation.add(origin,x),perturbation.add(origin0,x0)))/d
+
+
+#returns the range lo <= i < hi of pixels i of the new frame which land on pixel base + factor*i of the n pixels of the
+#last frame
+def overlap(base,factor,n):
+    lo = max(0,-(base//factor))
+    hi = min(n,(n-1-base)//factor + 1)
+    return lo, hi
+
+
+#Calculates the view xorigin + (xmin ... xmax), yorigin + (ymin ... ymax) of nx by ny pixels with mandelbrot (a Mandelbrot
+#object), reusing the pixels of last (a Frame) if the view is the last frame panned or zoomed out by a factor of two
+#and calculated with the same settings. Returns the image and the view snapped to the last frame's pixels
+#(xmin, xmax, ymin, ymax), or None if no pixels can be reused, in which case the view should be calculated as usual
+def reuse(mandelbrot,last,xorigin,yorigin,xmin,xmax,ymin,ymax,real=False,double=False,deep=False,nx=1000,ny=1000,maxiter=256):
+    if last is None or last.img.shape != (ny,nx):
+        return None
+    if (last.real, last.double, last.deep, last.maxiter, last.backend, last.tolerance) != (real, double, deep, maxiter, mandelbrot.backend, tolerance(mandelbrot,real)):
+        return None
+
+    #pixel size of the last frame
+    dx = (last.xmax-last.xmin)/nx
+    dy = (last.ymax-last.ymin)/ny
+
+    #how many of the last frame's pixels fit in one of the new frame's
+    for factor in (1, 2):
+        if abs((xmax-xmin)/nx - factor*dx) < pixel_tolerance*dx and abs((ymax-ymin)/ny - factor*dy) < pixel_tolerance*dy:
+            break
+    else:
+        return None
+
+    #Snap the view so that the new frame's pixel i is centred on the last frame's pixel bx + factor*i (and similarly
+    #in y). The left edge of the new frame is then (factor-1)/2 of the last frame's pixels to the left of pixel bx's edge
+    ox = offset(xorigin,xmin,last.xorigin,last.xmin,dx)
+    oy = offset(yorigin,ymin,last.yorigin,last.ymin,dy)
+    bx = int(round(ox + 0.5*(factor-1)))
+    by = int(round(oy + 0.5*(factor-1)))
+    xmin -= (ox - bx + 0.5*(factor-1))*dx
+    ymin -= (oy - by + 0.5*(factor-1))*dy
+    xmax = xmin + nx*factor*dx
+    ymax = ymin + ny*factor*dy
+
+    i0, i1 = overlap(bx,factor,nx)
+    j0, j1 = overlap(by,factor,ny)
+    if i1 <= i0 or j1 <= j0:
+        return None
+
+    img = np.empty((ny,nx),dtype=last.img.dtype)
+    img[j0:j1,i0:i1] = last.img[by+factor*j0:by+factor*(j1-1)+1:factor,bx+factor*i0:bx+factor*(i1-1)+1:factor]
+    missing = np.ones((ny,nx),dtype=np.bool_)
+    missing[j0:j1,i0:i1] = False
+
+    index = np.flatnonzero(missing)
+    metrics.counter("reused_pixels",nx*ny-len(index),total=nx*ny)
+    if deep:
+        values = mandelbrot.calculate_deep_points(index,xorigin,yorigin,xmin,xmax,ymin,ymax,real=real,nx=nx,ny=ny,maxiter=maxiter)
+    else:
+        values = mandelbrot.calculate_points(index,xmin,xmax,ymin,ymax,real=real,double=double,nx=nx,ny=ny,maxiter=maxiter)
+    img.flat[index] = values
+
+    return img, (xmin, xmax, ymin, ymax)
@@ -0,0 +1,112 @@
+import os
+
+
+#loads the OpenCl and precision settings from .pyfractalrc
+def load_settings():
+    if os.path.exists(".pyfractalrc"):
+        print("Loading settings from .pyfractalrc...")
+        try:
+            f=open(".pyfractalrc","r")
+            contents=f.readlines()
+            f.close()
+
+            platformline = contents[0]
+            deviceline = contents[1]
+            precisionline = contents[2]
+            
+            #read in platform
+            platforms = platformline.split()
+            if platforms[0] != "platform":
+                print("Platform line incorrect")
+                return None
+            platform = int(platforms[1])
+            print("Platform = %d"%platform)
+            
+            #read in device
+            devices = deviceline.split()
+            if devices[0] != "device":
+                print("Devices line wrong")
+                return None
+            device = int(devices[1])
+            print("Device = %d"%device)
+            
+            #read in precision
+            precisions = precisionline.split()
+            if precisions[0] != "precision":
+                print("Problem with the precision line")
+                return None
+            precision = int(precisions[1])
+            print("Precision = %d"%precision)
+
+            return platform, device, precision
+        except Exception as e:
+            print(e)
+            return None
+    else:
+        print("No config file")
+        return None
+
+
+#Saves the OpenCL and precision settings to .pyfractalrc, with the preference table of auto-configuration (see
+#autoconfig.py) if there is one, a line for each backend: "prefer <precision> <platform> <device> <calculated in> <Mpixels/s>"
+def save_settings(platform,device,precision,preferences=None):
+    from .mandelbrot import precision_name
+    f = open('.pyfractalrc',"w")
+    f.write("platform %d\n"%platform)
+    f.write("device %d\n"%device)
+    f.write("precision %d\n"%precision)
+    if preferences is not None:
+        for key, entries in preferences.items():
+            for p, d, double, rate in entries:
+                f.write("prefer %s %d %d %s %.2f\n"%(key,p,d,precision_name(double),rate))
+    f.close()
+
+
+#Loads the preference table (see save_settings) from .pyfractalrc. Returns None if there is none
+def load_preferences():
+    from .mandelbrot import floatfloat
+    doubles = {"float": False, "double": True, "floatfloat": floatfloat}
+    try:
+        with open(".pyfractalrc","r") as f:
+            contents = f.readlines()
+    except OSError:
+        return None
+
+    preferences = {}
+    for line in contents[3:]:
+        words = line.split()
+        if len(words) != 6 or words[0] != "prefer" or words[4] not in doubles:
+            continue
+        try:
+            entry = (int(words[2]), int(words[3]), doubles[words[4]], float(words[5]))
+        except ValueError:
+            continue
+        preferences.setdefault(words[1],[]).append(entry)
+
+    if "single" not in preferences or "double" not in preferences:
+        return None
+    return preferences
+
+
+#adds the OpenCL and precision options of the command line tools to the argparse parser
+def add_device_arguments(parser):
+    parser.add_argument("--platform",type=int,help="OpenCL platform (-1 for the Numba fallback, -2 for every device, -3 for the NumPy fallback; default: from .pyfractalrc, else the Numba fallback)")
+    parser.add_argument("--device",type=int,help="OpenCL device (-1 for every device of the platform)")
+    parser.add_argument("--precision",type=int,choices=[0,1,2,3],help="0 single, 1 double, 2 automatic, 3 float-float (default: from .pyfractalrc, else automatic)")
+
+
+#Returns the platform, device and precision to use: those from .pyfractalrc (or the Numba fallback with automatic
+#precision if there is none), overridden by any given on the command line (args, see add_device_arguments)
+def device_settings(args):
+    platform, device, precision = -1, -1, 2
+    config = load_settings()
+    if config is not None:
+        platform, device, precision = config
+    if args.platform is not None:
+        platform = args.platform
+        device = 0
+    if args.device is not None:
+        device = args.device
+    if args.precision is not None:
+        precision = args.precision
+    return platform, device, precision
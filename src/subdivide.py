@@ -0,0 +1,163 @@
+import numpy as np
+try:
+    import numba
+    jit = numba.jit(nopython=True)
+except ImportError:
+    #without Numba (the NumPy backend, see npkernels.py) the helpers below run as plain Python, which is slower
+    def jit(f):
+        return f
+
+from . import metrics
+
+#Renders the Mandelbrot set by boundary subdivision (the Mariani-Silver algorithm).
+#As the Mandelbrot set (and each band of equal iteration count around it) is connected and has no holes,
+#if every pixel on the border of a rectangle has the same value, so does every pixel inside it. Starting with
+#the whole image, we calculate only the borders of the rectangles: rectangles with uniform borders are filled
+#in, the others are split into four and their children's borders (the two lines splitting them) calculated.
+#All the border pixels of one level of the subdivision are calculated together with Mandelbrot.calculate_points,
+#so this works with the OpenCL, Numba and NumPy backends with one kernel launch per level.
+
+#rectangles whose interior is this many pixels across or fewer are calculated directly rather than subdivided
+minsize = 8
+
+
+#Returns the flat indices (i + nx*j) of the border pixels of the rectangles (i0, i1, j0, j1, all inclusive)
+#which have not been requested yet, and marks them as requested
+@jit
+def border_pixels(rects, requested, nx):
+    count = 0
+    for r in range(rects.shape[0]):
+        count += 2*(rects[r,1]-rects[r,0]+1) + 2*(rects[r,3]-rects[r,2]+1)
+
+    out = np.empty(count,np.int32)
+    m = 0
+    for r in range(rects.shape[0]):
+        i0, i1, j0, j1 = rects[r,0], rects[r,1], rects[r,2], rects[r,3]
+        for i in range(i0,i1+1):
+            for j in (j0, j1):
+                k = i + nx*j
+                if not requested[k]:
+                    requested[k] = True
+                    out[m] = k
+                    m += 1
+        for j in range(j0+1,j1):
+            for i in (i0, i1):
+                k = i + nx*j
+                if not requested[k]:
+                    requested[k] = True
+                    out[m] = k
+                    m += 1
+
+    return out[:m]
+
+
+#Classifies the rectangles, whose borders must already be in values. Rectangles whose border values differ by
+#at most tolerance have their interiors filled in (with the border value, or the mean border value if tolerance > 0).
+#Small rectangles have their interior pixels returned to be calculated directly, and the rest are split into four.
+#Returns the child rectangles, the pixels to calculate directly and the number of pixels filled in
+@jit
+def split_rects(rects, values, requested, nx, tolerance, minsize):
+    children = np.empty((4*rects.shape[0],4),np.int64)
+    nchildren = 0
+
+    count = 0
+    for r in range(rects.shape[0]):
+        count += max(0,rects[r,1]-rects[r,0]-1)*max(0,rects[r,3]-rects[r,2]-1)
+    direct = np.empty(count,np.int32)
+    ndirect = 0
+    nfilled = 0
+
+    for r in range(rects.shape[0]):
+        i0, i1, j0, j1 = rects[r,0], rects[r,1], rects[r,2], rects[r,3]
+
+        #nothing inside the border
+        if i1-i0 < 2 or j1-j0 < 2:
+            continue
+
+        first = values[i0 + nx*j0]
+        vmin = first
+        vmax = first
+        vsum = 0.
+        nborder = 0
+        for i in range(i0,i1+1):
+            for j in (j0, j1):
+                v = values[i + nx*j]
+                vmin = min(vmin,v)
+                vmax = max(vmax,v)
+                vsum += v
+                nborder += 1
+        for j in range(j0+1,j1):
+            for i in (i0, i1):
+                v = values[i + nx*j]
+                vmin = min(vmin,v)
+                vmax = max(vmax,v)
+                vsum += v
+                nborder += 1
+
+        if vmax - vmin <= tolerance:
+            #uniform border: fill in the interior
+            for j in range(j0+1,j1):
+                for i in range(i0+1,i1):
+                    k = i + nx*j
+                    if tolerance > 0:
+                        values[k] = vsum/nborder
+                    else:
+                        values[k] = first
+                    requested[k] = True
+                    nfilled += 1
+        elif i1-i0-1 <= minsize or j1-j0-1 <= minsize:
+            #too small to be worth subdividing, calculate the interior
+            for j in range(j0+1,j1):
+                for i in range(i0+1,i1):
+                    k = i + nx*j
+                    if not requested[k]:
+                        requested[k] = True
+                        direct[ndirect] = k
+                        ndirect += 1
+        else:
+            im = (i0+i1)//2
+            jm = (j0+j1)//2
+            for a, b, c, d in ((i0,im,j0,jm), (im,i1,j0,jm), (i0,im,jm,j1), (im,i1,jm,j1)):
+                children[nchildren,0] = a
+                children[nchildren,1] = b
+                children[nchildren,2] = c
+                children[nchildren,3] = d
+                nchildren += 1
+
+    return children[:nchildren], direct[:ndirect], nfilled
+
+
+#Calculates the nx by ny image of the view with mandelbrot (a Mandelbrot object) by boundary subdivision.
+#Discrete images are exact (identical to Mandelbrot.calculate). For continuous images, rectangles whose border
+#values are all within tolerance of each other are filled with their mean border value (tolerance = 0 is exact)
+def subdivide(mandelbrot,xmin=-2,xmax=1,ymin=-1.5,ymax=1.5,real=False,double=False,nx=1000,ny=1000,tolerance=0.,maxiter=256):
+    if real:
+        dtype = np.float32
+    else:
+        dtype = np.int32
+        tolerance = 0
+
+    values = np.zeros(nx*ny,dtype=dtype)
+    requested = np.zeros(nx*ny,dtype=np.bool_)
+
+    rects = np.array([[0,nx-1,0,ny-1]],dtype=np.int64)
+    direct = np.zeros(0,dtype=np.int32)
+
+    stats = {"pixels": nx*ny, "cardioid": 0, "periodic": 0, "calculated": 0, "filled": 0}
+    while len(rects) > 0 or len(direct) > 0:
+        mandelbrot.checkCancel()
+
+        #calculate the borders of this level's rectangles along with the interiors of the last level's small ones
+        index = np.concatenate((direct,border_pixels(rects,requested,nx)))
+        values[index] = mandelbrot.calculate_points(index,xmin,xmax,ymin,ymax,real=real,double=double,nx=nx,ny=ny,maxiter=maxiter)
+        stats["calculated"] += len(index)
+        stats["cardioid"] += mandelbrot.stats["cardioid"]
+        stats["periodic"] += mandelbrot.stats["periodic"]
+
+        rects, direct, n = split_rects(rects,values,requested,nx,tolerance,minsize)
+        stats["filled"] += n
+
+    metrics.counter("subdivision_calculated",stats["calculated"],total=nx*ny)
+    mandelbrot.stats = stats
+
+    return values.reshape((ny,nx))
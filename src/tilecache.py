@@ -0,0 +1,226 @@
+import os
+import re
+import math
+import collections
+
+import numpy as np
+
+from .mandelbrot import floatfloat
+
+
+#pixel size at zoom level 0. This is the pixel size of the default view (4 units across 1000 pixels),
+#so every zoom in/out by a factor of two from the default view lands exactly on a level
+base_pixel = 4./1000
+
+#width and height of a tile in pixels
+tile_pixels = 256
+
+
+#Cache of rendered tiles on a power-of-two grid. At zoom level L the pixel size is base_pixel/2^L and
+#tile (tx, ty) covers the pixels tx*tile_pixels <= i < (tx+1)*tile_pixels (and similarly in y), where pixel i
+#is centred on (i+0.5)*pixel size. Tiles are held in memory with least-recently-used eviction once the
+#memory budget (in bytes) is exceeded. If a directory is given, tiles are also written there as .npy files,
+#which are memory-mapped back in when they are not in memory, so the cache survives restarts. Each use of a tile
+#touches its file, so once the disk budget is exceeded the least recently used files are deleted.
+#Tiles are kept apart by everything which changes their values: besides the view and the iteration budget, the
+#precision, the backend which calculated them and the tolerance of boundary subdivision (see subdivide.py).
+class TileCache():
+    def __init__(self,budget=256*1024*1024,directory=None,disk_budget=4*1024*1024*1024):
+        self.budget = budget
+        self.directory = directory
+        self.disk_budget = disk_budget
+
+        #key -> tile, ordered from least to most recently used
+        self.tiles = collections.OrderedDict()
+        self.nbytes = 0
+
+        self.hits = 0
+        self.misses = 0
+
+        self.disk_nbytes = 0
+        if self.directory is not None:
+            os.makedirs(self.directory,exist_ok=True)
+            for entry in os.scandir(self.directory):
+                if entry.name.endswith(".npy"):
+                    self.disk_nbytes += entry.stat().st_size
+
+    #returns the zoom level for pixel size dx, or None if dx is not on the power-of-two grid
+    def level(self,dx):
+        if dx <= 0:
+            return None
+        l = math.log2(base_pixel/dx)
+        level = int(round(l))
+        if abs(l-level) > 1E-6:
+            return None
+        return level
+
+    #the key a tile calculated by mandelbrot is stored under
+    def key(self,mandelbrot,level,tx,ty,real,precision,maxiter):
+        #boundary subdivision only changes continuous images, by up to the tolerance (see Mandelbrot.calculate_async)
+        tolerance = mandelbrot.subdivide_tolerance if mandelbrot.subdivide and real else 0.
+        return (level, tx, ty, real, precision, maxiter, mandelbrot.backend, tolerance)
+
+    def filename(self,key):
+        level, tx, ty, real, precision, niter, backend, tolerance = key
+        if real:
+            kind = "real"
+        else:
+            kind = "int"
+        backend = re.sub(r"[^A-Za-z0-9]+","-",backend).strip("-")
+        return os.path.join(self.directory,"L%d_x%d_y%d_%s_%s_%d_%s_t%g.npy"%(level,tx,ty,kind,precision,niter,backend,tolerance))
+
+    #marks the tile stored under key as just used on disk, so _prune_disk keeps it
+    def touch(self,key):
+        if self.directory is not None:
+            try:
+                os.utime(self.filename(key))
+            except OSError:
+                pass
+
+    #returns the tile stored under key, or None if it is not in the cache
+    def get(self,key):
+        if key in self.tiles:
+            self.tiles.move_to_end(key)
+            self.hits += 1
+            self.touch(key)
+            return self.tiles[key]
+
+        if self.directory is not None:
+            fname = self.filename(key)
+            if os.path.exists(fname):
+                try:
+                    tile = np.load(fname,mmap_mode="r")
+                except (OSError, ValueError) as e:
+                    print("Could not read cached tile %s: %s"%(fname,e))
+                else:
+                    self.hits += 1
+                    self.touch(key)
+                    self._insert(key,tile)
+                    return tile
+
+        self.misses += 1
+        return None
+
+    #adds a tile to the cache, writing it to disk if the cache has a directory
+    def put(self,key,tile):
+        if self.directory is not None:
+            fname = self.filename(key)
+            np.save(fname,tile)
+            self.disk_nbytes += os.path.getsize(fname)
+            if self.disk_nbytes > self.disk_budget:
+                self._prune_disk()
+
+        self._insert(key,tile)
+
+    def _insert(self,key,tile):
+        if key in self.tiles:
+            self.nbytes -= self.tiles.pop(key).nbytes
+        self.tiles[key] = tile
+        self.nbytes += tile.nbytes
+
+        #evict the least recently used tiles
+        while self.nbytes > self.budget and len(self.tiles) > 1:
+            k, t = self.tiles.popitem(last=False)
+            self.nbytes -= t.nbytes
+
+    #deletes the least recently used tiles on disk (see touch) until the disk usage is back under 3/4 of the disk budget
+    def _prune_disk(self):
+        entries = [e for e in os.scandir(self.directory) if e.name.endswith(".npy")]
+        entries.sort(key=lambda e: e.stat().st_mtime)
+
+        self.disk_nbytes = sum(e.stat().st_size for e in entries)
+        for entry in entries:
+            if self.disk_nbytes <= 0.75*self.disk_budget:
+                break
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self.disk_nbytes -= size
+
+    #empties the in-memory cache (tiles on disk are kept)
+    def clear(self):
+        self.tiles.clear()
+        self.nbytes = 0
+
+    #Places the view on the tile grid. Returns the zoom level, the precision tiles are calculated in, the pixel size
+    #and the global indices of the view's first pixel (snapped to the nearest pixel of the grid), or None if the
+    #view is not on the tile grid
+    def grid(self,mandelbrot,xmin,xmax,ymin,ymax,double,nx,ny):
+        dx = (xmax-xmin)/nx
+        dy = (ymax-ymin)/ny
+        if abs(dy-dx) > 1E-6*dx:
+            return None
+        level = self.level(dx)
+        if level is None:
+            return None
+
+        #the Numba fallback calculates in double precision unless float-float is asked for (and the NumPy fallback always
+        #does, see npkernels.py)
+        if double == floatfloat and mandelbrot.backend != "numpy":
+            precision = "floatfloat"
+        elif double or mandelbrot.fallback:
+            precision = "double"
+        else:
+            precision = "single"
+
+        d = base_pixel*2.**(-level)
+
+        #global index of the first pixel in the view
+        gi0 = int(round(xmin/d))
+        gj0 = int(round(ymin/d))
+
+        return level, precision, d, gi0, gj0
+
+    #returns True if every tile of the view is in the cache (in memory or on disk), so render will not calculate anything
+    def cached(self,mandelbrot,xmin=-2,xmax=1,ymin=-1.5,ymax=1.5,real=False,double=False,nx=1000,ny=1000,maxiter=256):
+        grid = self.grid(mandelbrot,xmin,xmax,ymin,ymax,double,nx,ny)
+        if grid is None:
+            return False
+        level, precision, d, gi0, gj0 = grid
+        T = tile_pixels
+
+        for ty in range(gj0//T,(gj0+ny-1)//T+1):
+            for tx in range(gi0//T,(gi0+nx-1)//T+1):
+                key = self.key(mandelbrot,level,tx,ty,real,precision,maxiter)
+                if key not in self.tiles and (self.directory is None or not os.path.exists(self.filename(key))):
+                    return False
+        return True
+
+    #Renders the view using mandelbrot (a Mandelbrot object), taking any tiles it can from the cache and only
+    #calculating the missing ones. The view is snapped to the nearest pixel of the tile grid.
+    #Returns the image and the snapped (xmin, xmax, ymin, ymax), or None if the view is not on the tile grid
+    #(in which case the caller should calculate it directly)
+    def render(self,mandelbrot,xmin=-2,xmax=1,ymin=-1.5,ymax=1.5,real=False,double=False,nx=1000,ny=1000,maxiter=256):
+        grid = self.grid(mandelbrot,xmin,xmax,ymin,ymax,double,nx,ny)
+        if grid is None:
+            return None
+        level, precision, d, gi0, gj0 = grid
+        T = tile_pixels
+
+        if real:
+            img = np.empty((ny,nx),dtype=np.float32)
+        else:
+            img = np.empty((ny,nx),dtype=np.int32)
+
+        for ty in range(gj0//T,(gj0+ny-1)//T+1):
+            for tx in range(gi0//T,(gi0+nx-1)//T+1):
+                key = self.key(mandelbrot,level,tx,ty,real,precision,maxiter)
+                tile = self.get(key)
+                if tile is None:
+                    mandelbrot.checkCancel()
+                    if real:
+                        tile = mandelbrot.calculate_real(tx*T*d,(tx+1)*T*d,ty*T*d,(ty+1)*T*d,double=double,nx=T,ny=T,maxiter=maxiter)
+                    else:
+                        tile = mandelbrot.calculate(tx*T*d,(tx+1)*T*d,ty*T*d,(ty+1)*T*d,double=double,nx=T,ny=T,maxiter=maxiter)
+                    self.put(key,tile)
+
+                #copy the part of the tile that overlaps the view
+                i0 = max(gi0,tx*T)
+                i1 = min(gi0+nx,(tx+1)*T)
+                j0 = max(gj0,ty*T)
+                j1 = min(gj0+ny,(ty+1)*T)
+                img[j0-gj0:j1-gj0,i0-gi0:i1-gi0] = tile[j0-ty*T:j1-ty*T,i0-tx*T:i1-tx*T]
+
+        return img, (gi0*d, (gi0+nx)*d, gj0*d, (gj0+ny)*d)
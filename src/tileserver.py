@@ -0,0 +1,384 @@
+import os
+import sys
+import json
+import time
+import queue
+import asyncio
+import argparse
+import collections
+import concurrent.futures
+from urllib.parse import urlsplit, parse_qs
+
+import numpy as np
+
+from . import pngs
+from . import view
+from . import perturbation
+from .mandelbrot import choose_maxiter, max_maxiter
+from .settings import add_device_arguments, device_settings
+
+
+#HTTP tile server: python pyFractal.py serve
+#Serves the set as slippy map tiles (the z/x/y addressing of web map viewers such as Leaflet or OpenLayers), so a web
+#viewer can pan and zoom around it:
+#  GET /tiles/{z}/{x}/{y}.png   a coloured tile_pixels x tile_pixels PNG
+#  GET /tiles/{z}/{x}/{y}.f32   the raw values, as little-endian float32s from the top row down (the X-Maxiter
+#                               header gives the iteration budget)
+#  GET /stats                   the server's counters, as JSON
+#with the optional query parameters maxiter, continuous (0 or 1), and for PNGs cmap and scaling (as in the GUI).
+#Zoom level 0 is a single tile covering world; each level halves the tiles' size, with x to the right and y down.
+#The server is one asyncio event loop handling every connection (HTTP/1.1 with keep-alive), which never calculates
+#anything itself: tiles are rendered and encoded on a bounded pool of worker threads, each with its own Mandelbrot
+#object (on the same device they share its context, queues and programs). Rendered tiles are kept, encoded, in an
+#LRU cache of at most cache_bytes, and a request for a tile which is already being rendered waits for that render
+#rather than starting another (a viewer opening on a view asks every client for the same tiles at once). Once
+#max_pending tiles are being rendered or waiting for a worker, new tiles are refused (503) rather than queueing
+#without bound, so the latency of the tiles being served stays bounded under overload.
+#Every tile of a zoom level has the same iteration budget and colour scale (the scaled range 1 ... maxiter), so
+#neighbouring tiles join without seams. Deep zoom levels are calculated with perturbation theory (see perturbation.py).
+#src/loadgen.py measures the throughput and latency of a running server.
+
+#the size of the tiles in pixels
+tile_pixels = 256
+
+#the view covered by the single tile of zoom level 0 (xmin, xmax, ymin, ymax, as exact decimal strings)
+world = ("-2.5", "1.5", "-2", "2")
+
+#the deepest zoom level served
+max_zoom = 128
+
+#the most bytes of encoded tiles kept in the cache
+cache_bytes = 256*1024*1024
+
+#the most tiles being rendered or waiting for a worker at once
+max_pending = 256
+
+#the tile formats, and their content types
+formats = {"png": "image/png", "f32": "application/octet-stream"}
+
+
+#The tile requested: its zoom level and position, its format (see formats), whether it is continuous, its iteration
+#budget and, for PNGs, the scaling and colourmap (None for raw tiles, so requests differing only in those share a tile)
+Tile = collections.namedtuple("Tile",["z", "x", "y", "format", "real", "maxiter", "scaling", "cmap"])
+
+
+#raised when a request cannot be served, with the HTTP status to answer it with
+class HTTPError(Exception):
+    def __init__(self,status,message):
+        super().__init__(message)
+        self.status = status
+
+
+#the reason phrases of the HTTP statuses answered with
+reasons = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed", 500: "Internal Server Error",
+           503: "Service Unavailable"}
+
+
+#returns the exact view (xmin, xmax, ymin, ymax, as Decimals) of tile x, y of zoom level z
+def tile_view(z,x,y):
+    ctx = perturbation.context
+    xmin, xmax, ymin, ymax = [perturbation.exact(v) for v in world]
+    size = ctx.divide(ctx.subtract(xmax,xmin),2**z)
+    left = ctx.add(xmin,ctx.multiply(size,x))
+    top = ctx.subtract(ymax,ctx.multiply(size,y))
+    return left, ctx.add(left,size), ctx.subtract(top,size), top
+
+#returns the x, y of the tile of zoom level z containing the point cx, cy
+def tile_containing(z,cx,cy):
+    xmin, xmax, ymin, ymax = [float(v) for v in world]
+    n = 2**z
+    x = int((cx-xmin)/(xmax-xmin)*n)
+    y = int((ymax-cy)/(ymax-ymin)*n)
+    return min(n-1,max(0,x)), min(n-1,max(0,y))
+
+#returns the width of a 1000 pixel wide view (the GUI's frame) with the pixel size of the tiles of zoom level z, so
+#tiles get the iteration budget choose_maxiter gives the GUI at the same pixel size
+def equivalent_width(z):
+    xmin, xmax, ymin, ymax = [float(v) for v in world]
+    return (xmax-xmin)/2**z/tile_pixels*1000
+
+
+#Returns the Tile requested by the path and query of a URL, raising HTTPError if it is not a valid tile
+def parse_tile(path,query,zoom_limit=max_zoom):
+    from .export import scalings
+    parts = path.strip("/").split("/")
+    if len(parts) != 4 or parts[0] != "tiles":
+        raise HTTPError(404,"Not found: %s"%path)
+    name, dot, extension = parts[3].partition(".")
+    if extension not in formats:
+        raise HTTPError(404,"Unknown tile format '%s' (use %s)"%(extension,", ".join(formats)))
+    try:
+        z, x, y = int(parts[1]), int(parts[2]), int(name)
+    except ValueError:
+        raise HTTPError(400,"Bad tile address: %s"%path)
+    if not 0 <= z <= zoom_limit:
+        raise HTTPError(404,"Zoom level %d is outside 0 ... %d"%(z,zoom_limit))
+    if not (0 <= x < 2**z and 0 <= y < 2**z):
+        raise HTTPError(404,"Tile %d/%d is outside zoom level %d"%(x,y,z))
+
+    params = {key: values[-1] for key, values in parse_qs(query).items()}
+    try:
+        maxiter = int(params["maxiter"]) if "maxiter" in params else choose_maxiter(equivalent_width(z))
+    except ValueError:
+        raise HTTPError(400,"Bad maxiter '%s'"%params["maxiter"])
+    if not 1 <= maxiter <= max_maxiter:
+        raise HTTPError(400,"maxiter must be from 1 to %d"%max_maxiter)
+    real = params.get("continuous","0").lower() in ("1", "true", "yes")
+
+    scaling = cmap = None
+    if extension == "png":
+        scaling = params.get("scaling","Linear")
+        if scaling not in scalings:
+            raise HTTPError(400,"Unknown scaling '%s' (use %s)"%(scaling,", ".join(scalings)))
+        cmap = params.get("cmap","viridis")
+    return Tile(z,x,y,extension,real,maxiter,scaling,cmap)
+
+
+#Least recently used cache of encoded tiles, holding at most capacity bytes of them
+class LRUCache():
+    def __init__(self,capacity):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.size = 0
+
+    #returns the tile stored under key (marking it as the most recently used), or None
+    def get(self,key):
+        body = self.entries.get(key)
+        if body is not None:
+            self.entries.move_to_end(key)
+        return body
+
+    #stores body under key, dropping the least recently used tiles to make room
+    def put(self,key,body):
+        if len(body) > self.capacity:
+            return
+        old = self.entries.pop(key,None)
+        if old is not None:
+            self.size -= len(old)
+        self.entries[key] = body
+        self.size += len(body)
+        while self.size > self.capacity:
+            key, old = self.entries.popitem(last=False)
+            self.size -= len(old)
+
+
+class TileServer():
+    #mandelbrots are the Mandelbrot objects to render with, one per worker thread. precision is the precision setting
+    #(0 single, 1 double, 2 automatic, 3 float-float)
+    def __init__(self,mandelbrots,precision=2,cache_bytes=cache_bytes,max_pending=max_pending,max_zoom=max_zoom):
+        self.precision = precision
+        self.max_pending = max_pending
+        self.max_zoom = max_zoom
+        self.cache = LRUCache(cache_bytes)
+
+        #the Mandelbrot objects not in use. There are as many worker threads as objects, so one is always free
+        self.idle = queue.Queue()
+        for mandelbrot in mandelbrots:
+            self.idle.put(mandelbrot)
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(mandelbrots),thread_name_prefix="tileserver")
+
+        #the renders in progress or waiting for a worker, by Tile (only touched on the event loop's thread)
+        self.inflight = {}
+
+        #the colour tables of the colourmaps asked for, by name
+        self.tables = {}
+
+        self.stats = collections.Counter()
+        self.tstart = time.time()
+
+    #returns the colour table of the colourmap cmap, raising HTTPError if there is no such colourmap
+    def colourTable(self,cmap):
+        if cmap not in self.tables:
+            from .export import colour_table
+            try:
+                self.tables[cmap] = colour_table(cmap)
+            except (KeyError, ValueError):
+                raise HTTPError(400,"Unknown colourmap '%s'"%cmap)
+        return self.tables[cmap]
+
+    #Renders and encodes tile with a free Mandelbrot object. Runs on a worker thread
+    def render(self,tile,table):
+        mandelbrot = self.idle.get()
+        try:
+            return self.renderTile(mandelbrot,tile,table)
+        finally:
+            self.idle.put(mandelbrot)
+
+    #renders and encodes tile with mandelbrot, colouring PNGs with table. Returns the encoded tile
+    def renderTile(self,mandelbrot,tile,table):
+        from .export import colour_limits
+        tstart = time.perf_counter()
+        n = tile_pixels
+        xorigin, yorigin, xmin, xmax, ymin, ymax = view.split_view(*tile_view(tile.z,tile.x,tile.y),nx=n)
+        if view.is_deep(xmin,xmax,n):
+            img = mandelbrot.calculate_deep(xorigin,yorigin,xmin,xmax,ymin,ymax,real=tile.real,nx=n,ny=n,maxiter=tile.maxiter)
+        else:
+            double = view.use_double(self.precision,xmin,xmax,mandelbrot.double_precision,nx=n)
+            img = mandelbrot.calculate_async(xmin,xmax,ymin,ymax,real=tile.real,double=double,nx=n,ny=n,maxiter=tile.maxiter).result()
+
+        if tile.format == "png":
+            vmin, vmax = colour_limits([[1, 1, 1, tile.maxiter]],tile.scaling)
+            rgba = mandelbrot.colour_async(img,tile.scaling,vmin,vmax,table).result().view(np.uint8).reshape((n,n,4))
+            body = pngs.encode(rgba)
+        else:
+            body = np.ascontiguousarray(img[::-1],dtype="<f4").tobytes()
+        self.stats["render_seconds"] += time.perf_counter()-tstart
+        return body
+
+    #Returns the encoded tile and how it was served ("hit", "coalesced" or "miss"): from the cache, by waiting for
+    #the render of it in progress, or by rendering it. Raises HTTPError if the server is overloaded
+    async def getTile(self,tile):
+        body = self.cache.get(tile)
+        if body is not None:
+            self.stats["hits"] += 1
+            return body, "hit"
+
+        future = self.inflight.get(tile)
+        if future is not None:
+            self.stats["coalesced"] += 1
+            how = "coalesced"
+        else:
+            if len(self.inflight) >= self.max_pending:
+                self.stats["rejected"] += 1
+                raise HTTPError(503,"Too many tiles pending")
+            table = self.colourTable(tile.cmap) if tile.format == "png" else None
+            future = asyncio.get_running_loop().run_in_executor(self.executor,self.render,tile,table)
+            self.inflight[tile] = future
+            future.add_done_callback(lambda f: self.finished(tile,f))
+            self.stats["renders"] += 1
+            how = "miss"
+
+        #shielded, so a client hanging up does not cancel the render others are waiting for
+        try:
+            body = await asyncio.shield(future)
+        except Exception as e:
+            raise HTTPError(500,"%s: %s"%(type(e).__name__,e))
+        return body, how
+
+    #called on the event loop when the render of tile (future) finishes: caches the encoded tile
+    def finished(self,tile,future):
+        del self.inflight[tile]
+        if future.cancelled() or future.exception() is not None:
+            self.stats["errors"] += 1
+        else:
+            self.cache.put(tile,future.result())
+
+    #returns the server's counters, as a dictionary
+    def statistics(self):
+        stats = dict(self.stats)
+        stats.update({"uptime": time.time()-self.tstart, "pending": len(self.inflight),
+                      "cached_tiles": len(self.cache.entries), "cached_bytes": self.cache.size})
+        return stats
+
+    #Answers a request for target (the path and query of the URL). Returns the status, the response headers (a
+    #dictionary) and the body
+    async def respond(self,method,target):
+        if method not in ("GET", "HEAD"):
+            raise HTTPError(405,"Method %s not allowed"%method)
+        url = urlsplit(target)
+        if url.path == "/stats":
+            return 200, {"Content-Type": "application/json", "Cache-Control": "no-store"}, json.dumps(self.statistics()).encode()
+        if url.path == "/":
+            usage = "pyFractal tile server\nGET /tiles/{z}/{x}/{y}.png or .f32 (?maxiter=&continuous=&cmap=&scaling=)\nGET /stats\n"
+            return 200, {"Content-Type": "text/plain"}, usage.encode()
+
+        tile = parse_tile(url.path,url.query,self.max_zoom)
+        #check the colourmap before getTile, so a bad one is refused (400) even when the server is overloaded (503)
+        if tile.format == "png":
+            self.colourTable(tile.cmap)
+        body, how = await self.getTile(tile)
+        headers = {"Content-Type": formats[tile.format], "Cache-Control": "public, max-age=86400",
+                   "X-Cache": how, "X-Maxiter": str(tile.maxiter)}
+        return 200, headers, body
+
+    #Serves the requests on one connection, until the client closes it or asks for it to be closed
+    async def handle(self,reader,writer):
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                request = line.decode("latin-1").split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, colon, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                #bodies are not used, but must be read past to reach the next request
+                if "content-length" in headers:
+                    await reader.readexactly(int(headers["content-length"]))
+
+                self.stats["requests"] += 1
+                if len(request) != 3 or not request[2].startswith("HTTP/"):
+                    status, response, body = 400, {"Content-Type": "text/plain"}, b"Bad request line\n"
+                    keep_alive = False
+                else:
+                    method, target, version = request
+                    connection = headers.get("connection","").lower()
+                    keep_alive = connection == "keep-alive" if version == "HTTP/1.0" else connection != "close"
+                    try:
+                        status, response, body = await self.respond(method,target)
+                    except HTTPError as e:
+                        status, response, body = e.status, {"Content-Type": "text/plain"}, (str(e)+"\n").encode()
+                    if status != 200:
+                        self.stats["status_%d"%status] += 1
+
+                head = ["HTTP/1.1 %d %s"%(status,reasons[status]),
+                        "Content-Length: %d"%len(body),
+                        "Connection: %s"%("keep-alive" if keep_alive else "close"),
+                        "Access-Control-Allow-Origin: *"]
+                if status == 503:
+                    head.append("Retry-After: 1")
+                head += ["%s: %s"%(name,value) for name, value in response.items()]
+                writer.write(("\r\n".join(head)+"\r\n\r\n").encode("latin-1"))
+                if len(request) != 3 or request[0] != "HEAD":
+                    writer.write(body)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+        finally:
+            writer.close()
+
+    #serves tiles on host:port until cancelled
+    async def serve(self,host,port):
+        server = await asyncio.start_server(self.handle,host,port)
+        print("Serving tiles on http://%s:%d/tiles/{z}/{x}/{y}.png"%(host,port))
+        async with server:
+            await server.serve_forever()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pyFractal.py serve",description="Serves slippy map tiles of the set over HTTP")
+    parser.add_argument("--host",default="127.0.0.1",help="address to listen on (default: 127.0.0.1)")
+    parser.add_argument("--port",type=int,default=8080,help="port to listen on (default: 8080)")
+    parser.add_argument("-j","--workers",type=int,default=2,help="number of worker threads rendering tiles (default: 2)")
+    parser.add_argument("--threads",type=int,help="Numba threads per worker (default: the cores divided between the workers)")
+    parser.add_argument("--cache-mb",type=float,default=cache_bytes/1024/1024,help="size of the cache of encoded tiles in MB (default: %d)"%(cache_bytes//1024//1024))
+    parser.add_argument("--max-pending",type=int,default=max_pending,help="most tiles rendering or queued before new ones are refused (default: %d)"%max_pending)
+    parser.add_argument("--max-zoom",type=int,default=max_zoom,help="deepest zoom level served (default: %d)"%max_zoom)
+    add_device_arguments(parser)
+    args = parser.parse_args(argv)
+
+    from .multidevice import create_mandelbrot
+    platform, device, precision = device_settings(args)
+    workers = max(1,args.workers)
+    nthreads = args.threads
+    if nthreads is None:
+        nthreads = max(1,os.cpu_count()//workers)
+    mandelbrots = [create_mandelbrot(platform,device,nthreads=nthreads) for k in range(workers)]
+
+    server = TileServer(mandelbrots,precision=precision,cache_bytes=int(args.cache_mb*1024*1024),
+                        max_pending=args.max_pending,max_zoom=args.max_zoom)
+    try:
+        asyncio.run(server.serve(args.host,args.port))
+    except KeyboardInterrupt:
+        pass
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,121 @@
+import os
+import json
+
+import numpy as np
+
+from .mandelbrot import device_key, precision_name, floatfloat
+
+
+#Tunes the launch configuration of the OpenCL image kernels for each device: how many neighbouring pixels each
+#work-item calculates (1, or 2, 4 or 8 with the vector kernels, which iterate them in the lanes of vectors) and the
+#shape of the work-groups (or None, leaving it to the driver). Which is fastest depends on the device and its driver
+#(CPU runtimes such as PoCL vectorise across work-items themselves, some better than others), so the first time a
+#device is used in each precision every configuration is timed on a test view, and the fastest is kept in the tuning
+#cache. Entries are keyed by the device and its driver version, so updating either tunes the device again.
+#Only configurations giving exactly the same image as one pixel per work-item are considered.
+
+#file the tuned configurations are kept in between runs (None to tune every run)
+tuning_cache = os.path.join(".pyfractalcache","tuning.json")
+
+#the configurations tried: pixels per work-item (there are no float-float vector kernels, so those only try 1), and
+#work-group shapes (rows, work-items per row)
+widths = [1, 2, 4, 8]
+shapes = [None, (1,8), (1,16), (1,32), (1,64), (4,8), (8,8), (16,16)]
+
+#the test view (with escape times from 1 to the whole budget, and parts of the cardioid and of the bulbs, whose
+#points are short-circuited) and its size in pixels
+view = (-1.6, 0.4, -1.0, 1.0)
+size = 512
+
+#number of times each configuration is timed (the fastest time is used)
+repeats = 3
+
+
+def load_cache():
+    if tuning_cache is None:
+        return {}
+    try:
+        with open(tuning_cache,"r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+#writes the cache, replacing the old one in one step so an interruption never leaves a partial file
+def save_cache(cache):
+    if tuning_cache is None:
+        return
+    try:
+        os.makedirs(os.path.dirname(tuning_cache),exist_ok=True)
+        with open(tuning_cache+".tmp","w") as f:
+            json.dump(cache,f,indent=1)
+        os.replace(tuning_cache+".tmp",tuning_cache)
+    except OSError as e:
+        print("Could not save the tuning cache %s: %s"%(tuning_cache,e))
+
+
+#Calculates the test view with mandelbrot in the launch configuration (width, local). Returns the image and the
+#fastest kernel time in seconds
+def run(mandelbrot,double,width,local):
+    import pyopencl as cl
+    xmin, xmax, ymin, ymax = view
+    dx = (xmax-xmin)/size
+    dy = (ymax-ymin)/size
+
+    img = np.empty((size,size),dtype=np.int32)
+    buf = cl.Buffer(mandelbrot.context,cl.mem_flags.WRITE_ONLY,img.nbytes)
+    statsBuf = cl.Buffer(mandelbrot.context,cl.mem_flags.READ_WRITE,8)
+
+    best = None
+    for r in range(repeats):
+        event = mandelbrot.launch("mandelbrot",buf,xmin,dx,ymin,dy,size,size,0,double,256,statsBuf,width,local)
+        event.wait()
+        t = (event.get_profiling_info(cl.profiling_info.END)-event.get_profiling_info(cl.profiling_info.START))/1E9
+        if best is None or t < best:
+            best = t
+    cl.enqueue_copy(mandelbrot.queue,img,buf)
+    return img, best
+
+
+#Returns the fastest launch configuration (width, local) of mandelbrot's device in the precision double (see
+#mandelbrot.floatfloat), from the tuning cache if the device has been tuned before
+def tune(mandelbrot,double):
+    import pyopencl as cl
+    precision = precision_name(double)
+    key = device_key(mandelbrot.device)
+
+    cache = load_cache()
+    if precision in cache.get(key,{}):
+        width, local = cache[key][precision]
+        return width, (tuple(local) if local is not None else None)
+
+    print("Tuning the OpenCL kernels for %s (%s precision)..."%(mandelbrot.device.name,precision))
+    maxgroup = mandelbrot.device.max_work_group_size
+    reference = None
+    results = []
+    for width in (widths if double != floatfloat else [1]):
+        for local in shapes:
+            if local is not None and local[0]*local[1] > maxgroup:
+                continue
+            try:
+                img, t = run(mandelbrot,double,width,local)
+            except cl.Error as e:
+                #e.g. a work-group shape the kernel cannot be launched with
+                continue
+
+            if reference is None:
+                reference = img
+            elif not np.array_equal(img,reference):
+                print("Skipping %d pixels per work-item: the image differs"%width)
+                break
+            results.append((t, width, local))
+
+    if len(results) == 0:
+        return 1, None
+    untuned = results[0][0]
+    t, width, local = min(results,key=lambda r: r[0])
+    print("Tuned: %d pixels per work-item, work-groups %s (%.2f ms, %.2f ms untuned)"%(width,"x".join(str(l) for l in local) if local is not None else "chosen by the driver",1E3*t,1E3*untuned))
+
+    cache = load_cache()
+    cache.setdefault(key,{})[precision] = [width, list(local) if local is not None else None]
+    save_cache(cache)
+    return width, local
@@ -0,0 +1,90 @@
+from decimal import Decimal
+
+from . import perturbation
+from .mandelbrot import floatfloat
+
+
+#Describing and saving views, shared by the GUI and the batch renderer (so this must not import Qt).
+#A view is kept as an exact (decimal.Decimal) origin xorigin, yorigin plus float offsets xmin ... ymax from it.
+#The origin is only non-zero for deep zooms, otherwise xmin ... ymax are the actual coordinates.
+
+#pixel size below which the view is calculated using perturbation theory, as double precision runs out
+deep_pixel = 1E-14
+
+#pixel size below which automatic precision calculates in double precision (or float-float)
+double_pixel = 1E-7
+
+#The precision needed depends on the pixel size, so the functions below take the width of the image in pixels, nx.
+#By default this is the width of the GUI's frame (1000 pixels); exports, keyframes and tiles pass their own
+
+
+#returns True if a view xmin ... xmax wide, nx pixels across, is deep enough to need perturbation theory
+def is_deep(xmin,xmax,nx=1000):
+    return (xmax-xmin)/nx < deep_pixel
+
+
+#Returns the precision to calculate in (the double argument of the calculate functions: False, True or floatfloat) for
+#the precision setting (0 single, 1 double, 2 automatic, 3 float-float) and a view xmin ... xmax wide, nx pixels
+#across. dp is whether the device supports double precision: if not, float-float is used in its place
+def use_double(precision,xmin,xmax,dp=True,nx=1000):
+    double = True if dp else floatfloat
+    if precision == 0:
+        return False
+    elif precision == 1:
+        return double
+    elif precision == 2:
+        #switch to DP (or float-float) when pixel size is 1E-7
+        if (xmax-xmin)/nx < double_pixel:
+            return double
+        return False
+    elif precision == 3:
+        return floatfloat
+    else:
+        raise ValueError("precision is not a valid value: %d"%precision)
+
+
+#Returns the backend to calculate a view xmin ... xmax wide (nx pixels across) on under automatic precision, from the preference table
+#preferences of auto-configuration (see autoconfig.py): the fastest in single precision, or once the view needs it,
+#in double precision or float-float. Deep zooms are calculated in double precision whatever the backend (see
+#perturbation.py), so for them it is the fastest in double precision. Returns its platform, device and the precision
+#to calculate in (the double argument of the calculate functions)
+def preferred_backend(preferences,xmin,xmax,nx=1000):
+    if is_deep(xmin,xmax,nx):
+        entries = [e for e in preferences["double"] if e[2] is True] or preferences["double"]
+    elif use_double(2,xmin,xmax,nx=nx):
+        entries = preferences["double"]
+    else:
+        entries = preferences["single"]
+    platform, device, double, rate = entries[0]
+    return platform, device, double
+
+
+#Splits the exact view xmin ... ymax (Decimals, or strings or floats), nx pixels across, into the origin and offsets it
+#is kept as. Returns xorigin, yorigin, xmin, xmax, ymin, ymax
+def split_view(xmin,xmax,ymin,ymax,nx=1000):
+    ctx = perturbation.context
+    xmin, xmax, ymin, ymax = [perturbation.exact(v) for v in (xmin, xmax, ymin, ymax)]
+    xorigin = ctx.divide(ctx.add(xmin,xmax),2)
+    yorigin = ctx.divide(ctx.add(ymin,ymax),2)
+    offsets = [float(ctx.subtract(xmin,xorigin)), float(ctx.subtract(xmax,xorigin)),
+               float(ctx.subtract(ymin,yorigin)), float(ctx.subtract(ymax,yorigin))]
+
+    if is_deep(offsets[0],offsets[1],nx):
+        return [xorigin, yorigin] + offsets
+    return [Decimal(0), Decimal(0), float(xmin), float(xmax), float(ymin), float(ymax)]
+
+
+#The display settings written to saved images so they can be re-opened by pyFractal
+#(the coordinates are exact decimal strings, so deep zooms can be restored)
+def image_metadata(xorigin,yorigin,xmin,xmax,ymin,ymax,scaling,cmap,cmap_inverted,real,maxiter):
+    return {
+        "xmin": str(perturbation.add(xorigin,xmin)),
+        "xmax": str(perturbation.add(xorigin,xmax)),
+        "ymin": str(perturbation.add(yorigin,ymin)),
+        "ymax": str(perturbation.add(yorigin,ymax)),
+        "scaling": scaling,
+        "cmap": cmap,
+        "cmap_inverted": cmap_inverted,
+        "continuous": real,
+        "maxiter": maxiter
+    }
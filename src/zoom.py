@@ -0,0 +1,221 @@
+import os
+import sys
+import json
+import math
+import time
+import argparse
+
+import numpy as np
+
+from . import pngs
+from . import view
+from . import perturbation
+from .settings import add_device_arguments, device_settings
+
+
+#Renders zoom movies: a numbered PNG sequence zooming in on a target point, which stays at the centre of the frame.
+#Rather than calculating every frame, keyframes are calculated at every power of two of the zoom, oversampled
+#(by default at twice the frame resolution in each direction). Every frame lies between two keyframes: it is inside
+#the larger one (keyframe k) and contains the smaller one (keyframe k+1), so it is resampled from keyframe k, with
+#the middle, covered by keyframe k+1, resampled from that instead. As the frame is never more than twice as zoomed in
+#as keyframe k, the oversampling keeps at least one keyframe pixel per frame pixel. So a zoom costs one
+#(oversampled) calculation per doubling, however many frames each doubling is spread over.
+#Only two keyframes are kept in memory, and each frame is written to disk as soon as it is made.
+
+#default number of frames for each doubling of the zoom
+frames_per_doubling = 30
+
+#default keyframe resolution, relative to the frames
+oversample = 2
+
+
+#Returns the exact bounds xmin, xmax, ymin, ymax (Decimals) of the view width x height centred on
+#xtarget, ytarget zoomed in by a factor of 2**k
+def keyframe_view(xtarget,ytarget,width,height,k):
+    halfwidth = 0.5*width*2.**-k
+    halfheight = 0.5*height*2.**-k
+    return (perturbation.add(xtarget,-halfwidth), perturbation.add(xtarget,halfwidth),
+            perturbation.add(ytarget,-halfheight), perturbation.add(ytarget,halfheight))
+
+
+#Calculates the continuous (calculate_real) image of a keyframe view with mandelbrot (a Mandelbrot object),
+#using perturbation theory for deep views and double precision as the precision setting asks
+def render_keyframe(mandelbrot,bounds,nx,ny,precision,maxiter):
+    xorigin, yorigin, xmin, xmax, ymin, ymax = view.split_view(*bounds,nx=nx)
+    if view.is_deep(xmin,xmax,nx):
+        return mandelbrot.calculate_deep(xorigin,yorigin,xmin,xmax,ymin,ymax,real=True,nx=nx,ny=ny,maxiter=maxiter)
+    double = view.use_double(precision,xmin,xmax,mandelbrot.double_precision,nx=nx)
+    return mandelbrot.calculate_real(xmin,xmax,ymin,ymax,double=double,nx=nx,ny=ny,maxiter=maxiter)
+
+
+#Returns the position (in pixels of a keyframe n pixels across) of each of the m pixel centres across a frame
+#zoomed in by a factor of ratio relative to the keyframe. Both are centred on the same point
+def sample_positions(m,n,ratio):
+    u = (np.arange(m)+0.5)/m - 0.5
+    return (u/ratio + 0.5)*n - 0.5
+
+
+#Bilinearly interpolates img at the pixel positions xs (columns) and ys (rows), returning an array of
+#len(ys) x len(xs). Positions outside the image take the value of the nearest edge pixel
+def resample(img,xs,ys):
+    ny, nx = img.shape
+    xs = np.clip(xs,0,nx-1)
+    ys = np.clip(ys,0,ny-1)
+    i0 = np.minimum(xs.astype(np.intp),nx-2)
+    j0 = np.minimum(ys.astype(np.intp),ny-2)
+    fx = (xs-i0).astype(np.float32)
+    fy = (ys-j0).astype(np.float32)[:,np.newaxis]
+
+    #interpolate along the rows first, then between them
+    rows = img[np.concatenate((j0,j0+1))]
+    rows = rows[:,i0]*(1-fx) + rows[:,i0+1]*fx
+    top = rows[:len(j0)]
+    bottom = rows[len(j0):]
+    return top*(1-fy) + bottom*fy
+
+
+#Makes the nx x ny frame zoomed in by ratio (1 <= ratio < 2) relative to keyframe outer, from outer and (where it
+#covers the frame) inner, the next keyframe in (which is zoomed in by 2 relative to outer)
+def make_frame(outer,inner,ratio,nx,ny):
+    oy, ox = outer.shape
+    frame = resample(outer,sample_positions(nx,ox,ratio),sample_positions(ny,oy,ratio))
+    if inner is None:
+        return frame
+
+    iy, ix = inner.shape
+    xs = sample_positions(nx,ix,ratio/2)
+    ys = sample_positions(ny,iy,ratio/2)
+    cols = np.nonzero((xs >= -0.5) & (xs <= ix-0.5))[0]
+    rows = np.nonzero((ys >= -0.5) & (ys <= iy-0.5))[0]
+    if len(cols) > 0 and len(rows) > 0:
+        frame[rows[0]:rows[-1]+1,cols[0]:cols[-1]+1] = resample(inner,xs[cols],ys[rows])
+    return frame
+
+
+#returns the range of the finite values of img after applying the display scaling
+def scaled_range(img,scaling):
+    from .export import scale
+    scaled = scale(np.array(img,dtype=np.float32),scaling)
+    finite = scaled[np.isfinite(scaled)]
+    if len(finite) == 0:
+        return 0., 1.
+    return float(finite.min()), float(finite.max())
+
+
+#Renders a zoom movie with mandelbrot (a Mandelbrot object) into outdir as the numbered PNGs name % frame. The zoom
+#starts from the view width across centred on xtarget, ytarget (floats, or strings/Decimals for deep zooms) and
+#zooms in by a factor of 2**doublings over frames*doublings frames (plus the final frame). The frames are nx x ny
+#pixels, and the keyframes nx*oversample x ny*oversample. The same iteration budget maxiter (by default chosen for
+#the final view) is used for every keyframe, so the colours of the set do not jump between them. precision is the
+#precision setting (0 single, 1 double, 2 automatic, 3 float-float). Each frame is coloured with the matplotlib
+#colourmap cmap after applying scaling (see export.scale), between limits blended from those of its two keyframes
+def zoom(mandelbrot,outdir,xtarget,ytarget,width=4.,doublings=10,frames=frames_per_doubling,nx=1280,ny=720,
+         oversample=oversample,precision=2,maxiter=None,scaling="Linear",cmap="viridis",name="frame%05d.png"):
+    import matplotlib
+    from .export import scale
+    from .mandelbrot import choose_maxiter
+
+    height = width*ny/nx
+    kx = nx*oversample
+    ky = ny*oversample
+    if maxiter is None:
+        maxiter = choose_maxiter(width*2.**-doublings)
+    colourmap = matplotlib.colormaps[cmap]
+    os.makedirs(outdir,exist_ok=True)
+
+    nframes = doublings*frames + 1
+    print("Rendering %d frames from %d keyframes (%d x %d, maxiter %d)"%(nframes,doublings+1,kx,ky,maxiter))
+
+    tstart = time.time()
+    keyframes = {}
+    for f in range(nframes):
+        k = f//frames
+        t = f/frames - k
+
+        #calculate the keyframes this frame needs, dropping those no later frame does
+        for key in list(keyframes):
+            if key < k:
+                del keyframes[key]
+        for key in (k, k+1):
+            if key <= doublings and key not in keyframes:
+                tkey = time.time()
+                img = render_keyframe(mandelbrot,keyframe_view(xtarget,ytarget,width,height,key),kx,ky,precision,maxiter)
+                keyframes[key] = (img, scaled_range(img,scaling))
+                print("Calculated keyframe %d of %d (%.2fs)"%(key+1,doublings+1,time.time()-tkey))
+
+        outer, (omin, omax) = keyframes[k]
+        if k+1 in keyframes:
+            inner, (imin, imax) = keyframes[k+1]
+        else:
+            inner, (imin, imax) = None, (omin, omax)
+        frame = make_frame(outer,inner,2.**t,nx,ny)
+
+        vmin = (1-t)*omin + t*imin
+        vmax = (1-t)*omax + t*imax
+        if not vmax > vmin:
+            vmax = vmin + 1
+        frame = scale(frame,scaling)
+        frame -= vmin
+        frame /= (vmax-vmin)
+        np.nan_to_num(frame,copy=False,nan=0.,posinf=1.,neginf=0.)
+
+        #the frames carry their view like saved images, so any of them can be opened in pyFractal
+        xorigin, yorigin, xmin, xmax, ymin, ymax = view.split_view(*keyframe_view(xtarget,ytarget,width,height,k+t),nx=nx)
+        metadata = view.image_metadata(xorigin,yorigin,xmin,xmax,ymin,ymax,scaling,cmap,False,True,maxiter)
+        with pngs.PNGWriter(os.path.join(outdir,name%f),nx,ny,{"Software": "pyFractal", "pyFractal": json.dumps(metadata)}) as png:
+            png.writeRows(colourmap(frame[::-1],bytes=True))
+
+    total = time.time()-tstart
+    print("Rendered %d frames in %.2fs (%.3fs per frame)"%(nframes,total,total/nframes))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="pyFractal.py zoom",description="Renders a zoom movie into a point as a numbered PNG sequence")
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument("--target",nargs=2,metavar=("X","Y"),help="point to zoom in on (decimal strings, so deep zooms are exact)")
+    target.add_argument("--to",metavar="IMAGE",help="zoom in on the view of this image saved by pyFractal")
+    parser.add_argument("--doublings",type=int,help="number of times the zoom doubles (default: 10, or enough to reach the --to view)")
+    parser.add_argument("--width",type=float,default=4.,help="width of the first frame's view (default: 4)")
+    parser.add_argument("-f","--frames",type=int,default=frames_per_doubling,help="frames per doubling of the zoom (default: %d)"%frames_per_doubling)
+    parser.add_argument("--oversample",type=int,default=oversample,help="keyframe resolution relative to the frames (default: %d)"%oversample)
+    parser.add_argument("-o","--outdir",default="zoom",help="directory to write the frames to (default: zoom)")
+    parser.add_argument("--nx",type=int,default=1280,help="frame width in pixels (default: 1280)")
+    parser.add_argument("--ny",type=int,default=720,help="frame height in pixels (default: 720)")
+    parser.add_argument("--maxiter",type=int,help="iteration budget (default: chosen for the final view)")
+    parser.add_argument("--cmap",default="viridis",help="matplotlib colourmap (default: viridis)")
+    parser.add_argument("--scaling",default="Linear",choices=["Linear","Logarithmic","Sqrt","Cbrt"],help="colour scaling (default: Linear)")
+    parser.add_argument("--threads",type=int,help="Numba threads (default: all the cores)")
+    add_device_arguments(parser)
+    args = parser.parse_args(argv)
+
+    doublings = args.doublings
+    if args.to is not None:
+        metadata = pngs.GetImageMetadata(args.to)
+        if metadata is None or "pyFractal" not in metadata:
+            print("%s is not an image saved by pyFractal"%args.to)
+            return 1
+        saved = json.loads(metadata["pyFractal"])
+        ctx = perturbation.context
+        xmin, xmax = perturbation.exact(saved["xmin"]), perturbation.exact(saved["xmax"])
+        ymin, ymax = perturbation.exact(saved["ymin"]), perturbation.exact(saved["ymax"])
+        xtarget = ctx.divide(ctx.add(xmin,xmax),2)
+        ytarget = ctx.divide(ctx.add(ymin,ymax),2)
+        if doublings is None:
+            doublings = max(1,int(math.ceil(math.log2(args.width/float(ctx.subtract(xmax,xmin))))))
+    else:
+        xtarget, ytarget = args.target
+        if doublings is None:
+            doublings = 10
+
+    platform, device, precision = device_settings(args)
+    from .multidevice import create_mandelbrot
+    mandelbrot = create_mandelbrot(platform,device,nthreads=args.threads)
+
+    zoom(mandelbrot,args.outdir,xtarget,ytarget,width=args.width,doublings=doublings,frames=args.frames,
+         nx=args.nx,ny=args.ny,oversample=args.oversample,precision=precision,maxiter=args.maxiter,
+         scaling=args.scaling,cmap=args.cmap)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())